@@ -0,0 +1,416 @@
+"""
+Benchmarks every stage of the snoserve pipeline on synthetic SNODAS data.
+
+A synthetic SNODAS TAR file is generated with one gzipped, big-endian int16 .dat file and one
+gzipped .txt header per product in filenames.txt, on the full 6935 x 3351 grid or a scaled one.
+Each stage is then timed on a scratch folder: downloading from a local HTTP server, extracting
+the TAR and GZ files, converting (from the extracted files and streamed from the TAR file),
+colorizing and publishing to a mock GeoServer. The timings are written as JSON so runs on
+different commits can be compared:
+
+    python benchmark.py --scale 0.25 --repeat 3 --output before.json
+    python benchmark.py --scale 0.25 --repeat 3 --output after.json --compare before.json
+"""
+
+import gzip
+import json
+import platform
+import subprocess
+import tarfile
+from argparse import ArgumentParser
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from os import getenv
+from os.path import basename, dirname, getsize, isfile, join
+from pathlib import Path
+from shutil import rmtree
+from statistics import median
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+import numpy as np
+
+from snoserve import dataDate, directory, downloader, file, read_txt_vars, server
+
+# The full SNODAS grid, in pixels and degrees
+COLUMNS = 6935
+ROWS = 3351
+EXTENT = (-124.733749999999, 24.9495833333335, -66.9420833333342, 52.8745833333323)
+
+# The file name prefix and data units of each product, by output file name in filenames.txt
+PRODUCTS = {
+    "snowpacksub": ("us_ssmv11050lL00T", "Meters / 100000.000000"),
+    "melt": ("us_ssmv11044bS__T", "Meters / 100000.000000"),
+    "blowingsub": ("us_ssmv11039lL00T", "Meters / 100000.000000"),
+    "temp": ("us_ssmv11038wS__A", "Kelvin / 1.000000"),
+    "snowdepth": ("us_ssmv11036tS__T", "Meters / 1000.000000"),
+    "swe": ("us_ssmv11034tS__T", "Meters / 1000.000000"),
+    "precipsnow": ("us_ssmv01025SlL01T", "Kilograms per square meter / 10.000000"),
+    "preciprain": ("us_ssmv01025SlL00T", "Kilograms per square meter / 10.000000"),
+}
+
+# Each stage and the stage whose output it needs
+STAGES = {
+    "download": None,
+    "extractTAR": "download",
+    "extractGZ": "extractTAR",
+    "createTiffs": "extractGZ",
+    "streamTiffs": "download",
+    "colorize": "streamTiffs",
+    "publish": "streamTiffs",
+}
+
+
+class benchmark:
+    """
+    Times the stages of the pipeline on a synthetic SNODAS TAR file.
+
+    Attributes:
+        root (str): The scratch folder, holding the synthetic TAR file and the data and tmp folders.
+        scale (float): The size of the grid relative to the full SNODAS grid.
+        repeat (int): The number of times each stage is timed.
+        workers (int): The number of products converted at once, or None for the default.
+        date (dataDate): The date given to the synthetic data.
+    """
+
+    def __init__(self, root, scale=1.0, repeat=1, workers=None):
+        """
+        Initializes the benchmark.
+
+        Args:
+            root (str): The scratch folder. It is created if needed.
+            scale (float, optional): The size of the grid relative to the full SNODAS grid. Defaults to 1.
+            repeat (int, optional): The number of times each stage is timed. Defaults to 1.
+            workers (int, optional): The number of products converted at once. Defaults to
+                SNOSERVE_WORKERS or the number of CPUs.
+        """
+        self.root = root
+        self.scale = scale
+        self.repeat = repeat
+        self.workers = workers
+        self.date = dataDate("20240115")
+        Path(root).mkdir(parents=True, exist_ok=True)
+
+    def synthetic(self):
+        """
+        Writes the synthetic SNODAS TAR file, unless it was written by an earlier run.
+
+        Returns:
+            str: The path of the TAR file.
+        """
+        tar = join(self.root, "source", f"SNODAS_unmasked_{self.date.date_string}_{self.scale:g}.tar")
+        if not isfile(tar):
+            Path(dirname(tar)).mkdir(parents=True, exist_ok=True)
+            synthetic_tar(tar, self.date.date_string, self.scale)
+        return tar
+
+    def time(self, function, args=(), setup=None):
+        """
+        Times a function `self.repeat` times.
+
+        Args:
+            function (callable): The function to time. It is called with `args`.
+            setup (callable, optional): Called before each call, untimed, to reset its inputs.
+
+        Returns:
+            tuple: The seconds each call took and the result of the last call.
+        """
+        seconds = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = perf_counter()
+            result = function(*args)
+            seconds.append(perf_counter() - start)
+        return seconds, result
+
+    def run(self, stages=None):
+        """
+        Times the stages.
+
+        A stage that fails is recorded with its error, and the stages that need its output are skipped.
+
+        Args:
+            stages (list, optional): The stages to time, from `STAGES`. Defaults to all of them.
+                The stages they need are run as well.
+
+        Returns:
+            dict: The results, with the timings of each stage.
+        """
+        stages = stages or list(STAGES)
+        needed = set()
+        for stage in stages:
+            while stage is not None:
+                needed.add(stage)
+                stage = STAGES[stage]
+        tar = self.synthetic()
+        grid = read_txt_vars(join(dirname(tar), "header.txt"))
+        results = {
+            "commit": git_commit(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "scale": self.scale,
+            "columns": int(grid["Number of columns"]),
+            "rows": int(grid["Number of rows"]),
+            "tarBytes": getsize(tar),
+            "repeat": self.repeat,
+            "stages": {},
+        }
+        rmtree(join(self.root, "data"), ignore_errors=True)
+        rmtree(join(self.root, "tmp"), ignore_errors=True)
+        dir = directory(self.date, self.root)
+        data = file(self.date, dir, client=downloader())
+        source = ThreadingHTTPServer(("127.0.0.1", 0), partial(quietFileHandler, directory=dirname(tar)))
+        Thread(target=source.serve_forever, daemon=True).start()
+        data.address = f"http://127.0.0.1:{source.server_port}/{basename(tar)}"
+
+        def fresh_download():
+            Path(dir.download).unlink(missing_ok=True)
+            Path(f"{dir.download}.json").unlink(missing_ok=True)
+
+        def fresh_extract():
+            rmtree(dir.extract, ignore_errors=True)
+            data.extractTAR()
+
+        def colorize(tiffs):
+            return [tiff.colorize(dir) for tiff in tiffs if isfile(join(dir.colortables, f"{tiff.name}.txt"))]
+
+        # The function timed for each stage, its arguments (None for the output of the stage it
+        # needs) and the untimed setup run before each call
+        jobs = {
+            "download": (data.download, (), fresh_download),
+            "extractTAR": (data.extractTAR, (), lambda: rmtree(dir.extract, ignore_errors=True)),
+            "extractGZ": (data.extractGZ, (), fresh_extract),
+            "createTiffs": (data.createTiffs, (False, self.workers), data.manifest.invalidate),
+            "streamTiffs": (data.streamTiffs, (False, self.workers), data.manifest.invalidate),
+            "colorize": (colorize, None, None),
+            "publish": (self.publish, (dir,), None),
+        }
+        outputs = {}
+        try:
+            for stage in STAGES:
+                if stage not in needed:
+                    continue
+                required = STAGES[stage]
+                if required is not None and required not in outputs:
+                    results["stages"][stage] = {"skipped": f"{required} failed"}
+                    continue
+                (function, args, setup) = jobs[stage]
+                if args is None:
+                    args = (outputs[required],)
+                try:
+                    (seconds, outputs[stage]) = self.time(function, args, setup)
+                except Exception as error:
+                    results["stages"][stage] = {"error": f"{type(error).__name__}: {error}"}
+                    continue
+                if stage in ("createTiffs", "streamTiffs") and data.errors:
+                    results["stages"][stage] = {"error": f"failed products: {sorted(data.errors)}"}
+                    del outputs[stage]
+                    continue
+                results["stages"][stage] = {"seconds": seconds, "min": min(seconds), "median": median(seconds)}
+        finally:
+            source.shutdown()
+        return results
+
+    def publish(self, dir):
+        """
+        Uploads and styles snowdepth and swe on a mock GeoServer.
+
+        Args:
+            dir (directory): The directory object of the converted data.
+
+        Returns:
+            dict: The responses of the uploads.
+        """
+        mock = ThreadingHTTPServer(("127.0.0.1", 0), mockGeoServer)
+        Thread(target=mock.serve_forever, daemon=True).start()
+        settings = {
+            **dir.settings,
+            "GEOSERVER_ADDRESS": f"http://127.0.0.1:{mock.server_port}/geoserver/rest",
+            "GEOSERVER_USERNAME": "admin",
+            "GEOSERVER_PASS": "geoserver",
+        }
+        try:
+            verty = server(directory(self.date, dir.root, dir.tmp, settings, dir.gdalConfig))
+            published = verty.selective_upload("SNODAS", dir.finalData, ["snowdepth", "swe"])
+            verty.style_types(["snowdepth", "swe"])
+            if verty.errors:
+                raise Exception(f"Failed to publish {list(verty.errors)}")
+            return published
+        finally:
+            mock.shutdown()
+
+
+class quietFileHandler(SimpleHTTPRequestHandler):
+    """Serves the synthetic TAR file without logging each request."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class mockGeoServer(BaseHTTPRequestHandler):
+    """Stands in for the GeoServer REST API: nothing exists, and every change succeeds."""
+
+    def handle_request(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(404 if self.command == "GET" else 201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def synthetic_grid(columns, rows, seed=0):
+    """
+    Generates a smooth, snowpack-like field with no data outside an oval standing in for CONUS.
+
+    Args:
+        columns (int): The number of columns.
+        rows (int): The number of rows.
+        seed (int, optional): The seed of the random phases. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: The raw int16 values, with -9999 for no data.
+    """
+    phases = np.random.default_rng(seed).uniform(0, 2 * np.pi, 4)
+    x = np.linspace(-1, 1, columns, dtype=np.float32)
+    y = np.linspace(-1, 1, rows, dtype=np.float32)[:, np.newaxis]
+    field = np.sin(9 * x + phases[0]) * np.cos(7 * y + phases[1]) + 0.5 * np.sin(23 * x + 17 * y + phases[2])
+    grid = np.clip(field * 1500 + 300 * np.sin(3 * y + phases[3]), 0, 32000).astype(np.int16)
+    grid[(x**2 + y**2) > 0.95] = -9999
+    return grid
+
+
+def synthetic_header(name, units, columns, rows):
+    """
+    Writes the text of a SNODAS .txt header.
+
+    Args:
+        name (str): The output file name of the product, a value of filenames.txt.
+        units (str): The data units of the product (e.g., 'Meters / 1000.000000').
+        columns (int): The number of columns.
+        rows (int): The number of rows.
+
+    Returns:
+        str: The header.
+    """
+    descriptions = {value: key for key, value in read_txt_vars(directory(dataDate("20240101")).filenames).items()}
+    (minX, minY, maxX, maxY) = EXTENT
+    lines = {
+        "Format version": "NOHRSC GIS/RS raster file v1.1",
+        "Description": descriptions[name],
+        "Data units": units,
+        "Number of columns": columns,
+        "Number of rows": rows,
+        "Data bytes per pixel": 2,
+        "No data value": -9999,
+        "Horizontal datum": "WGS84",
+        "Minimum x-axis coordinate": minX,
+        "Maximum x-axis coordinate": maxX,
+        "Minimum y-axis coordinate": minY,
+        "Maximum y-axis coordinate": maxY,
+        "X-axis resolution": (maxX - minX) / columns,
+        "Y-axis resolution": (maxY - minY) / rows,
+    }
+    return "".join(f"{key}: {value}\n" for key, value in lines.items())
+
+
+def synthetic_tar(tar, date, scale=1.0):
+    """
+    Writes a synthetic SNODAS TAR file with every product in filenames.txt.
+
+    A copy of the header is kept next to the TAR file as header.txt.
+
+    Args:
+        tar (str): The path of the TAR file.
+        date (str): The date of the data in YYYYMMDD format.
+        scale (float, optional): The size of the grid relative to the full SNODAS grid. Defaults to 1.
+    """
+    columns = max(1, round(COLUMNS * scale))
+    rows = max(1, round(ROWS * scale))
+    with tarfile.open(tar, "w") as archive:
+        for seed, (name, (prefix, units)) in enumerate(PRODUCTS.items()):
+            member = f"{prefix}0024TTNATS{date}05HP001"
+            header = synthetic_header(name, units, columns, rows)
+            dat = synthetic_grid(columns, rows, seed).astype(">i2").tobytes()
+            for extension, content in ((".txt.gz", header.encode()), (".dat.gz", dat)):
+                add_member(archive, f"{member}{extension}", gzip.compress(content, compresslevel=6))
+    with open(join(dirname(tar), "header.txt"), "w") as out:
+        out.write(header)
+
+
+def add_member(archive, name, content):
+    """
+    Adds a file to an open TAR file from memory.
+
+    Args:
+        archive (tarfile.TarFile): The TAR file.
+        name (str): The name of the member.
+        content (bytes): The content of the member.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    archive.addfile(info, BytesIO(content))
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=dirname(__file__) or ".", capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Prints the median time of each stage against a baseline run.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline run.
+    """
+    print(f"{'stage':<12} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for stage, timing in results["stages"].items():
+        before = baseline["stages"].get(stage, {}).get("median")
+        now = timing.get("median")
+        if before is None or now is None:
+            print(f"{stage:<12} {before or '-':>10} {now or '-':>10} {'-':>7}")
+            continue
+        print(f"{stage:<12} {before:>10.3f} {now:>10.3f} {now / before:>7.2f}")
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the snoserve pipeline on synthetic SNODAS data.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Grid size relative to the full SNODAS grid.")
+    parser.add_argument("--repeat", type=int, default=1, help="Times to run each stage.")
+    parser.add_argument("--workers", type=int, help="Products to convert at once.")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="Stages to time. Defaults to all.")
+    parser.add_argument("--root", help="Scratch folder. Defaults to a new temporary folder.")
+    parser.add_argument("--output", help="JSON file to write the results to.")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with.")
+    args = parser.parse_args(argv)
+    root = args.root or getenv("SNOSERVE_BENCHMARK_ROOT") or mkdtemp(prefix="snoserve-benchmark-")
+    results = benchmark(root, args.scale, args.repeat, args.workers).run(args.stages)
+    if args.root is None and getenv("SNOSERVE_BENCHMARK_ROOT") is None:
+        rmtree(root)
+    print(json.dumps(results, indent=1))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=1)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
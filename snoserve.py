@@ -1,15 +1,303 @@
+import cProfile
+import hashlib
+import io
+import json
+import math
+import resource
+import sys
+import tarfile
+from argparse import ArgumentParser
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
+from functools import wraps
+from gzip import decompress
 from gzip import open as gunzip
-from os import chdir, environ, getenv, listdir, path, remove, system
-from os.path import abspath, dirname, isfile, join
+from html import escape
+from importlib import import_module
+from os import cpu_count, getenv, getpid, link, listdir, path, remove, replace
+from os.path import abspath, dirname, getsize, isfile, join
 from pathlib import Path
-from shutil import copyfileobj, rmtree, unpack_archive
-from subprocess import check_call
-from urllib.request import urlretrieve
+from random import uniform
+from shutil import copyfile, copyfileobj, rmtree, unpack_archive
+from threading import BoundedSemaphore, Lock
+from time import perf_counter, sleep, thread_time, time
+from zipfile import ZIP_STORED, ZipFile
 
-from geoserver.catalog import Catalog
-from osgeo.gdal import Translate, TranslateOptions
-from pytz import timezone
+
+class lazyModule:
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used.
+
+    GDAL, the GeoServer client, NumPy, requests and pytz take most of the time it takes to start,
+    so they are imported through this, and commands that do not need them start in milliseconds.
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name (str): The name of the module (e.g., osgeo.gdal).
+        """
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = import_module(self.name)
+        return getattr(self.module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self.name!r}>"
+
+
+np = lazyModule("numpy")
+requests = lazyModule("requests")
+gdal = lazyModule("osgeo.gdal")
+catalog = lazyModule("geoserver.catalog")
+pytz = lazyModule("pytz")
+processes = lazyModule("concurrent.futures.process")
+
+
+# Output profiles GTIFF.process can write a product with, selected per product in profiles.txt.
+# "cog" writes a Cloud Optimized GeoTIFF: internally tiled, compressed with a predictor and with
+# internal overviews, so GeoServer can serve zoomed out requests without reading the full grid.
+OUTPUT_PROFILES = {
+    "gtiff": {"format": "GTiff", "creationOptions": []},
+    "tiled": {
+        "format": "GTiff",
+        "creationOptions": [
+            "TILED=YES",
+            "BLOCKXSIZE=512",
+            "BLOCKYSIZE=512",
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=2",
+        ],
+    },
+    "cog": {
+        "format": "COG",
+        "creationOptions": [
+            "BLOCKSIZE=512",
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=YES",
+            "OVERVIEWS=AUTO",
+            "RESAMPLING=AVERAGE",
+        ],
+    },
+    "cog-zstd": {
+        "format": "COG",
+        "creationOptions": [
+            "BLOCKSIZE=512",
+            "COMPRESS=ZSTD",
+            "LEVEL=9",
+            "PREDICTOR=YES",
+            "OVERVIEWS=AUTO",
+            "RESAMPLING=AVERAGE",
+        ],
+    },
+    # Not converted at all: the raw grid is kept next to a VRT describing it (see GTIFF.reference)
+    "vrt": {"format": "VRT", "creationOptions": []},
+}
+
+
+# Properties files of a time-enabled ImageMosaic store. The time of each granule is read from
+# the YYYYMMDD date in its file name.
+MOSAIC_PROPERTIES = {
+    "indexer.properties": (
+        "TimeAttribute=time\n"
+        "Schema=*the_geom:Polygon,location:String,time:java.util.Date\n"
+        "PropertyCollectors=TimestampFileNameExtractorSPI[timeregex](time)\n"
+    ),
+    "timeregex.properties": "regex=[0-9]{8}\n",
+}
+
+
+# Nodata value of the products computed by derivedProducts
+DERIVED_NODATA = -9999.0
+# How derived products are written block by block before they are copied to a COG
+DERIVED_BLOCKS = ["TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=3"]
+
+# Factors converting the base units of the SNODAS metadata to inches. A kilogram of water per
+# square meter is a millimeter of water.
+UNITS_TO_INCHES = {
+    "Meters": 39.37007874,
+    "Millimeters": 0.03937007874,
+    "Kilograms per square meter": 0.03937007874,
+}
+
+
+class instrumentation:
+    """
+    Measures the stages of the pipeline and exports the measurements.
+
+    Each stage run with `stage()` records its wall time, the CPU time of its thread, the bytes
+    the process read and wrote (files and sockets, from /proc/self/io), the peak RSS of the
+    process and its outcome. Every record is appended as a JSON line to the SNOSERVE_METRICS_LOG
+    file, if set, and kept in `records` until `export()` writes them to the SNOSERVE_METRICS_FILE
+    file in the Prometheus text format, which node_exporter's textfile collector can scrape. When
+    SNOSERVE_CPROFILE is set to a folder, each stage is also profiled to a .prof file in it.
+
+    Byte counts and peak RSS are for the whole process, so stages running at the same time are
+    counted in each other's bytes.
+
+    Attributes:
+        records (list): The records of the stages run, as dicts.
+    """
+
+    def __init__(self):
+        """
+        Initializes an instrumentation object without records.
+        """
+        self.records = []
+        self.lock = Lock()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Measures the code run in the `with` block as a stage.
+
+        Args:
+            name (str): The name of the stage (e.g., download).
+            **labels: Labels telling runs of the stage apart (e.g., product="swe").
+
+        Yields:
+            dict: The record of the stage, completed when the block exits.
+        """
+        record = {"stage": name, "labels": labels, "start": time(), "pid": getpid()}
+        profiler = None
+        if getenv("SNOSERVE_CPROFILE"):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # another stage of this process is being profiled
+                profiler = None
+        (read, written) = io_counters()
+        (wall, cpu) = (perf_counter(), thread_time())
+        try:
+            yield record
+            record["outcome"] = "ok"
+        except BaseException as error:
+            record["outcome"] = "error"
+            record["error"] = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            record["wall_seconds"] = perf_counter() - wall
+            record["cpu_seconds"] = thread_time() - cpu
+            (readAfter, writtenAfter) = io_counters()
+            record["read_bytes"] = readAfter - read
+            record["written_bytes"] = writtenAfter - written
+            record["peak_rss_bytes"] = peak_rss()
+            if profiler is not None:
+                profiler.disable()
+                folder = getenv("SNOSERVE_CPROFILE")
+                Path(folder).mkdir(parents=True, exist_ok=True)
+                tag = "-".join([name] + [str(value) for value in labels.values()])
+                profiler.dump_stats(join(folder, f"{tag}-{getpid()}-{int(record['start'] * 1000)}.prof"))
+            self.add([record], log=True)
+
+    def add(self, records, log=False):
+        """
+        Keeps records, e.g. sent back by a worker process.
+
+        Args:
+            records (list): The records.
+            log (bool, optional): If True, also appends them to the SNOSERVE_METRICS_LOG file. Defaults to False.
+        """
+        with self.lock:
+            self.records.extend(records)
+            if log and getenv("SNOSERVE_METRICS_LOG"):
+                with open(getenv("SNOSERVE_METRICS_LOG"), "a") as out:
+                    for record in records:
+                        out.write(json.dumps(record) + "\n")
+
+    def reset(self):
+        """
+        Forgets the records, e.g. between the runs of a long-running process.
+        """
+        with self.lock:
+            self.records = []
+
+    def export(self, textfile=None):
+        """
+        Writes the records in the Prometheus text format, replacing the file in one step.
+
+        Runs of a stage with the same labels are added up. A stage's success is 0 if any of its
+        runs failed.
+
+        Args:
+            textfile (str, optional): The file to write. Defaults to SNOSERVE_METRICS_FILE. Nothing
+                is written if neither is set.
+
+        Returns:
+            str: The text written.
+        """
+        textfile = textfile or getenv("SNOSERVE_METRICS_FILE")
+        metrics = {
+            "duration_seconds": ("wall_seconds", "Wall time of the stage in the last run."),
+            "cpu_seconds": ("cpu_seconds", "CPU time of the stage's thread in the last run."),
+            "read_bytes": ("read_bytes", "Bytes read by the process during the stage in the last run."),
+            "written_bytes": ("written_bytes", "Bytes written by the process during the stage in the last run."),
+            "peak_rss_bytes": ("peak_rss_bytes", "Peak resident memory of the process at the end of the stage."),
+            "runs": (None, "Runs of the stage in the last run."),
+            "success": (None, "1 if every run of the stage succeeded in the last run, else 0."),
+        }
+        with self.lock:
+            records = list(self.records)
+        series = {}
+        for record in records:
+            labels = {"stage": record["stage"], **record["labels"]}
+            key = tuple(sorted(labels.items()))
+            totals = series.setdefault(key, {"runs": 0, "success": 1, "peak_rss_bytes": 0})
+            totals["runs"] += 1
+            totals["success"] &= record["outcome"] == "ok"
+            for field in ("wall_seconds", "cpu_seconds", "read_bytes", "written_bytes"):
+                totals[field] = totals.get(field, 0) + record[field]
+            totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"], record["peak_rss_bytes"])
+        lines = []
+        for metric, (field, help) in metrics.items():
+            lines += [f"# HELP snoserve_stage_{metric} {help}", f"# TYPE snoserve_stage_{metric} gauge"]
+            for key, totals in series.items():
+                labels = ",".join(f'{label}="{prometheus_escape(value)}"' for label, value in key)
+                lines.append(f"snoserve_stage_{metric}{{{labels}}} {float(totals[field or metric])}")
+        lines += [
+            "# HELP snoserve_last_run_timestamp_seconds Time the metrics were written.",
+            "# TYPE snoserve_last_run_timestamp_seconds gauge",
+            f"snoserve_last_run_timestamp_seconds {time()}",
+        ]
+        text = "\n".join(lines) + "\n"
+        if textfile:
+            Path(textfile).parent.mkdir(parents=True, exist_ok=True)
+            with open(f"{textfile}.tmp", "w") as out:
+                out.write(text)
+            replace(f"{textfile}.tmp", textfile)
+        return text
+
+
+# The measurements of this process. Worker processes send theirs back with their results.
+instruments = instrumentation()
+
+
+def instrumented(name, labels=None):
+    """
+    Decorates a method so that each call is measured as a stage by `instruments`.
+
+    Args:
+        name (str): The name of the stage.
+        labels (callable, optional): Returns the labels of a call when called with its arguments,
+            including self.
+
+    Returns:
+        callable: The decorator.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def measured(*args, **kwargs):
+            with instruments.stage(name, **(labels(*args, **kwargs) if labels else {})):
+                return function(*args, **kwargs)
+
+        return measured
+
+    return decorator
 
 
 class dataDate:
@@ -17,8 +305,10 @@ class dataDate:
     A class to determine the appropriate date for data download and naming purposes.
 
     This class determines the latest date for which SNODAS data should be downloaded and processed.
-    It accounts for the release time of the data, which is typically at 9:15 AM Eastern Time.
+    It accounts for the release time of the data, which is typically at 9:15 AM Eastern Time
+    (SNOSERVE_RELEASE, see `release_time`).
     If the current time is before the release time, the class will use the date from the previous day.
+    A specific date can be given instead, for example when backfilling historical data.
 
     Attributes:
         latest_data (datetime.datetime): The latest date for which SNODAS data should be downloaded and processed.
@@ -34,19 +324,28 @@ class dataDate:
         2023-06-10 00:00:00-04:00
         >>> print(date_obj.date_string)
         20230610
+        >>> print(dataDate("20240102").date_string)
+        20240102
     """
 
-    def __init__(self):
+    def __init__(self, date=None):
         """
         Initializes the dataDate object and determines the latest date for SNODAS data download and processing.
+
+        Args:
+            date (datetime.datetime or str, optional): The date to use instead of the latest date, as a
+                datetime or a string in YYYYMMDD format.
         """
-        tz = timezone("US/Eastern")
-        now = datetime.now(tz)
-        releaseTime = now.replace(hour=9, minute=15, second=0, microsecond=0)
-        if now < releaseTime:
-            self.latest_data = now - timedelta(days=1)
+        if date is None:
+            now = datetime.now(pytz.timezone("US/Eastern"))
+            if now < release_time(now):
+                self.latest_data = now - timedelta(days=1)
+            else:
+                self.latest_data = now
+        elif isinstance(date, str):
+            self.latest_data = datetime_from_str(date)
         else:
-            self.latest_data = now
+            self.latest_data = date
         self.year = self.latest_data.strftime("%Y")
         self.day = self.latest_data.strftime("%d")
         self.month = self.latest_data.strftime("%m")
@@ -54,523 +353,4532 @@ class dataDate:
         self.monthAbbrv = self.latest_data.strftime("%b")
 
 
-class file:
+class downloader:
     """
-    A class for downloading and processing SNODAS data.
+    A pooled HTTP client for downloading SNODAS TAR files.
 
-    This class handles the downloading, extraction, and processing of SNODAS data for a given date.
-    It creates the necessary directories, downloads the data, extracts the compressed files,
-    and prepares the data for further processing.
+    One downloader keeps its HTTP connections open between downloads, so sharing it between
+    the file objects of many dates (as `backfill` does) avoids a new connection per date.
 
-    Attributes:
-        date (dataDate): A dataDate object containing the date information for the data download.
-        dir (directory): A directory object containing the paths for various directories used in the processing.
-        address (str): The URL address for downloading the SNODAS data.
+    Downloads are written to a `.part` file next to the destination. If a download is interrupted,
+    the next attempt resumes from the end of the `.part` file with an HTTP Range request. A download
+    is only moved into place once its size matches the server's and it reads as a complete TAR file.
+    Failed attempts are retried with exponential backoff.
 
-    Methods:
-        download(): Downloads the SNODAS data if it hasn't been downloaded already.
-        extractTAR(): Extracts the downloaded TAR file.
-        extractGZ(): Extracts all GZ files from the extracted TAR file.
+    The ETag and Last-Modified headers of each download are stored in a `.json` file next to it.
+    When `revalidate` is True, an existing download is checked with a conditional request and only
+    downloaded again if NOAA has changed it. Otherwise an existing complete download is used without
+    contacting NOAA at all.
+
+    Attributes:
+        session (requests.Session): The session holding the pooled connections.
+        retries (int): The number of times a failed download is retried.
+        backoff (float): The delay in seconds before the first retry. It doubles on each retry.
+        timeout (float): The timeout in seconds for connecting and for each read.
+        revalidate (bool): Whether to check existing downloads with a conditional request.
     """
-    def __init__(self, date, directory):
+
+    def __init__(self, pool_size=4, retries=5, backoff=2.0, timeout=60, revalidate=False):
         """
-        Initializes the file object with the given date and directory information.
+        Initializes the downloader and its connection pool.
 
         Args:
-            date (dataDate): A dataDate object containing the date information for the data download.
-            directory (directory): A directory object containing the paths for various directories used in the processing.
+            pool_size (int, optional): The number of connections kept open per host. Defaults to 4.
+            retries (int, optional): The number of times a failed download is retried. Defaults to 5.
+            backoff (float, optional): The delay in seconds before the first retry. Defaults to 2.
+            timeout (float, optional): The timeout in seconds for connecting and for each read. Defaults to 60.
+            revalidate (bool, optional): Whether to check existing downloads with a conditional request. Defaults to False.
         """
-        self.date = date
-        self.dir = directory
-        self.dir.create()
-        self.address = f"https://noaadata.apps.nsidc.org/NOAA/G02158/unmasked/{self.date.year}/{self.date.month}_{self.date.monthAbbrv}/SNODAS_unmasked_{self.date.year}{self.date.month}{self.date.day}.tar"
+        self.session = requests.Session()
+        # Ignore proxy settings from the environment to allow downloading without a proxy
+        self.session.trust_env = False
+        # Byte ranges must refer to the file itself, not a compressed transfer of it
+        self.session.headers["Accept-Encoding"] = "identity"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.revalidate = revalidate
 
-    def download(self):
+    def fetch(self, url, dest):
         """
-        Downloads the SNODAS data if it hasn't been downloaded already.
+        Downloads a TAR file unless a complete, unchanged copy already exists.
 
-        This method checks if the SNODAS data file has already been downloaded.
-        If the file doesn't exist, it downloads the data from the specified URL address.
-        If the file already exists, it prints a message indicating that the file has been downloaded.
+        Args:
+            url (str): The URL of the TAR file.
+            dest (str): The local path to save the TAR file to.
+
+        Returns:
+            bool: True if new data was downloaded, False if the existing file was kept.
+
+        Raises:
+            requests.RequestException, OSError, tarfile.TarError: If the download still fails after all retries.
         """
-        if not isfile(self.dir.download):
-            # Set the no_proxy environment variable to allow downloading without a proxy
-            environ["no_proxy"] = "*"
-            print(urlretrieve(self.address, self.dir.download))
-        else:
-            print("file already downloaded; proceeding")
+        validators = self.validators(dest)
+        headers = {}
+        if self.complete(dest, validators):
+            if not self.revalidate:
+                print("file already downloaded; proceeding")
+                return False
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                headers["If-Modified-Since"] = validators["last_modified"]
+        for attempt in range(self.retries + 1):
+            try:
+                return self.attempt(url, dest, headers)
+            except (requests.RequestException, OSError, tarfile.TarError) as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt * uniform(0.5, 1)
+                print(f"Download of {url} failed ({error}); retrying in {delay:.1f}s")
+                sleep(delay)
 
-    def extractTAR(self):
+    def available(self, url):
         """
-        Extracts the downloaded TAR file.
+        Checks whether a file has been published, with a HEAD request.
 
-        This method extracts the downloaded TAR file into the specified extraction directory.
-        The extracted files are used for further processing.
+        Args:
+            url (str): The URL of the file.
 
         Returns:
-            str: The path to the directory where the TAR file was extracted.
+            bool: True if the server has the file, False if it doesn't or can't be reached.
         """
-        unpack_archive(self.dir.download, self.dir.extract)
-        return self.dir.extract
+        return self.version(url) is not None
 
-    def extractGZ(self):
+    def version(self, url):
         """
-        Extracts all GZ files from the extracted TAR file and removes the original GZ files.
+        Identifies the published version of a file, with a HEAD request.
 
-        This method navigates to the directory where the TAR file was extracted.
-        It then iterates through all files in the directory and checks for files with the '.gz' extension.
-        For each GZ file found, it extracts the contents and creates a new file without the '.gz' extension.
-        After extracting the contents, the original GZ file is removed.
-        Finally, the method changes the current working directory back to the original directory.
+        Args:
+            url (str): The URL of the file.
+
+        Returns:
+            str: The Last-Modified or ETag header of the file, "" if the server sends neither, or
+            None if the server doesn't have the file or can't be reached.
         """
-        extension = ".gz"
-        chdir(self.dir.extract)
-        for item in listdir(self.dir.extract):
-            if item.endswith(extension):
-                nameGZ = path.abspath(item)
-                outputName = (path.basename(nameGZ)).rsplit(".", 1)[0]
-                with gunzip(nameGZ, "rb") as fileIn, open(outputName, "wb") as fileOut:
-                    copyfileobj(fileIn, fileOut)
-                remove(nameGZ)
-        chdir(self.dir.workingDirectory)
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        return response.headers.get("Last-Modified") or response.headers.get("ETag") or ""
 
-    def createTiffs(self, colorize=False):
+    def attempt(self, url, dest, headers):
         """
-        Creates GeoTIFF files from the extracted .txt and .dat files.
+        Makes one attempt at downloading a TAR file, resuming a partial download if there is one.
 
         Args:
-            colorize (bool, optional): If True, applies color relief to the generated GeoTIFF files using the corresponding color table files. Defaults to False.
+            url (str): The URL of the TAR file.
+            dest (str): The local path to save the TAR file to.
+            headers (dict): Conditional request headers for an existing download.
 
-        This method iterates through the extracted files in the `self.dir.extract` directory.
-        For each file with a `.txt` extension, it performs the following steps:
-
-        1. Creates a `GTIFF` object with the file name and directory object.
-        2. Generates a `.hdr` file for the GeoTIFF using the `GTIFF.createHDR()` method.
-        3. Retrieves the output file name from the `self.dir.finalNames` dictionary based on the 'Description' metadata.
-        4. Processes the `.dat` file and generates a GeoTIFF file in the `self.dir.finalData` directory using the `GTIFF.process()` method.
-        5. If `colorize` is True, applies color relief to the generated GeoTIFF file using the `self.colorize()` method.
+        Returns:
+            bool: True if new data was downloaded, False if the server reported no change.
         """
-        filenames = self.dir.finalNames
-        for item in listdir(self.dir.extract):
-            if item.endswith(".txt"):
-                tiff = GTIFF(strip_extension(item), self.dir)
-                tiff.createHDR()
-                filename = filenames[tiff.metadata["Description"]]
-                tiff.process(self.dir, filename)
-                if colorize:
-                    self.colorize(tiff)
-
-    def colorize(self, tiff):  # colors GTIFF if 'name'.txt is provided in colortables
-        if tiff.name in [
-            strip_extension(file) for file in listdir(self.dir.colortables)
-        ]:
-            tiff.colorize(self.dir)
-
-    def cleantemp(self):  # removes extracted files
-        # currently leaves .tar file to prevent DDOSing NOAA
-        rmtree(self.dir.extract)
-
-    def clean_old_tar(self):
-        pass
-
-    def clean_old_data(self):
-        pass
+        part = f"{dest}.part"
+        headers = dict(headers)
+        offset = getsize(part) if isfile(part) else 0
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            etag = self.validators(part).get("etag")
+            if etag is not None:
+                headers["If-Range"] = etag
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                print("file unchanged on server; proceeding")
+                return False
+            if response.status_code == 416:
+                # The partial file is already complete or no longer matches the server
+                return self.finish(part, dest, self.validators(part), getsize(part))
+            response.raise_for_status()
+            validators = {}
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["last_modified"] = response.headers["Last-Modified"]
+            if response.status_code == 206:
+                total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            else:
+                # The server sent the whole file, so start over
+                offset = 0
+                total = response.headers.get("Content-Length", "")
+            total = int(total) if total.isdigit() else None
+            self.save_validators(part, validators)
+            with open(part, "ab" if offset else "wb") as out:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    out.write(chunk)
+        return self.finish(part, dest, validators, total)
 
-
-class GTIFF:  # processes individual geotiff files
-    def __init__(self, filename, directory):
+    def finish(self, part, dest, validators, total):
         """
-        Initializes the GTIFF class for processing individual GeoTIFF files.
+        Checks a finished `.part` file and moves it into place.
 
         Args:
-            filename (str): The base filename of the GeoTIFF files (without extensions).
-            directory (object): A directory object containing the necessary paths.
+            part (str): The path of the `.part` file.
+            dest (str): The local path to save the TAR file to.
+            validators (dict): The ETag and Last-Modified headers of the download.
+            total (int): The size the server reported for the file, or None if unknown.
 
-        Attributes:
-            txt (str): The file path for the associated .txt file.
-            dat (str): The file path for the associated .dat file.
-            hdr (str): The file path for the associated .hdr file.
-            metadata (dict): A dictionary containing the metadata read from the .txt file.
+        Returns:
+            bool: True, as new data was downloaded.
+
+        Raises:
+            OSError: If the file is shorter than the server reported.
+            tarfile.TarError: If the file is not a complete TAR file. The `.part` file is removed.
         """
-        self.txt = join(directory.extract, f"{filename}.txt")  # set .txt file path
-        self.dat = join(directory.extract, f"{filename}.dat")  # set .dat file path
-        self.hdr = join(directory.extract, f"{filename}.hdr")
-        self.metadata = read_txt_vars(self.txt)
+        size = getsize(part)
+        if total is not None and size < total:
+            raise OSError(f"Download truncated at {size} of {total} bytes")
+        if not valid_tar(part):
+            remove(part)
+            Path(f"{part}.json").unlink(missing_ok=True)
+            raise tarfile.TarError(f"Downloaded file {part} is not a complete TAR file")
+        validators["size"] = size
+        self.save_validators(dest, validators)
+        replace(part, dest)
+        Path(f"{part}.json").unlink(missing_ok=True)
+        return True
 
-    def stringHDR(self):
+    def complete(self, dest, validators):
         """
-        Generates the text content for the ENVI header file (.hdr) based on the metadata.
+        Checks whether a download exists, has the recorded size and is a complete TAR file.
+
+        Args:
+            dest (str): The local path of the TAR file.
+            validators (dict): The validators stored for the download.
 
         Returns:
-            str: The text content for the ENVI header file.
+            bool: True if the download is complete.
         """
-        samples = self.metadata["Number of columns"]
-        lines = self.metadata["Number of rows"]
-        self.envi = [
-            "ENVI",
-            f"samples = {samples}",
-            f"lines = {lines}",
-            "bands = 1",
-            "header offset = 0",
-            "file type = ENVI Standard",
-            "data type = 2",
-            "interleave = bsq",
-            "byte order = 1",
-        ]
-        self.envi = "\n".join(self.envi)
-        return self.envi
+        if not isfile(dest):
+            return False
+        if "size" in validators and validators["size"] != getsize(dest):
+            return False
+        return valid_tar(dest)
 
-    def createHDR(self):
+    def validators(self, dest):
         """
-        Creates the ENVI header file (.hdr) with the content generated from the stringHDR method.
+        Reads the ETag, Last-Modified and size stored for a download.
+
+        Args:
+            dest (str): The local path of the download.
 
         Returns:
-            str: The file path of the created .hdr file.
+            dict: The stored validators, empty if there are none.
         """
-        self.stringHDR()
-        with open(self.hdr, "w") as hdr:
-            hdr.write(self.envi)
-        return self.hdr
+        try:
+            with open(f"{dest}.json") as stored:
+                return json.load(stored)
+        except (OSError, ValueError):
+            return {}
 
-    def process(self, dir, filename):
+    def save_validators(self, dest, validators):
         """
-        Processes the .dat file and generates a GeoTIFF file with the specified filename.
+        Stores the ETag, Last-Modified and size for a download.
 
         Args:
-            dir (object): A directory object containing the necessary paths.
-            filename (str): The desired filename for the output GeoTIFF file.
+            dest (str): The local path of the download.
+            validators (dict): The validators to store.
         """
-        minX = float(self.metadata["Minimum x-axis coordinate"])
-        minY = float(self.metadata["Minimum y-axis coordinate"])
-        maxX = float(self.metadata["Maximum x-axis coordinate"])
-        maxY = float(self.metadata["Maximum y-axis coordinate"])
-        a_ullr = [minX, maxY, maxX, minY]
-        noData = float(self.metadata["No data value"])
-        options = TranslateOptions(
-            format="Gtiff",
-            outputSRS="epsg:4326",
-            noData=noData,
-            outputBounds=a_ullr,
-            metadataOptions=self.metadata,
-        )
-        dest = join(dir.finalData, f"{filename}.tif")
-        Translate(dest, self.dat, options=options)
-        self.fullPath = dest
-        self.name = filename
+        with open(f"{dest}.json", "w") as stored:
+            json.dump(validators, stored)
+
+
+class cache:
+    """
+    A size and age bounded cache of files, keyed by date and product.
 
-    def colorize(self, dir, colortxt=None, output_file=None):
+    The cache keeps an index file recording the path, size, date and last access time of each
+    entry, so lookups and eviction don't need to scan directories. Each operation reads and
+    rewrites the index under a lock shared by every cache object using the same index file, so
+    several file objects (e.g. during a backfill) can use one cache at once.
+
+    Attributes:
+        index (str): The path of the index file.
+        max_bytes (int): The total size the entries may use, or None for no limit.
+        max_days (float): The number of days an entry may go unused, or None for no limit.
+        policy (str): "lru" evicts the least recently used entries first, "oldest" evicts the
+            entries with the oldest dates first.
+    """
+
+    locks = {}
+
+    def __init__(self, index, max_bytes=None, max_days=None, policy="lru"):
         """
-        Applies color relief to the GeoTIFF file using a color table file.
+        Initializes the cache with its index file and budgets.
 
         Args:
-            dir (object): A directory object containing the necessary paths.
-            colortxt (str, optional): The file path of the color table file. If not provided,
-                the default file path is constructed based on the GTIFF name.
-            output_file (str, optional): The file path for the output GeoTIFF file with color relief.
-                If not provided, the original GeoTIFF file will be overwritten.
-
-        This method calls the 'gdaldem color-relief' command in the shell to apply color relief
-        to the GeoTIFF file using the specified color table file. The '-alpha' option is used to
-        preserve the alpha channel (if present) in the output file.
+            index (str): The path of the index file.
+            max_bytes (int, optional): The total size the entries may use. Defaults to no limit.
+            max_days (float, optional): The number of days an entry may go unused. Defaults to no limit.
+            policy (str, optional): "lru" or "oldest". Defaults to "lru".
         """
-        if output_file is None:
-            output_file = self.fullPath
-        if colortxt is None:
-            colortxt = join(dir.colortables, f"{self.name}.txt")
-        cmd = f"gdaldem color-relief {self.fullPath} {colortxt} {output_file} -alpha"
-        check_call(cmd, shell=True)
+        if policy not in ("lru", "oldest"):
+            raise ValueError(f"Cache policy {policy} is not one of ['lru', 'oldest'].")
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_days = max_days
+        self.policy = policy
+        self.lock = cache.locks.setdefault(abspath(index), Lock())
 
-    def convertToInches(self):
+    def load(self):
         """
-        This method is a placeholder for future work related to converting the SNODAS snow depth data
-        to inches.
+        Reads the index file.
+
+        Returns:
+            dict: The entries of the cache, empty if there is no index file yet.
         """
-        pass  # future work
+        try:
+            with open(self.index) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
 
-class directory:  # directory manager
-    def __init__(self, date):
+    def save(self, entries):
         """
-        Initializes the directory object with paths and filenames based on the provided date.
+        Writes the index file, replacing it in one step so a crash can't leave it half written.
 
         Args:
-            date (dataDate): A dataDate object containing the current date information.
+            entries (dict): The entries of the cache.
         """
-        self.workingDirectory = dirname(abspath(__file__))
-        self.date = f"{date.year}{date.month}{date.day}"
-        self.name = f"SNODAS-{self.date}"
-        self.data = join(self.workingDirectory, "data")
-        self.tmp = join(self.workingDirectory, "tmp")
-        self.download = join(self.tmp, self.name + ".tar")
-        self.extract = join(self.tmp, self.name)
-        self.finalData = join(self.data, self.name)
-        self.swe = join(self.finalData, f"swe{self.date}.tif")
-        self.snowDepth = join(self.finalData, f"snowdepth{self.date}.tif")
-        self.styles = join(self.workingDirectory, "styles")
-        self.folders = [
-            self.data,
-            self.tmp,
-            self.finalData,
-            self.extract,
-            self.styles,
-        ]
-        self.filenames = join(self.workingDirectory, "filenames.txt")
-        self.finalNames = read_txt_vars(self.filenames)
-        self.environment = join(self.workingDirectory, ".env")
+        Path(self.index).parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.index}.tmp", "w") as index:
+            json.dump(entries, index, indent=1)
+        replace(f"{self.index}.tmp", self.index)
 
-    def create(self):
+    def add(self, key, file, date):
         """
-        Creates directories for storing data, temporary files, and styles.
+        Records a file in the cache, or marks it as used if it is already there.
+
+        Args:
+            key (str): The key of the entry (e.g., 20240101 or 20240101/swe).
+            file (str): The path of the file.
+            date (str): The date of the data in the file in YYYYMMDD format.
         """
-        for folder in self.folders:
-            Path(folder).mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            entries = self.load()
+            entries[key] = {"path": file, "size": getsize(file), "date": date, "accessed": time()}
+            self.save(entries)
 
-    def outputDirs(self):
+    def get(self, key):
         """
-        Reads the file names from the filenames.txt file and creates a dictionary with the locations to save processed data.
+        Looks up a file in the cache and marks it as used.
+
+        Args:
+            key (str): The key of the entry.
 
         Returns:
-            dict: A dictionary where keys are file descriptions and values are output file paths.
+            str: The path of the file, or None if it is not in the cache.
         """
-        self.finalNames = read_txt_vars(self.filenames)
-        self.outputPaths = {}
-        for key in self.finalNames:
-            self.outputPaths[key] = join(self.finalData, f"{self.finalNames[key]}.tif")
-        return self.outputPaths
+        with self.lock:
+            entries = self.load()
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if not isfile(entry["path"]):
+                del entries[key]
+                self.save(entries)
+                return None
+            entry["accessed"] = time()
+            self.save(entries)
+            return entry["path"]
 
-    def unzippedName(self, extension, zippedFile):  # refactor extract GZ in future
+    def evict(self, keep=()):
         """
-        This method is a placeholder for future refactoring related to extracting GZ files.
+        Removes entries and their files until the cache is within its budgets.
+
+        Entries unused for longer than `max_days` are removed first. If the cache is still larger
+        than `max_bytes`, entries are removed in `policy` order until it fits.
+
+        Args:
+            keep (iterable, optional): Dates in YYYYMMDD format whose entries must not be removed.
+
+        Returns:
+            dict: The entries that were removed.
         """
-        pass
+        keep = set(keep)
+        removed = {}
+        with self.lock:
+            entries = {key: entry for key, entry in self.load().items() if isfile(entry["path"])}
+            if self.max_days is not None:
+                cutoff = time() - self.max_days * 86400
+                for key, entry in list(entries.items()):
+                    if entry["date"] not in keep and entry["accessed"] < cutoff:
+                        removed[key] = entries.pop(key)
+            if self.max_bytes is not None:
+                order = "accessed" if self.policy == "lru" else "date"
+                total = sum(entry["size"] for entry in entries.values())
+                for key, entry in sorted(entries.items(), key=lambda item: item[1][order]):
+                    if total <= self.max_bytes:
+                        break
+                    if entry["date"] not in keep:
+                        removed[key] = entries.pop(key)
+                        total -= entry["size"]
+            for entry in removed.values():
+                remove(entry["path"])
+                folder = dirname(entry["path"])
+                if folder == dirname(abspath(self.index)):
+                    continue
+                if not [item for item in listdir(folder) if not item.startswith(".")]:
+                    rmtree(folder)
+            self.save(entries)
+        return removed
 
 
-class server:
-    def __init__(self, directory):
+class manifest:
+    """
+    The record of which stages of one date have finished, and with what.
+
+    Each stage (e.g. "download", "convert/swe", "publish/swe") is recorded with its inputs and its
+    output files, with their sizes and SHA-256 hashes, in a JSON file in the date's data folder.
+    A stage is fresh, and can be skipped on a rerun, if it was recorded with the same inputs and its
+    outputs still exist with the recorded hashes. An output is only hashed again if its size or
+    modification time changed since it was recorded. Inputs are anything the stage's result depends on:
+    settings, and the hashes of the files it reads, so a stage is redone when a file it reads
+    changes content (e.g. a color table or an SLD) but not when it is merely rewritten.
+
+    The "complete" stage is recorded once a date has been fully processed and published.
+    Setting SNOSERVE_FORCE to 1 makes every stage stale.
+
+    The file is read and rewritten under a lock shared by every manifest object of the same file.
+
+    Attributes:
+        path (str): The path of the manifest file.
+    """
+
+    locks = {}
+
+    def __init__(self, path, force=None):
         """
-        Initialize a server instance with the given directory.
+        Initializes the manifest with its file.
 
         Args:
-            directory (object): A directory object containing the necessary information
-                for the server, such as the styles folder path.
+            path (str): The path of the manifest file. It is created when the first stage is recorded.
+            force (bool, optional): Whether every stage is stale. Defaults to SNOSERVE_FORCE.
         """
-        self.directory = directory
-        self.HOST =getenv("GEOSERVER_ADDRESS")
-        self.USERNAME = getenv("GEOSERVER_USERNAME")
-        self.PASSWORD = getenv("GEOSERVER_PASS")
-        self.geoserver = Catalog(self.HOST, self.USERNAME, self.PASSWORD)
-        self.geoserver
+        self.path = path
+        self.force = force
+        self.lock = manifest.locks.setdefault(abspath(path), Lock())
 
-    def upload_data(self, data_name, workspace, local_path):
+    def load(self):
         """
-        Upload geospatial data to the GeoServer instance.
+        Reads the manifest file.
+
+        Returns:
+            dict: The record of each stage, by stage name.
+        """
+        try:
+            with open(self.path) as stages:
+                return json.load(stages)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, stages):
+        """
+        Writes the manifest file, replacing it in one step so a crash can't leave it half written.
 
         Args:
-            data_name (str): The name of the data to be uploaded.
-            workspace (str): The workspace in GeoServer where the data will be uploaded.
-            local_path (str): The local file path of the data to be uploaded.
+            stages (dict): The record of each stage, by stage name.
+        """
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as out:
+            json.dump(stages, out, indent=1)
+        replace(f"{self.path}.tmp", self.path)
+
+    def fresh(self, stage, inputs=None):
+        """
+        Checks whether a stage has finished with the same inputs and its outputs are intact.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (dict, optional): The inputs the stage would run with.
 
         Returns:
-            A CoverageStore object representing the uploaded data.
+            bool: True if the stage can be skipped.
         """
-        return self.geoserver.create_coveragestore(
-            data_name,
-            workspace=workspace,
-            path=local_path,
-            upload_data=True,
-            overwrite=True,
-        )
+        if (getenv("SNOSERVE_FORCE", "0") == "1") if self.force is None else self.force:
+            return False
+        record = self.load().get(stage)
+        if record is None or record["status"] != "complete" or record["inputs"] != (inputs or {}):
+            return False
+        return all(self.current(output, info) == info["sha256"] for output, info in record["outputs"].items())
 
-    def style_data(self, layer_name, style_name):
+    def record(self, stage, inputs=None, outputs=(), status="complete", details=None):
         """
-        Styles a GeoServer layer with the specified style.
+        Records that a stage has finished.
 
-        This method first checks if the specified style exists in the GeoServer instance.
-        If the style does not exist, it uploads the style using the `upload_style` method.
-        Then, it retrieves the layer object from the GeoServer instance using the provided
-        `layer_name`. It constructs an XML string with the `style_name` to be set as the
-        default style for the layer.
+        Args:
+            stage (str): The name of the stage.
+            inputs (dict, optional): The inputs the stage ran with. They must be JSON serializable.
+            outputs (list, optional): The paths of the files the stage wrote.
+            status (str, optional): "complete", or "failed" for a stage whose failure must be
+                remembered (e.g. a failed validation). A failed stage is never fresh.
+            details (dict, optional): Anything else to keep about the stage, JSON serializable.
+        """
+        files = {}
+        for output in outputs:
+            info = Path(output).stat()
+            files[output] = {"size": info.st_size, "mtime": info.st_mtime_ns, "sha256": file_hash(output)}
+        with self.lock:
+            stages = self.load()
+            stages[stage] = {"status": status, "inputs": inputs or {}, "outputs": files, "finished": time()}
+            if details is not None:
+                stages[stage]["details"] = details
+            self.save(stages)
 
-        Finally, it sends a PUT request to the GeoServer REST API using cURL to set the
-        default style for the layer.
+    def current(self, output, info):
+        """
+        Returns the hash of a recorded output file as it is now.
 
-        As far as I can tell there is no way to set a default style for a layer using the
-        geoserver-restconfig module.
+        The recorded hash is reused while the file has the recorded size and modification time.
 
         Args:
-            layer_name (str): The name of the layer to be styled.
-            style_name (str): The name of the style to be applied to the layer.
+            output (str): The path of the file.
+            info (dict): The record of the file, as written by `record`.
+
+        Returns:
+            str: The SHA-256 hash of the file, or None if it no longer exists.
         """
-        if self.geoserver.get_style(name=style_name) is None:
-            print("Style does not exist, uploading new style")
-            self.upload_style(style_name)
+        try:
+            now = Path(output).stat()
+        except OSError:
+            return None
+        if now.st_size == info["size"] and now.st_mtime_ns == info.get("mtime"):
+            return info["sha256"]
+        return file_hash(output)
 
-        layer = self.geoserver.get_layer(layer_name)
-        style = f"<layer><defaultStyle><name>{style_name}</name></defaultStyle></layer>"
-        cmd = f'curl -u {self.USERNAME}:{self.PASSWORD} -XPUT -H "Content-type: text/xml" -d "{style}" {self.HOST}/layers/SNODAS:{layer.name}'
-        system(cmd)
+    def hash(self, output):
+        """
+        Returns the hash of an output file.
 
-    def upload_folder(self, workspace, folder_path):
+        Args:
+            output (str): The path of the file.
+
+        Returns:
+            str: The SHA-256 hash of the file (see `current`), the hash recorded when it was
+            written if it has since been removed, or None if no stage wrote it.
         """
-        Upload all GeoTIFF files from a specified folder to the GeoServer instance.
+        for record in self.load().values():
+            if output in record["outputs"]:
+                info = record["outputs"][output]
+                return self.current(output, info) or info["sha256"]
+        return None
+
+    def signature(self, source):
+        """
+        Identifies the content of a file a stage reads.
 
         Args:
-            workspace (str): The workspace in GeoServer where the data will be uploaded.
-            folder_path (str): The local path of the folder containing the GeoTIFF files.
+            source (str): The path of the file.
+
+        Returns:
+            str: Its hash, reusing the recorded one if a stage of this manifest wrote it and it is
+            unchanged since.
         """
-        for data in listdir(folder_path):
-            if data.endswith(".tif"):
-                data_path = join(folder_path, data)
-                name = (path.basename(data)).rsplit(".", 1)[0]
-                self.upload_data(name, workspace, data_path)
+        return self.hash(source) or file_hash(source)
 
-    def delete_data(self, data_name, workspace):
+    def invalidate(self, prefix=""):
         """
-        Delete geospatial data from the GeoServer instance.
+        Forgets stages so they are redone.
 
         Args:
-            data_name (str): The name of the data to be deleted.
-            workspace (str): The workspace in GeoServer where the data is located.
+            prefix (str, optional): Forgets the stages whose names start with it. Defaults to every stage.
 
         Returns:
-            A boolean indicating whether the deletion was successful.
+            list: The names of the stages forgotten.
         """
-        store = self.geoserver.get_store(name=data_name, workspace=workspace)
-        return self.geoserver.delete(store, purge=True, recurse=True)
+        with self.lock:
+            stages = self.load()
+            removed = [stage for stage in stages if stage.startswith(prefix)]
+            if removed:
+                for stage in removed:
+                    del stages[stage]
+                self.save(stages)
+        return removed
 
-    def upload_style(self, style):
+    def done(self, stage="complete"):
         """
-        Uploads a specified style to the GeoServer instance.
+        Checks whether the date has been fully processed and published.
 
-        This method checks if the specified style file exists in the styles folder
-        of the current directory object. If the style file is found, it reads the
-        file and creates a new style in the GeoServer instance with the content
-        of the file.
+        Args:
+            stage (str, optional): "complete" for a date that was published, or "converted" for a
+                date that was converted without publishing (see `backfill`). A complete date is
+                also converted.
+
+        Returns:
+            bool: True if `stage` or the "complete" stage is recorded.
+        """
+        stages = self.load()
+        return stage in stages or "complete" in stages
+
+    def validation(self, products):
+        """
+        Checks that the products of the date passed validation (see `GTIFF.validate`).
 
         Args:
-            style (str): The name of the style to be uploaded.
+            products (iterable): The products that must have passed validation.
 
-        Raises:
-            Exception: If the specified style file is not found in the styles folder.
+        Returns:
+            tuple: The products that failed validation, including products not in `products`, and
+            the products in `products` that were never validated.
         """
-        style_files = listdir(self.directory.styles)
-        available_styles = [
-            strip_extension(path.basename(file)) for file in style_files
-        ]
-        if style in available_styles:
-            style_file = join(self.directory.styles, f"{style}.sld")
-            with open(style_file) as file:
-                self.geoserver.create_style(
-                    strip_extension(path.basename(style)), file.read()
-                )
-        else:
-            raise Exception(f"Style {style} not found in styles folder.")
+        stages = self.load()
+        failed = sorted(
+            stage.split("/", 1)[1]
+            for stage, record in stages.items()
+            if stage.startswith("validate/") and record["status"] != "complete"
+        )
+        missing = sorted(product for product in products if f"validate/{product}" not in stages)
+        return failed, missing
+
+
+class file:
+    """
+    A class for downloading and processing SNODAS data.
+
+    This class handles the downloading, extraction, and processing of SNODAS data for a given date.
+    It creates the necessary directories, downloads the data, extracts the compressed files,
+    and prepares the data for further processing.
+
+    Attributes:
+        date (dataDate): A dataDate object containing the date information for the data download.
+        dir (directory): A directory object containing the paths for various directories used in the processing.
+        address (str): The URL address for downloading the SNODAS data.
+
+    Methods:
+        download(): Downloads the SNODAS data if it hasn't been downloaded already.
+        extractTAR(): Extracts the downloaded TAR file.
+        extractGZ(): Extracts all GZ files from the extracted TAR file.
+        streamTiffs(): Creates GeoTIFF files directly from the downloaded TAR file.
+    """
+    def __init__(self, date, directory, client=None):
+        """
+        Initializes the file object with the given date and directory information.
+
+        Args:
+            date (dataDate): A dataDate object containing the date information for the data download.
+            directory (directory): A directory object containing the paths for various directories used in the processing.
+            client (downloader, optional): The downloader to download the data with. Share one
+                downloader between file objects to reuse its connections. Defaults to a new downloader.
+        """
+        self.date = date
+        self.dir = directory
+        self.client = client if client is not None else downloader()
+        settings = self.dir.settings
+        policy = self.dir.setting("SNOSERVE_CACHE_POLICY", "lru")
+        self.tars = cache(
+            self.dir.tarCache,
+            max_bytes=env_number("SNOSERVE_TAR_CACHE_BYTES", settings=settings),
+            max_days=env_number("SNOSERVE_TAR_CACHE_DAYS", 30, settings),
+            policy=policy,
+        )
+        self.rasters = cache(
+            self.dir.dataCache,
+            max_bytes=env_number("SNOSERVE_DATA_CACHE_BYTES", settings=settings),
+            max_days=env_number("SNOSERVE_DATA_CACHE_DAYS", 30, settings),
+            policy=policy,
+        )
+        self.manifest = manifest(self.dir.manifest, self.dir.setting("SNOSERVE_FORCE", "0") == "1")
+        self.dir.create()
+        self.address = data_address(self.date, self.dir.settings)
+
+    @instrumented("download")
+    def download(self):
+        """
+        Downloads the SNODAS data if it hasn't been downloaded already.
+
+        This method checks if the SNODAS data file has already been completely downloaded.
+        If it hasn't, it downloads the data from the specified URL address with `self.client`,
+        resuming a partial download if there is one.
+        If the file already exists, it prints a message indicating that the file has been downloaded.
+        Either way the file is recorded as used in the TAR cache, and its hash is recorded in the
+        manifest when it is new.
+
+        Returns:
+            bool: True if new data was downloaded, False if the existing file was kept.
+        """
+        downloaded = self.client.fetch(self.address, self.dir.download)
+        self.tars.add(self.date.date_string, self.dir.download, self.date.date_string)
+        inputs = {"url": self.address}
+        if downloaded or not self.manifest.fresh("download", inputs):
+            self.manifest.record("download", inputs, [self.dir.download])
+        return downloaded
+
+    @instrumented("extractTAR")
+    def extractTAR(self):
+        """
+        Extracts the downloaded TAR file.
+
+        This method extracts the downloaded TAR file into the specified extraction directory.
+        The extracted files are used for further processing.
+
+        Returns:
+            str: The path to the directory where the TAR file was extracted.
+        """
+        unpack_archive(self.dir.download, self.dir.extract)
+        return self.dir.extract
+
+    @instrumented("extractGZ")
+    def extractGZ(self):
+        """
+        Extracts all GZ files from the extracted TAR file and removes the original GZ files.
+
+        This method iterates through all files in the directory where the TAR file was extracted
+        and checks for files with the '.gz' extension.
+        For each GZ file found, it extracts the contents and creates a new file without the '.gz' extension.
+        After extracting the contents, the original GZ file is removed.
+        The current working directory is left untouched, so several dates can be extracted at once.
+        """
+        extension = ".gz"
+        for item in listdir(self.dir.extract):
+            if item.endswith(extension):
+                nameGZ = join(self.dir.extract, item)
+                outputName = join(self.dir.extract, strip_extension(item))
+                with gunzip(nameGZ, "rb") as fileIn, open(outputName, "wb") as fileOut:
+                    copyfileobj(fileIn, fileOut)
+                remove(nameGZ)
 
-    def style_types(self, types_list):
+    def createTiffs(self, colorize=False, workers=None, executor="process"):
         """
-        Style all data stores in GeoServer that have a name matching the provided list of types.
+        Creates GeoTIFF files from the extracted .txt and .dat files.
 
         Args:
-            types_list (list): A list of data types (store names) to be styled.
+            colorize (bool, optional): If True, applies color relief to the generated GeoTIFF files using the corresponding color table files. Defaults to False.
+            workers (int, optional): The number of products to convert at once. See `convert()`.
+            executor (str, optional): "process" or "thread". See `convert()`.
+
+        This method iterates through the extracted files in the `self.dir.extract` directory.
+        For each file with a `.txt` extension, it creates a `GTIFF` object with the file name and
+        directory object. The GTIFF objects are then converted by `convert()`, which for each one:
+
+        1. Generates a `.hdr` file for the GeoTIFF using the `GTIFF.createHDR()` method.
+        2. Retrieves the output file name from the `self.dir.finalNames` dictionary based on the 'Description' metadata.
+        3. Processes the `.dat` file and generates a GeoTIFF file in the `self.dir.finalData` directory using the `GTIFF.process()` method.
+        4. If `colorize` is True, applies color relief to the generated GeoTIFF file using the `GTIFF.colorize()` method.
+
+        Returns:
+            list: The processed GTIFF objects.
         """
-        stores = self.geoserver.get_stores()
-        for store in stores:
-            data_type = store.name
-            if data_type in types_list:
-                self.style_data(store.name, data_type)
+        tiffs = []
+        for item in listdir(self.dir.extract):
+            if item.endswith(".txt"):
+                tiffs.append(GTIFF(strip_extension(item), self.dir))
+        return self.convert(tiffs, colorize, workers, executor)
 
-    def selective_upload(self, workspace, folder_path, selection):
+    def streamTiffs(self, colorize=False, workers=None, executor="process"):
         """
-        Upload selected GeoTIFF files from a specified folder to the GeoServer instance.
+        Creates GeoTIFF files directly from the downloaded TAR file without extracting it to disk.
 
         Args:
-            workspace (str): The workspace in GeoServer where the data will be uploaded.
-            folder_path (str): The local path of the folder containing the GeoTIFF files.
-            selection (list): A list of file names (without extensions) to be uploaded.
+            colorize (bool, optional): If True, applies color relief to the generated GeoTIFF files using the corresponding color table files. Defaults to False.
+            workers (int, optional): The number of products to convert at once. See `convert()`.
+            executor (str, optional): "process" or "thread". See `convert()`.
+
+        This method reads the TAR file one member at a time. Each gzipped `.txt` member is
+        decompressed in memory and parsed for its metadata. The matching `.dat.gz` member is
+        decompressed into memory once, only for the products that have to be converted, and
+        checked and converted from there (see `GTIFF.inflate`), so the only files written are the
+        products in the `self.dir.finalData` directory.
+
+        `extractTAR()`, `extractGZ()` and `createTiffs()` remain available as a fallback.
+
+        Returns:
+            list: The processed GTIFF objects.
         """
-        selection = [f"{file}.tif" for file in selection]
-        for file in listdir(folder_path):
-            if file in selection:
-                data_path = join(folder_path, file)
-                name = (path.basename(file)).rsplit(".", 1)[0]
-                self.upload_data(name, workspace, data_path)
-    
-    def check_workspace(self, workspace):
+        return self.convert(self.readTiffs(), colorize, workers, executor)
+
+    def readTiffs(self, stream=True):
         """
-        Check if a workspace exists in the GeoServer instance.
-        If the workspace does not exist, create it.
+        Creates a GTIFF object for each product in the downloaded TAR file, from its .txt member.
 
         Args:
-            workspace (str): The name of the workspace to check/create.
+            stream (bool, optional): If True, the .dat files are read from the TAR file (see
+                `GTIFF.inflate`), otherwise from the extract directory. Defaults to True.
 
         Returns:
-            None
+            list: The GTIFF objects, with their metadata.
         """
-        workspaces = self.geoserver.get_workspaces()
-        if workspace not in workspaces:
-            self.geoserver.create_workspace(workspace, workspace)
-        else:
-            print(f"Workspace '{workspace}' already exists.")
+        extension = ".txt.gz"
+        tiffs = []
+        with tarfile.open(self.dir.download) as archive:
+            for member in archive:
+                if member.name.endswith(extension):
+                    with archive.extractfile(member) as txt:
+                        lines = decompress(txt.read()).decode().splitlines()
+                    tiff = GTIFF(
+                        member.name[: -len(extension)],
+                        self.dir,
+                        metadata=parse_txt_vars(lines),
+                        archive=self.dir.download if stream else None,
+                    )
+                    tiffs.append(tiff)
+        return tiffs
 
+    def ingest(self, colorize=False, workers=None, executor="process"):
+        """
+        Creates GeoTIFF files from the downloaded TAR file.
 
-def read_txt_vars(txt):
-    """
-    Read key-value pairs from a text file and store them in a dictionary.
+        The TAR file is streamed with `streamTiffs()`, unless the SNOSERVE_INGEST environment
+        variable is set to "extract", in which case it is extracted with `extractTAR()` and
+        `extractGZ()` before the products are converted. It is only extracted if a product has to
+        be converted again (see `stale`) and the extracted files are not still there from an
+        earlier run. The arguments are passed on unchanged.
 
-    Args:
-        txt (str): Path to the text file.
+        Returns:
+            list: The processed GTIFF objects.
+        """
+        if self.dir.setting("SNOSERVE_INGEST", "stream") == "extract":
+            tiffs = self.readTiffs(stream=False)
+            inputs = {"source": self.manifest.hash(self.dir.download)}
+            if any(self.stale(tiff) for tiff in tiffs) and not self.manifest.fresh("extract", inputs):
+                self.extractTAR()
+                self.extractGZ()
+                extracted = [join(self.dir.extract, item) for item in listdir(self.dir.extract)]
+                self.manifest.record("extract", inputs, extracted)
+            return self.convert(tiffs, colorize, workers, executor)
+        return self.streamTiffs(colorize, workers, executor)
 
-    Returns:
-        dict: A dictionary containing the key-value pairs read from the file.
-    """
-    variables = {}
-    with open(txt) as varfile:
-        for var in varfile:
-            (key, val) = var.rstrip().split(": ")
-            variables[key] = val
-    return variables
+    def stale(self, tiff):
+        """
+        Checks whether a product has to be converted again, or was converted and validated by an
+        earlier run from the same TAR file with the same settings and its files are intact.
 
+        Args:
+            tiff (GTIFF): The GTIFF object of the product.
 
-def strip_extension(file):
-    """
-    Remove the first file extension from a file path or name.
+        Returns:
+            bool: True if the product has to be converted.
+        """
+        filename = self.dir.finalNames.get(tiff.metadata.get("Description"))
+        if filename is None:
+            return True
+        if not self.manifest.fresh(f"convert/{filename}", self.convertInputs(tiff, filename)):
+            return True
+        return not self.manifest.fresh(f"validate/{filename}", self.validateInputs(tiff))
 
-    Args:
-        file (str): The file path or name.
+    def convert(self, tiffs, colorize=False, workers=None, executor="process"):
+        """
+        Converts GTIFF objects to GeoTIFF files, several products at once.
 
-    Returns:
-        str: The file name without the first extension.
-    """
-    return (path.basename(file)).rsplit(".", 1)[0]
+        Each product is converted by `convert_tiff()` in its own worker. A product that fails is
+        reported and recorded in `self.errors` without stopping the rest of the batch.
 
+        Products converted by an earlier run from the same TAR file with the same settings, whose
+        files are intact, are not converted again (see `manifest`); they are only colorized if
+        their color table changed.
 
-def datetime_from_str(string):
-    """
-    Convert a string in the format 'YYYYMMDD' to a datetime object in the US/Eastern timezone.
+        Args:
+            tiffs (list): The GTIFF objects to convert.
+            colorize (bool, optional): If True, applies color relief to products that have a color table. Defaults to False.
+            workers (int, optional): The number of products to convert at once. Defaults to the
+                SNOSERVE_WORKERS environment variable, or the number of CPUs. 1 converts the
+                products one after another in this process.
+            executor (str, optional): "process" to convert in a process pool or "thread" to
+                convert in a thread pool. Defaults to "process".
 
-    Args:
-        string (str): A string representing a date in the format 'YYYYMMDD'.
+        Returns:
+            list: The GTIFF objects that were converted, with `fullPath` and `name` set.
+        """
+        filenames = self.dir.finalNames
+        if workers is None:
+            workers = int(self.dir.setting("SNOSERVE_WORKERS", cpu_count()))
+        self.errors = {}
+        results = []
+        jobs = []
+        for tiff in tiffs:
+            filename = tiff.member
+            try:
+                filename = filenames[tiff.metadata["Description"]]
+                inputs = self.convertInputs(tiff, filename)
+                reconvert = self.stale(tiff)
+                if not reconvert:
+                    tiff.restore(self.dir, filename, inputs["profile"], inputs["regions"], inputs["targets"])
+                recolor = colorize and isfile(join(self.dir.colortables, f"{filename}.txt"))
+                if recolor and not reconvert and self.manifest.fresh(f"colorize/{filename}", self.colorInputs(tiff)):
+                    tiff.colorPath = join(self.dir.finalData, f"{filename}_color.tif")
+                    recolor = False
+            except Exception as error:
+                print(f"Failed to convert {filename}: {error}")
+                self.errors[filename] = error
+                continue
+            if reconvert or recolor:
+                jobs.append((tiff, filename, recolor, reconvert))
+            else:
+                results.append(tiff)
+        reconverted = {filename for tiff, filename, recolor, reconvert in jobs if reconvert}
+        converted = []
+        if workers <= 1 or len(jobs) <= 1:
+            for tiff, filename, recolor, reconvert in jobs:
+                try:
+                    converted.append(convert_tiff(tiff, self.dir, filename, recolor, reconvert))
+                except Exception as error:
+                    print(f"Failed to convert {filename}: {error}")
+                    self.errors[filename] = error
+        else:
+            pool = processes.ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+            with pool(max_workers=min(workers, len(jobs))) as ex:
+                futures = [
+                    (filename, ex.submit(convert_tiff, tiff, self.dir, filename, recolor, reconvert))
+                    for tiff, filename, recolor, reconvert in jobs
+                ]
+                for filename, future in futures:
+                    try:
+                        converted.append(future.result())
+                        if executor == "process":
+                            instruments.add(converted[-1].measurements)
+                    except Exception as error:
+                        print(f"Failed to convert {filename}: {error}")
+                        self.errors[filename] = error
+        sources = {filename: tiff for tiff, filename, recolor, reconvert in jobs}
+        for filename, error in self.errors.items():
+            if isinstance(error, QualityError):
+                details = {"passed": False, "error": str(error), "statistics": error.statistics}
+                inputs = self.validateInputs(sources[filename])
+                self.manifest.record(f"validate/{filename}", inputs, status="failed", details=details)
+        for tiff in converted:
+            if tiff.name in reconverted:
+                details = {"passed": True, "statistics": tiff.stats}
+                self.manifest.record(f"validate/{tiff.name}", self.validateInputs(tiff), details=details)
+                inputs = self.convertInputs(tiff, tiff.name)
+                outputs = [tiff.fullPath] + list(tiff.regions.values()) + list(tiff.targets.values())
+                outputs += [tiff.rawPath] * (tiff.rawPath is not None)
+                outputs += [aux for aux in [f"{tiff.fullPath}.aux.xml"] if isfile(aux)]
+                self.manifest.record(f"convert/{tiff.name}", inputs, outputs)
+            if tiff.colorPath is not None:
+                self.manifest.record(f"colorize/{tiff.name}", self.colorInputs(tiff), [tiff.colorPath])
+        results += converted
+        for tiff in results:
+            self.rasters.add(f"{self.date.date_string}/{tiff.name}", tiff.fullPath, self.date.date_string)
+            if tiff.rawPath is not None:
+                self.rasters.add(f"{self.date.date_string}/{tiff.name}.dat", tiff.rawPath, self.date.date_string)
+            if tiff.colorPath is not None:
+                key = f"{self.date.date_string}/{strip_extension(tiff.colorPath)}"
+                self.rasters.add(key, tiff.colorPath, self.date.date_string)
+            for copy in list(tiff.regions.values()) + list(tiff.targets.values()):
+                key = f"{self.date.date_string}/{strip_extension(copy)}"
+                self.rasters.add(key, copy, self.date.date_string)
+        self.history(results)
+        return results
 
-    Returns:
-        datetime.datetime: A datetime object representing the input date in the US/Eastern timezone.
-    """
-    tz = timezone("US/Eastern")
-    date = datetime.strptime(string, "%Y%m%d").replace(tzinfo=tz)
-    return date
+    def convertInputs(self, tiff, filename):
+        """
+        Returns what the conversion of a product depends on, for the manifest.
 
+        Args:
+            tiff (GTIFF): The GTIFF object of the product.
+            filename (str): The output file name of the product.
 
-def main():
-    date = dataDate()
-    dir = directory(date)
-    current_data = file(date, dir)
-    current_data.download()
-    current_data.extractTAR()
-    current_data.extractGZ()
-    current_data.createTiffs()
-    current_data.cleantemp()
-    verty = server(dir)
-    verty.selective_upload("SNODAS", current_data.dir.finalData, ["snowdepth", "swe"])
-    verty.style_types(["snowdepth", "swe"])
+        Returns:
+            dict: The hash of the TAR file, the product's file in it, its output profile, regions
+            and targets.
+        """
+        return {
+            "source": self.manifest.hash(self.dir.download),
+            "member": tiff.member,
+            "profile": self.dir.outputProfile(filename),
+            "regions": self.dir.regions,
+            "targets": self.dir.targets,
+        }
+
+    def validateInputs(self, tiff):
+        """
+        Returns what the validation of a product depends on, for the manifest.
+
+        Args:
+            tiff (GTIFF): The GTIFF object of the product.
+
+        Returns:
+            dict: The hash of the TAR file and the product's file in it.
+        """
+        return {"source": self.manifest.hash(self.dir.download), "member": tiff.member}
+
+    def colorInputs(self, tiff):
+        """
+        Returns what the colorized GeoTIFF of a converted product depends on, for the manifest.
+
+        Args:
+            tiff (GTIFF): The converted GTIFF object of the product.
+
+        Returns:
+            dict: The hashes of the product's GeoTIFF file and color table, and the color mode.
+        """
+        return {
+            "source": self.manifest.signature(tiff.fullPath),
+            "colortable": file_hash(join(self.dir.colortables, f"{tiff.name}.txt")),
+            "mode": self.dir.setting("SNOSERVE_COLOR_MODE", "palette"),
+        }
+
+    def history(self, tiffs):
+        """
+        Appends this date's products to their time-series cubes in the cube folder.
+
+        The products with a cube are set with the SNOSERVE_CUBE environment variable, separated by
+        commas. Defaults to "snowdepth,swe". A product that fails is reported and recorded in
+        `self.errors` as "cube/<product>".
+
+        Args:
+            tiffs (list): The converted GTIFF objects.
+        """
+        products = [product for product in self.dir.setting("SNOSERVE_CUBE", "snowdepth,swe").split(",") if product]
+        for tiff in tiffs:
+            if tiff.name in products:
+                inputs = {"source": self.manifest.signature(tiff.fullPath)}
+                if self.manifest.fresh(f"cube/{tiff.name}", inputs):
+                    continue
+                try:
+                    cube(join(self.dir.cubes, tiff.name)).append(self.date.date_string, tiff)
+                    self.manifest.record(f"cube/{tiff.name}", inputs)
+                except Exception as error:
+                    print(f"Failed to add {tiff.name} to its cube: {error}")
+                    self.errors[f"cube/{tiff.name}"] = error
+
+    @instrumented("derive")
+    def derive(self, tiffs):
+        """
+        Computes the derived products defined in derived.txt from this date's converted products.
+
+        Nothing is computed if the products were computed by an earlier run from grids with the same content.
+
+        Args:
+            tiffs (list): The converted GTIFF objects, as returned by `ingest()`.
+
+        Returns:
+            list: The paths of the derived products written.
+        """
+        engine = derivedProducts(self.dir)
+        (sources, products) = engine.plan(tiffs)
+        inputs = {
+            "definitions": products,
+            "sources": {f"{product}-{offset}": self.manifest.signature(source) for (product, offset), source in sources.items()},
+        }
+        outputs = [join(self.dir.finalData, f"{name}.tif") for name in products]
+        if self.manifest.fresh("derive", inputs):
+            return outputs
+        with gdal_options(self.dir.gdalConfig):
+            paths = engine.run(tiffs)
+        self.manifest.record("derive", inputs, paths)
+        for derived in paths:
+            self.rasters.add(f"{self.date.date_string}/{strip_extension(derived)}", derived, self.date.date_string)
+        return paths
+
+    def colorize(self, tiff):  # colors GTIFF if 'name'.txt is provided in colortables
+        if tiff.name in [
+            strip_extension(file) for file in listdir(self.dir.colortables)
+        ]:
+            tiff.colorize(self.dir)
+
+    def cleantemp(self):  # removes extracted files
+        # leaves .tar file to prevent DDOSing NOAA, clean_old_tar removes it once it is old
+        rmtree(self.dir.extract)
+
+    def clean_old_tar(self, keep=()):
+        """
+        Removes downloaded TAR files that are over the budgets of the TAR cache.
+
+        The TAR file of this object's date is always kept.
+
+        Args:
+            keep (iterable, optional): Other dates in YYYYMMDD format whose TAR files must be kept.
+
+        Returns:
+            dict: The cache entries that were removed.
+        """
+        removed = self.tars.evict(keep=[self.date.date_string, *keep])
+        for entry in removed.values():
+            Path(f"{entry['path']}.json").unlink(missing_ok=True)
+        return removed
+
+    def clean_old_data(self, keep=()):
+        """
+        Removes processed rasters that are over the budgets of the data cache.
+
+        The rasters of this object's date are always kept. A date that loses any of its rasters is
+        no longer marked complete, so a backfill will process it again.
+
+        Args:
+            keep (iterable, optional): Other dates in YYYYMMDD format whose rasters must be kept,
+                e.g. dates converted by a backfill that are not published yet.
+
+        Returns:
+            dict: The cache entries that were removed.
+        """
+        removed = self.rasters.evict(keep=[self.date.date_string, *keep])
+        for entry in removed.values():
+            Path(f"{entry['path']}.aux.xml").unlink(missing_ok=True)
+            evicted = manifest(self.dir.forDate(dataDate(entry["date"])).manifest)
+            evicted.invalidate("complete")
+            evicted.invalidate("converted")
+        return removed
+
+
+class GTIFF:  # processes individual geotiff files
+    def __init__(self, filename, directory, metadata=None, archive=None):
+        """
+        Initializes the GTIFF class for processing individual GeoTIFF files.
+
+        Args:
+            filename (str): The base filename of the GeoTIFF files (without extensions).
+            directory (object): A directory object containing the necessary paths.
+            metadata (dict, optional): Metadata already parsed from the .txt file. If not provided,
+                it is read from the extracted .txt file.
+            archive (str, optional): The path of the TAR file containing `filename`.dat.gz. If provided,
+                the .dat file is decompressed from it into memory when it is first read (see
+                `inflate`) instead of being extracted to disk.
+
+        Attributes:
+            txt (str): The file path for the associated .txt file.
+            dat (str): The file path for the associated .dat file, in GDAL's /vsimem/ filesystem
+                when it is streamed from an archive.
+            hdr (str): The file path for the associated .hdr file.
+            metadata (dict): A dictionary containing the metadata read from the .txt file.
+            archive (str): The path of the TAR file the .dat file is streamed from, or None.
+            member (str): The name of the gzipped .dat file in the TAR file.
+            buffer (bytes): The decompressed .dat file streamed from the archive, once `inflate`
+                has run and until `release` runs.
+            mounted (bool): Whether `buffer` is also in /vsimem/ for GDAL (see `source`).
+            colorPath (str): The file path of the colorized GeoTIFF file, once `colorize` has run.
+            regions (dict): The file paths of the clipped GeoTIFF files by region, once `clip` has run.
+            rawPath (str): The file path of the .dat file kept for a VRT product, once `reference` has run.
+            targets (dict): The file paths of the warped GeoTIFF files by target, once `warp` has run.
+            stats (dict): The statistics of the grid, once `statistics` has run.
+            settings (dict): The settings of the directory object (see `directory.setting`).
+        """
+        self.txt = join(directory.extract, f"{filename}.txt")  # set .txt file path
+        self.dat = join(directory.extract, f"{filename}.dat")  # set .dat file path
+        self.hdr = join(directory.extract, f"{filename}.hdr")
+        self.member = f"{filename}.dat.gz"
+        self.archive = archive
+        self.colorPath = None
+        self.rawPath = None
+        self.regions = {}
+        self.targets = {}
+        self.stats = None
+        self.settings = directory.settings
+        self.buffer = None
+        self.mounted = False
+        if archive is not None:
+            self.dat = f"/vsimem/{directory.name}/{filename}.dat"
+        if metadata is None:
+            metadata = read_txt_vars(self.txt)
+        self.metadata = metadata
+
+    def stringHDR(self):
+        """
+        Generates the text content for the ENVI header file (.hdr) based on the metadata.
+
+        Returns:
+            str: The text content for the ENVI header file.
+        """
+        samples = self.metadata["Number of columns"]
+        lines = self.metadata["Number of rows"]
+        self.envi = [
+            "ENVI",
+            f"samples = {samples}",
+            f"lines = {lines}",
+            "bands = 1",
+            "header offset = 0",
+            "file type = ENVI Standard",
+            "data type = 2",
+            "interleave = bsq",
+            "byte order = 1",
+        ]
+        self.envi = "\n".join(self.envi)
+        return self.envi
+
+    def stringVRT(self, dat=None):
+        """
+        Generates a GDAL VRT describing the raw .dat file, equivalent to the ENVI header.
+
+        The VRT can be opened by GDAL directly from its XML text, so no header file has to be
+        written next to the .dat file. This is what allows the .dat file to be read in place
+        from inside the TAR file. When the metadata has the extent of the grid, the VRT is
+        georeferenced in WGS84 with its nodata value, so it can also be saved as a product.
+
+        Args:
+            dat (str, optional): The file name of the .dat file relative to the VRT file. Defaults
+                to the absolute path `self.dat`.
+
+        Returns:
+            str: The XML content of the VRT.
+        """
+        samples = int(self.metadata["Number of columns"])
+        lines = int(self.metadata["Number of rows"])
+        source = f'<SourceFilename relativeToVRT="0">{escape(self.dat)}</SourceFilename>'
+        if dat is not None:
+            source = f'<SourceFilename relativeToVRT="1">{escape(dat)}</SourceFilename>'
+        self.vrt = [f'<VRTDataset rasterXSize="{samples}" rasterYSize="{lines}">']
+        if "Minimum x-axis coordinate" in self.metadata:
+            minX = float(self.metadata["Minimum x-axis coordinate"])
+            maxY = float(self.metadata["Maximum y-axis coordinate"])
+            width = (float(self.metadata["Maximum x-axis coordinate"]) - minX) / samples
+            height = (maxY - float(self.metadata["Minimum y-axis coordinate"])) / lines
+            self.vrt += [
+                '  <SRS dataAxisToSRSAxisMapping="2,1">EPSG:4326</SRS>',
+                f"  <GeoTransform>{minX!r}, {width!r}, 0.0, {maxY!r}, 0.0, {-height!r}</GeoTransform>",
+            ]
+        self.vrt += ['  <VRTRasterBand dataType="Int16" band="1" subClass="VRTRawRasterBand">']
+        if "No data value" in self.metadata:
+            self.vrt += [f"    <NoDataValue>{float(self.metadata['No data value'])!r}</NoDataValue>"]
+        if dat is not None and self.stats is not None:
+            self.vrt += [self.stringPAM("    ")]
+        self.vrt += [
+            f"    {source}",
+            "    <ImageOffset>0</ImageOffset>",
+            "    <PixelOffset>2</PixelOffset>",
+            f"    <LineOffset>{2 * samples}</LineOffset>",
+            "    <ByteOrder>MSB</ByteOrder>",
+            "  </VRTRasterBand>",
+            "</VRTDataset>",
+        ]
+        self.vrt = "\n".join(self.vrt)
+        return self.vrt
+
+    def source(self):
+        """
+        Returns what GDAL should open to read the .dat file.
+
+        Returns:
+            str: The VRT file of a VRT product, the VRT XML over the .dat file in /vsimem/ when it
+            is streamed from an archive (see `inflate`), otherwise the path of the extracted .dat
+            file (read through its .hdr file).
+        """
+        if self.rawPath is not None:
+            return self.fullPath
+        if self.archive is not None:
+            if not self.mounted:
+                gdal.FileFromMemBuffer(self.dat, self.inflate())
+                self.mounted = True
+            return self.stringVRT()
+        return self.dat
+
+    def inflate(self):
+        """
+        Decompresses the .dat file streamed from the TAR file into memory, once.
+
+        The same bytes are checked by `statistics`, read by GDAL from /vsimem/ (see `source`) and
+        written out by `reference` for a VRT product, so nothing but the products is written to
+        disk. `release` frees them.
+
+        Returns:
+            bytes: The decompressed .dat file.
+
+        Raises:
+            QualityError: If the .dat file in the TAR file is truncated.
+        """
+        if self.buffer is None:
+            with tarfile.open(self.archive) as archive, archive.extractfile(self.member) as zipped:
+                with gunzip(zipped) as grid:
+                    try:
+                        self.buffer = grid.read()
+                    except EOFError as error:
+                        raise QualityError(f"{self.member} is truncated: {error}") from error
+        return self.buffer
+
+    def release(self):
+        """
+        Frees the .dat file decompressed by `inflate`, and its copy in /vsimem/.
+        """
+        if self.mounted:
+            gdal.Unlink(self.dat)
+            self.mounted = False
+        self.buffer = None
+
+    def blocks(self, block_rows=512):
+        """
+        Reads the .dat file in blocks of rows, checking that it holds the whole grid.
+
+        An extracted or kept .dat file is memory-mapped, so only the rows of the current block are
+        read. A .dat file in a TAR file is decompressed into memory first (see `inflate`).
+
+        Args:
+            block_rows (int, optional): The number of rows per block. Defaults to 512.
+
+        Yields:
+            numpy.ndarray: The next rows of the grid, as big-endian int16.
+
+        Raises:
+            QualityError: If the .dat file is shorter or longer than the grid in the .txt metadata.
+        """
+        columns = int(self.metadata["Number of columns"])
+        rows = int(self.metadata["Number of rows"])
+        expected = 2 * rows * columns
+        if self.rawPath is None and self.archive is not None:
+            size = len(self.inflate())
+            if size != expected:
+                raise QualityError(f"{self.member} has {size} bytes, the grid needs {expected}.")
+            grid = np.frombuffer(self.buffer, dtype=">i2").reshape(rows, columns)
+        else:
+            raw = self.rawPath if self.rawPath is not None else self.dat
+            if getsize(raw) != expected:
+                raise QualityError(f"{raw} has {getsize(raw)} bytes, the grid needs {expected}.")
+            grid = np.memmap(raw, dtype=">i2", mode="r", shape=(rows, columns))
+        for row in range(0, rows, block_rows):
+            yield grid[row : row + block_rows]
+
+    @instrumented("validate", lambda self, *args, **kwargs: {"product": getattr(self, "name", None)})
+    def statistics(self, buckets=256):
+        """
+        Computes the statistics of the grid in one pass over the .dat file.
+
+        Every value is counted with `numpy.bincount` over the 65536 possible int16 values, so the
+        minimum, maximum, mean, standard deviation and histogram all come from the same counts.
+
+        Args:
+            buckets (int, optional): The number of buckets of the histogram. Defaults to 256.
+
+        Returns:
+            dict: The `minimum`, `maximum`, `mean` and `stddev` of the values with data (None if
+            there are none), the `nodata` fraction of the grid, and the `histogram` as its
+            `min` and `max` edges and `counts`.
+
+        Raises:
+            QualityError: If the .dat file does not hold the whole grid.
+        """
+        counts = np.zeros(65536, dtype=np.int64)
+        for block in self.blocks():
+            counts += np.bincount(block.ravel().astype(np.int32) + 32768, minlength=65536)
+        total = int(counts.sum())
+        noData = float(self.metadata["No data value"])
+        missing = 0
+        if noData.is_integer() and -32768 <= noData <= 32767:
+            missing = int(counts[int(noData) + 32768])
+            counts[int(noData) + 32768] = 0
+        self.stats = {"minimum": None, "maximum": None, "mean": None, "stddev": None, "nodata": missing / total}
+        self.stats["histogram"] = {"min": 0.0, "max": 0.0, "counts": []}
+        present = np.flatnonzero(counts)
+        if len(present):
+            values = present - 32768.0
+            weights = counts[present]
+            mean = float(np.dot(values, weights) / weights.sum())
+            minimum, maximum = float(values[0]), float(values[-1])
+            # Integer values are counted in buckets from half a unit below the minimum to half above the maximum
+            width = (maximum - minimum + 1) / buckets
+            histogram = np.bincount(((values - minimum) / width).astype(np.int64), weights=weights, minlength=buckets)
+            self.stats.update(
+                minimum=minimum,
+                maximum=maximum,
+                mean=mean,
+                stddev=float(np.sqrt(np.dot((values - mean) ** 2, weights) / weights.sum())),
+                histogram={"min": minimum - 0.5, "max": maximum + 0.5, "counts": histogram[:buckets].astype(np.int64).tolist()},
+            )
+        return self.stats
+
+    def validate(self):
+        """
+        Checks the grid before it is converted, so a bad day is never published.
+
+        The grid must be complete (see `blocks`), have data, and have no more than
+        SNOSERVE_QA_MAX_NODATA (0.95 by default) of its pixels without data. Setting SNOSERVE_QA
+        to 0 still computes the statistics but does not block anything.
+
+        Returns:
+            dict: The statistics of the grid (see `statistics`).
+
+        Raises:
+            QualityError: If a check fails.
+        """
+        enforce = setting("SNOSERVE_QA", "1", self.settings) != "0"
+        try:
+            stats = self.statistics()
+        except QualityError:
+            if not enforce:
+                return None
+            raise
+        if not enforce:
+            return stats
+        limit = float(setting("SNOSERVE_QA_MAX_NODATA", 0.95, self.settings))
+        if stats["minimum"] is None:
+            raise QualityError(f"{self.name} has no data.", stats)
+        if stats["nodata"] > limit:
+            raise QualityError(f"{self.name} has no data in {stats['nodata']:.1%} of the grid, over {limit:.1%}.", stats)
+        return stats
+
+    def stringPAM(self, indent=""):
+        """
+        Generates the GDAL statistics and histogram elements of a raster band from `stats`.
+
+        GDAL and GeoServer read them instead of computing the statistics and histogram themselves
+        the first time the raster is used.
+
+        Args:
+            indent (str, optional): The indentation of the elements.
+
+        Returns:
+            str: The <Metadata> and <Histograms> elements, which fit in a <PAMRasterBand> of a
+            .aux.xml file or in a <VRTRasterBand>.
+        """
+        stats = self.stats
+        if stats["minimum"] is None:
+            return f'{indent}<Metadata>\n{indent}  <MDI key="STATISTICS_VALID_PERCENT">0</MDI>\n{indent}</Metadata>'
+        metadata = {
+            "STATISTICS_MINIMUM": stats["minimum"],
+            "STATISTICS_MAXIMUM": stats["maximum"],
+            "STATISTICS_MEAN": stats["mean"],
+            "STATISTICS_STDDEV": stats["stddev"],
+            "STATISTICS_VALID_PERCENT": 100 * (1 - stats["nodata"]),
+        }
+        histogram = stats["histogram"]
+        lines = [f"{indent}<Histograms>", f"{indent}  <HistItem>"]
+        lines += [
+            f"{indent}    <HistMin>{histogram['min']!r}</HistMin>",
+            f"{indent}    <HistMax>{histogram['max']!r}</HistMax>",
+            f"{indent}    <BucketCount>{len(histogram['counts'])}</BucketCount>",
+            f"{indent}    <IncludeOutOfRange>0</IncludeOutOfRange>",
+            f"{indent}    <Approximate>0</Approximate>",
+            f"{indent}    <HistCounts>{'|'.join(str(count) for count in histogram['counts'])}</HistCounts>",
+        ]
+        lines += [f"{indent}  </HistItem>", f"{indent}</Histograms>", f"{indent}<Metadata>"]
+        lines += [f'{indent}  <MDI key="{key}">{value!r}</MDI>' for key, value in metadata.items()]
+        lines += [f"{indent}</Metadata>"]
+        return "\n".join(lines)
+
+    def createAUX(self):
+        """
+        Writes `stats` to a GDAL .aux.xml file next to the converted GeoTIFF file.
+
+        A VRT product holds its statistics in the VRT file itself (see `stringVRT`).
+
+        Returns:
+            str: The file path of the .aux.xml file, or None if there is nothing to write.
+        """
+        if self.stats is None or self.rawPath is not None:
+            return None
+        dest = f"{self.fullPath}.aux.xml"
+        with atomic(dest) as part:
+            with open(part, "w") as out:
+                out.write(f'<PAMDataset>\n  <PAMRasterBand band="1">\n{self.stringPAM("    ")}\n  </PAMRasterBand>\n</PAMDataset>\n')
+        return dest
+
+    def createHDR(self):
+        """
+        Creates the ENVI header file (.hdr) with the content generated from the stringHDR method.
+
+        Returns:
+            str: The file path of the created .hdr file.
+        """
+        self.stringHDR()
+        with open(self.hdr, "w") as hdr:
+            hdr.write(self.envi)
+        return self.hdr
+
+    @instrumented("process", lambda self, dir, filename, profile=None: {"product": filename})
+    def process(self, dir, filename, profile=None):
+        """
+        Processes the .dat file and generates a GeoTIFF file with the specified filename.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            filename (str): The desired filename for the output GeoTIFF file.
+            profile (str, optional): The name of the output profile in `OUTPUT_PROFILES` to write
+                the GeoTIFF with. Defaults to the profile configured for `filename` in profiles.txt.
+        """
+        if profile is None:
+            profile = dir.outputProfile(filename)
+        self.name = filename
+        self.profile = profile
+        if OUTPUT_PROFILES[profile]["format"] == "VRT":
+            self.reference(dir, filename)
+            return
+        minX = float(self.metadata["Minimum x-axis coordinate"])
+        minY = float(self.metadata["Minimum y-axis coordinate"])
+        maxX = float(self.metadata["Maximum x-axis coordinate"])
+        maxY = float(self.metadata["Maximum y-axis coordinate"])
+        a_ullr = [minX, maxY, maxX, minY]
+        noData = float(self.metadata["No data value"])
+        options = gdal.TranslateOptions(
+            format=OUTPUT_PROFILES[profile]["format"],
+            creationOptions=OUTPUT_PROFILES[profile]["creationOptions"],
+            outputSRS="epsg:4326",
+            noData=noData,
+            outputBounds=a_ullr,
+            metadataOptions=self.metadata,
+        )
+        dest = join(dir.finalData, f"{filename}.tif")
+        with atomic(dest) as part:
+            if gdal.Translate(part, self.source(), options=options) is None:
+                raise RuntimeError(f"GDAL could not create {dest}")
+        self.fullPath = dest
+
+    def reference(self, dir, filename):
+        """
+        Makes the product available as a VRT over its raw grid instead of converting it.
+
+        The .dat file is kept in the data folder as `<filename>.dat`: an extracted file is moved
+        there, and a file streamed from the TAR file is written there from memory (see `inflate`).
+        `<filename>.vrt` next to it describes it with `stringVRT`, so GDAL reads the product with
+        no conversion.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            filename (str): The output file name of the product.
+
+        Returns:
+            str: The file path of the VRT file.
+        """
+        raw = join(dir.finalData, f"{filename}.dat")
+        with atomic(raw) as part:
+            if self.archive is None:
+                try:
+                    replace(self.dat, part)
+                except OSError:
+                    copyfile(self.dat, part)
+                self.dat = raw
+            else:
+                Path(part).write_bytes(self.inflate())
+        dest = join(dir.finalData, f"{filename}.vrt")
+        with atomic(dest) as part:
+            with open(part, "w") as out:
+                out.write(self.stringVRT(f"{filename}.dat"))
+        self.rawPath = raw
+        self.fullPath = dest
+        return dest
+
+    def restore(self, dir, filename, profile, regions=(), targets=()):
+        """
+        Sets the attributes `process`, `clip` and `warp` set, for a product converted by an earlier run.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            filename (str): The output file name of the product.
+            profile (str): The output profile the product was written with.
+            regions (iterable, optional): The names of the regions the product was clipped to.
+            targets (iterable, optional): The names of the targets the product was warped to.
+        """
+        self.fullPath = join(dir.finalData, f"{filename}.tif")
+        if OUTPUT_PROFILES[profile]["format"] == "VRT":
+            self.rawPath = join(dir.finalData, f"{filename}.dat")
+            self.fullPath = join(dir.finalData, f"{filename}.vrt")
+        self.name = filename
+        self.profile = profile
+        self.regions = {region: join(dir.finalData, f"{filename}_{region}.tif") for region in regions}
+        self.targets = {target: join(dir.finalData, f"{filename}_{target}.tif") for target in targets}
+
+    def window(self, bounds):
+        """
+        Finds the pixels of the grid covering a longitude and latitude box.
+
+        The box is widened to whole pixels and cut to the extent of the grid.
+
+        Args:
+            bounds (list): The box as [west, south, east, north] in degrees.
+
+        Returns:
+            tuple: The window as [column, row, columns, rows] and its extent as
+            [minX, maxY, maxX, minY], ready for the `srcWin` and `outputBounds` Translate options.
+
+        Raises:
+            ValueError: If the box does not overlap the grid.
+        """
+        columns = int(self.metadata["Number of columns"])
+        rows = int(self.metadata["Number of rows"])
+        minX = float(self.metadata["Minimum x-axis coordinate"])
+        minY = float(self.metadata["Minimum y-axis coordinate"])
+        maxX = float(self.metadata["Maximum x-axis coordinate"])
+        maxY = float(self.metadata["Maximum y-axis coordinate"])
+        width = (maxX - minX) / columns
+        height = (maxY - minY) / rows
+        (west, south, east, north) = bounds
+        # The tolerance keeps edges that fall on a pixel boundary from taking in the next pixel
+        left = max(0, math.floor((west - minX) / width + 1e-6))
+        right = min(columns, math.ceil((east - minX) / width - 1e-6))
+        top = max(0, math.floor((maxY - north) / height + 1e-6))
+        bottom = min(rows, math.ceil((maxY - south) / height - 1e-6))
+        if right <= left or bottom <= top:
+            raise ValueError(f"{bounds} does not overlap the grid.")
+        extent = [minX + left * width, maxY - top * height, minX + right * width, maxY - bottom * height]
+        return [left, top, right - left, bottom - top], extent
+
+    def clip(self, dir, filename, region, definition, profile=None):
+        """
+        Writes the part of the .dat file covering a region to `<filename>_<region>.tif`.
+
+        Only the rows and columns of the region's window are read from the .dat file, so the full
+        grid is never converted for it. When the region is a polygon, the pixels outside of it are
+        then set to the no data value.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            filename (str): The output file name of the product (e.g., swe).
+            region (str): The name of the region.
+            definition (dict): The region, as read by `parse_regions`.
+            profile (str, optional): The name of the output profile in `OUTPUT_PROFILES`. Defaults
+                to the profile configured for `<filename>_<region>` in profiles.txt, or else for
+                `filename`. The vrt profile writes a plain GeoTIFF.
+
+        Returns:
+            str: The file path of the clipped GeoTIFF file.
+        """
+        name = f"{filename}_{region}"
+        if profile is None:
+            profile = dir.outputProfile(name if name in dir.outputProfiles else filename)
+        if OUTPUT_PROFILES[profile]["format"] == "VRT":
+            profile = "gtiff"  # the clipped copy of a VRT product is still a GeoTIFF
+        (window, extent) = self.window(definition["bounds"])
+        noData = float(self.metadata["No data value"])
+        dest = join(dir.finalData, f"{name}.tif")
+        cutline = definition.get("cutline")
+        options = gdal.TranslateOptions(
+            format="GTiff" if cutline else OUTPUT_PROFILES[profile]["format"],
+            creationOptions=[] if cutline else OUTPUT_PROFILES[profile]["creationOptions"],
+            outputSRS="epsg:4326",
+            noData=noData,
+            srcWin=window,
+            outputBounds=extent,
+            metadataOptions=self.metadata,
+        )
+        with atomic(dest) as part:
+            target = f"/vsimem/{name}.tif" if cutline else part
+            if gdal.Translate(target, self.source(), options=options) is None:
+                raise RuntimeError(f"GDAL could not create {target}")
+            if cutline:
+                options = gdal.WarpOptions(
+                    format=OUTPUT_PROFILES[profile]["format"],
+                    creationOptions=OUTPUT_PROFILES[profile]["creationOptions"],
+                    cutlineDSName=cutline,
+                    dstNodata=noData,
+                )
+                try:
+                    if gdal.Warp(part, target, options=options) is None:
+                        raise RuntimeError(f"GDAL could not create {dest}")
+                finally:
+                    gdal.Unlink(target)
+        self.regions[region] = dest
+        return dest
+
+    @instrumented("warp", lambda self, dir, filename, target, *args, **kwargs: {"product": filename, "target": target})
+    def warp(self, dir, filename, target, definition, profile=None):
+        """
+        Writes the product reprojected to a target's coordinate system to `<filename>_<target>.tif`.
+
+        The converted product (see `process`) is warped once here, so GeoServer serves the target
+        in its native coordinate system instead of reprojecting the grid for every request.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            filename (str): The output file name of the product (e.g., swe).
+            target (str): The name of the target.
+            definition (dict): The target, as read by `parse_targets`.
+            profile (str, optional): The name of the output profile in `OUTPUT_PROFILES`. Defaults
+                to the profile configured for `<filename>_<target>` in profiles.txt, or else for
+                `filename`. The vrt profile writes a plain GeoTIFF.
+
+        Returns:
+            str: The file path of the warped GeoTIFF file.
+        """
+        name = f"{filename}_{target}"
+        if profile is None:
+            profile = dir.outputProfile(name if name in dir.outputProfiles else filename)
+        if OUTPUT_PROFILES[profile]["format"] == "VRT":
+            profile = "gtiff"
+        dest = join(dir.finalData, f"{name}.tif")
+        options = gdal.WarpOptions(
+            format=OUTPUT_PROFILES[profile]["format"],
+            creationOptions=OUTPUT_PROFILES[profile]["creationOptions"],
+            dstSRS=definition["srs"],
+            resampleAlg=definition["resampling"],
+            dstNodata=float(self.metadata["No data value"]),
+            multithread=True,
+        )
+        with atomic(dest) as part:
+            if gdal.Warp(part, self.fullPath, options=options) is None:
+                raise RuntimeError(f"GDAL could not create {dest}")
+        self.targets[target] = dest
+        return dest
+
+    @instrumented("colorize", lambda self, *args, **kwargs: {"product": self.name})
+    def colorize(self, dir, colortxt=None, output_file=None, mode=None):
+        """
+        Applies color relief to the GeoTIFF file using a color table file.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+            colortxt (str, optional): The file path of the color table file. If not provided,
+                the default file path is constructed based on the GTIFF name.
+            output_file (str, optional): The file path for the output GeoTIFF file with color relief.
+                If not provided, `<name>_color.tif` is written next to the GeoTIFF file, which is
+                left intact.
+            mode (str, optional): "palette" writes one 8-bit band with an embedded color table,
+                "rgba" writes four 8-bit bands. Defaults to the SNOSERVE_COLOR_MODE setting, or "palette".
+
+        The color table is turned into a lookup table once by `palette`, which is then applied to
+        the GeoTIFF file block by block, in this process.
+
+        Returns:
+            str: The file path of the output GeoTIFF file.
+        """
+        if mode is None:
+            mode = dir.setting("SNOSERVE_COLOR_MODE", "palette")
+        if mode not in ("palette", "rgba"):
+            raise ValueError(f"Color mode {mode} is not one of ['palette', 'rgba'].")
+        if output_file is None:
+            output_file = join(dir.finalData, f"{self.name}_color.tif")
+        if colortxt is None:
+            colortxt = join(dir.colortables, f"{self.name}.txt")
+        colors = palette(colortxt, float(self.metadata["No data value"]))
+        source = gdal.Open(self.fullPath)
+        band = source.GetRasterBand(1)
+        columns, rows = source.RasterXSize, source.RasterYSize
+        options = ["TILED=YES", "COMPRESS=DEFLATE"]
+        if mode == "rgba":
+            options += ["PHOTOMETRIC=RGB", "ALPHA=YES"]
+        with atomic(output_file) as part:
+            output = gdal.GetDriverByName("GTiff").Create(
+                part, columns, rows, 4 if mode == "rgba" else 1, gdal.GDT_Byte, options=options
+            )
+            output.SetGeoTransform(source.GetGeoTransform())
+            output.SetProjection(source.GetProjection())
+            if mode == "palette":
+                table = gdal.ColorTable()
+                for index, color in enumerate(colors.colors):
+                    table.SetColorEntry(index, tuple(int(channel) for channel in color))
+                output.GetRasterBand(1).SetRasterColorTable(table)
+                output.GetRasterBand(1).SetNoDataValue(0)
+            for row in range(0, rows, 512):
+                count = min(512, rows - row)
+                block = band.ReadAsArray(0, row, columns, count)
+                if mode == "rgba":
+                    pixels = colors.rgba(block)
+                    for channel in range(4):
+                        output.GetRasterBand(channel + 1).WriteArray(pixels[..., channel], 0, row)
+                else:
+                    output.GetRasterBand(1).WriteArray(colors.indices(block), 0, row)
+            output.FlushCache()
+            output = source = None
+        self.colorPath = output_file
+        return output_file
+
+    def convertToInches(self, dir):
+        """
+        Converts the GeoTIFF file to inches, writing `<name>_in.tif` next to it.
+
+        The raw values are scaled with the slope and intercept from the metadata and converted
+        from their units (see `UNITS_TO_INCHES`) to inches by `derivedProducts`.
+
+        Args:
+            dir (object): A directory object containing the necessary paths.
+
+        Returns:
+            str: The file path of the GeoTIFF file in inches.
+        """
+        definitions = {f"{self.name}_in": {"operation": "inches", "product": self.name, "days": 1}}
+        return derivedProducts(dir, definitions).run([self])[0]
+
+class palette:
+    """
+    A color table from the colortables folder, precomputed as lookup tables.
+
+    The color table format is that of `gdaldem color-relief`: one `value red green blue [alpha]`
+    entry per line, and an `nv red green blue [alpha]` entry for the nodata color. Colors are
+    interpolated linearly between entries, and values beyond the first or last entry take its
+    color.
+
+    The colors of every possible 16-bit value are computed once, so coloring a grid is a single
+    indexing operation. For paletted output the ramp is divided into 255 steps; index 0 is the
+    nodata color.
+
+    Attributes:
+        entries (list): The (value, (red, green, blue, alpha)) entries, sorted by value.
+        nodataColor (tuple): The (red, green, blue, alpha) color of nodata.
+        nodata (float): The nodata value of the grids to color.
+        lookup (numpy.ndarray): The RGBA color of each 16-bit value, shape (65536, 4).
+        lookupIndex (numpy.ndarray): The palette index of each 16-bit value, shape (65536,).
+        colors (numpy.ndarray): The RGBA color of each palette index, shape (256, 4).
+    """
+
+    def __init__(self, colortxt, nodata=None):
+        """
+        Reads a color table and builds its lookup tables.
+
+        Args:
+            colortxt (str): The file path of the color table file.
+            nodata (float, optional): The nodata value of the grids to color.
+        """
+        self.entries = []
+        self.nodataColor = (0, 0, 0, 0)
+        with open(colortxt) as table:
+            for line in table:
+                words = line.split()
+                if not words:
+                    continue
+                color = tuple(int(word) for word in words[1:]) + (255,)
+                if words[0] == "nv":
+                    self.nodataColor = color[:4]
+                else:
+                    self.entries.append((float(words[0]), color[:4]))
+        self.entries.sort()
+        self.nodata = nodata
+        values = np.arange(-32768, 32768, dtype=np.float64)
+        self.lookup = self.interpolate(values)
+        breaks = [value for value, color in self.entries]
+        position = np.interp(values, breaks, np.linspace(0, 1, len(breaks)))
+        self.lookupIndex = (1 + np.rint(position * 254)).astype(np.uint8)
+        steps = np.interp(np.linspace(0, 1, 255), np.linspace(0, 1, len(breaks)), breaks)
+        self.colors = np.zeros((256, 4), dtype=np.uint8)
+        self.colors[0] = self.nodataColor
+        self.colors[1:] = self.interpolate(steps)
+        if nodata is not None and -32768 <= nodata <= 32767:
+            self.lookup[int(nodata) + 32768] = self.nodataColor
+            self.lookupIndex[int(nodata) + 32768] = 0
+
+    def interpolate(self, values):
+        """
+        Interpolates the colors of values between the color table entries.
+
+        Args:
+            values (numpy.ndarray): The values to color.
+
+        Returns:
+            numpy.ndarray: The uint8 RGBA color of each value, with a last axis of length 4.
+        """
+        breaks = [value for value, color in self.entries]
+        channels = [
+            np.interp(values, breaks, [color[channel] for value, color in self.entries])
+            for channel in range(4)
+        ]
+        return np.rint(np.stack(channels, axis=-1)).astype(np.uint8)
+
+    def offsets(self, block):
+        """
+        Converts a block of a grid to indices into the lookup tables.
+
+        Args:
+            block (numpy.ndarray): The block. Non-integer values are rounded.
+
+        Returns:
+            numpy.ndarray: The index of each value in the lookup tables.
+        """
+        if not np.issubdtype(block.dtype, np.integer):
+            block = np.rint(block)
+        return np.clip(block, -32768, 32767).astype(np.int32) + 32768
+
+    def rgba(self, block):
+        """
+        Colors a block of a grid.
+
+        Args:
+            block (numpy.ndarray): The block.
+
+        Returns:
+            numpy.ndarray: The uint8 RGBA color of each value, with a last axis of length 4.
+        """
+        return self.lookup[self.offsets(block)]
+
+    def indices(self, block):
+        """
+        Maps a block of a grid to palette indices.
+
+        Args:
+            block (numpy.ndarray): The block.
+
+        Returns:
+            numpy.ndarray: The uint8 index into `self.colors` of each value.
+        """
+        return self.lookupIndex[self.offsets(block)]
+
+
+class derivedProducts:
+    """
+    Computes products derived from the converted SNODAS grids.
+
+    The derived products are declared in derived.txt, one per line, as
+    `<name>: <operation> <product> [days] [inches]`:
+
+    - `scaled swe`: the product in the units of its metadata, using its slope and intercept.
+    - `inches snowdepth`: the product converted to inches.
+    - `change snowdepth 3`: the change of the product since `days` days before.
+    - `total precipsnow 7`: the sum of the product over the last `days` days, including today.
+
+    `change` and `total` are in the units of the metadata, or inches if the line ends with
+    `inches`. Earlier days are read from their converted GeoTIFF files. A pixel that is nodata in
+    any of the grids a product uses is nodata (`DERIVED_NODATA`) in the product.
+
+    All products are computed in one pass over blocks of rows. Each input grid is opened once and
+    each of its blocks is read once, however many products use it, so memory use is bounded by
+    the block size.
+
+    Products are written as Float32 with the output profile configured for their name (see
+    `directory.outputProfile`). A COG is written block by block to a tiled GeoTIFF first and then
+    copied to a COG, and the vrt profile writes a tiled GeoTIFF, since a derived product has no
+    raw grid to reference. Every file is written under a temporary name (see `atomic`), so a
+    failure leaves nothing behind.
+
+    Attributes:
+        dir (directory): The directory object of the date to compute the products for.
+        definitions (dict): The parsed definitions, by output name.
+        block_rows (int): The number of rows read and written at a time.
+    """
+
+    def __init__(self, dir, definitions=None, block_rows=512):
+        """
+        Initializes the engine with the product definitions.
+
+        Args:
+            dir (directory): The directory object of the date to compute the products for.
+            definitions (dict, optional): Parsed definitions, by output name. Defaults to the
+                definitions in derived.txt.
+            block_rows (int, optional): The number of rows read and written at a time. Defaults to 512.
+        """
+        self.dir = dir
+        if definitions is None:
+            definitions = parse_derived(dir.derivedProducts)
+        self.definitions = definitions
+        self.block_rows = block_rows
+
+    def offsets(self, definition):
+        """
+        Lists the days before today whose grids a product needs.
+
+        Args:
+            definition (dict): The definition of the product.
+
+        Returns:
+            list: The number of days before today of each grid, starting with today (0).
+        """
+        if definition["operation"] == "change":
+            return [0, definition["days"]]
+        if definition["operation"] == "total":
+            return list(range(definition["days"]))
+        return [0]
+
+    def source(self, product, offset, today):
+        """
+        Finds the converted GeoTIFF of a product `offset` days before this directory's date.
+
+        Args:
+            product (str): The name of the product.
+            offset (int): The number of days before this directory's date.
+            today (dict): The GTIFF objects of this directory's date, by name.
+
+        Returns:
+            str: The path of the GeoTIFF, or None if it does not exist.
+        """
+        if offset == 0:
+            return today[product].fullPath if product in today else None
+        date = dataDate(datetime_from_str(self.dir.date) - timedelta(days=offset))
+        for extension in (".tif", ".vrt"):
+            source = join(self.dir.forDate(date).finalData, f"{product}{extension}")
+            if isfile(source):
+                return source
+        return None
+
+    def run(self, tiffs):
+        """
+        Computes every defined product whose inputs exist and writes it to the data folder.
+
+        Args:
+            tiffs (list): The converted GTIFF objects of this directory's date.
+
+        Returns:
+            list: The paths of the products written.
+        """
+        today = {tiff.name: tiff for tiff in tiffs}
+        (inputs, products) = self.plan(tiffs)
+        if not products:
+            return []
+        paths = [join(self.dir.finalData, f"{name}.tif") for name in products]
+        with ExitStack() as stack:
+            parts = {name: stack.enter_context(atomic(dest)) for name, dest in zip(products, paths)}
+            profiles = {name: OUTPUT_PROFILES[self.dir.outputProfile(name)] for name in products}
+            blockwise = {}
+            for name, part in parts.items():
+                blockwise[name] = part
+                if profiles[name]["format"] != "GTiff":
+                    blockwise[name] = f"{part}.blocks.tif"
+                    stack.callback(Path(blockwise[name]).unlink, missing_ok=True)
+            try:
+                datasets = {key: gdal.Open(source) for key, source in inputs.items()}
+                reference = datasets[next(iter(inputs))]
+                columns, rows = reference.RasterXSize, reference.RasterYSize
+                driver = gdal.GetDriverByName("GTiff")
+                outputs = {}
+                for name in products:
+                    options = profiles[name]["creationOptions"] if profiles[name]["format"] == "GTiff" else DERIVED_BLOCKS
+                    output = driver.Create(blockwise[name], columns, rows, 1, gdal.GDT_Float32, options=options)
+                    output.SetGeoTransform(reference.GetGeoTransform())
+                    output.SetProjection(reference.GetProjection())
+                    output.GetRasterBand(1).SetNoDataValue(DERIVED_NODATA)
+                    outputs[name] = output
+                for row in range(0, rows, self.block_rows):
+                    count = min(self.block_rows, rows - row)
+                    blocks = {
+                        key: dataset.GetRasterBand(1).ReadAsArray(0, row, columns, count)
+                        for key, dataset in datasets.items()
+                    }
+                    for name, definition in products.items():
+                        metadata = today[definition["product"]].metadata
+                        grids = [blocks[(definition["product"], offset)] for offset in self.offsets(definition)]
+                        outputs[name].GetRasterBand(1).WriteArray(self.compute(definition, grids, metadata), 0, row)
+                for output in outputs.values():
+                    output.FlushCache()
+            finally:
+                # GDAL closes the files when the datasets are released, before they are moved or removed
+                output = outputs = datasets = reference = None
+            for name, part in parts.items():
+                if blockwise[name] != part:
+                    spec = profiles[name]
+                    if spec["format"] == "VRT":
+                        replace(blockwise[name], part)
+                        continue
+                    options = gdal.TranslateOptions(format=spec["format"], creationOptions=spec["creationOptions"])
+                    if gdal.Translate(part, blockwise[name], options=options) is None:
+                        raise RuntimeError(f"GDAL could not create {name}.tif")
+        return paths
+
+    def plan(self, tiffs):
+        """
+        Finds the products whose inputs exist, and the GeoTIFF files they are computed from.
+
+        Args:
+            tiffs (list): The converted GTIFF objects of this directory's date.
+
+        Returns:
+            tuple: The path of each input grid by (product, offset), and the definitions of the
+            products that can be computed, by output name.
+        """
+        today = {tiff.name: tiff for tiff in tiffs}
+        inputs = {}
+        products = {}
+        for name, definition in self.definitions.items():
+            needed = {
+                (definition["product"], offset): self.source(definition["product"], offset, today)
+                for offset in self.offsets(definition)
+            }
+            if None in needed.values():
+                print(f"Skipping {name}: not every day of {definition['product']} is available")
+                continue
+            inputs.update(needed)
+            products[name] = definition
+        return inputs, products
+
+    def compute(self, definition, grids, metadata):
+        """
+        Computes one block of a product.
+
+        Args:
+            definition (dict): The definition of the product.
+            grids (list): The raw blocks of the input grids, in the order of `offsets()`.
+            metadata (dict): The metadata of the product, for its scale, units and nodata value.
+
+        Returns:
+            numpy.ndarray: The float32 block of the product.
+        """
+        (slope, intercept, units) = scale_from_metadata(metadata)
+        factor = 1.0
+        if definition["operation"] == "inches" or definition.get("inches"):
+            if units not in UNITS_TO_INCHES:
+                raise ValueError(f"Cannot convert {units} to inches.")
+            factor = UNITS_TO_INCHES[units]
+        nodata = float(metadata["No data value"])
+        invalid = np.zeros(grids[0].shape, dtype=bool)
+        for grid in grids:
+            invalid |= grid == nodata
+        values = [(grid.astype(np.float32) * slope + intercept) * factor for grid in grids]
+        if definition["operation"] == "change":
+            result = values[0] - values[1]
+        elif definition["operation"] == "total":
+            result = np.sum(values, axis=0, dtype=np.float32)
+        else:
+            result = values[0]
+        result[invalid] = DERIVED_NODATA
+        return result
+
+
+class cube:
+    """
+    An append-only, chunked history of one product, for fast per-pixel time series.
+
+    Each day of the product is appended as one time step. The raw values are kept in
+    memory-mapped files of `chunk[0]` time steps each, `t00000.dat`, `t00001.dat`, ..., laid out
+    as (chunk rows, chunk columns, time, rows, columns): a day is written as one contiguous tile
+    per chunk, and the history of a pixel is read from one chunk per file instead of one GeoTIFF
+    per day. `index.json` records the grid, the scale of the values and the time step of each date.
+
+    Dates are given time steps in the order they are appended. Appending a date again overwrites
+    its time step. Queries return the dates in order, whatever order they were appended in.
+
+    Attributes:
+        folder (str): The folder of the cube (e.g., data/cube/swe).
+        chunk (tuple): The size of a chunk in time steps, rows and columns.
+        index (str): The path of the index file.
+    """
+
+    locks = {}
+
+    def __init__(self, folder, chunk=(32, 256, 256)):
+        """
+        Initializes the cube with its folder.
+
+        Args:
+            folder (str): The folder of the cube. It is created by the first append.
+            chunk (tuple, optional): The size of a chunk in time steps, rows and columns, used
+                when the cube is created. Defaults to (32, 256, 256).
+        """
+        self.folder = folder
+        self.index = join(folder, "index.json")
+        self.lock = cube.locks.setdefault(abspath(folder), Lock())
+        self.chunk = tuple(self.load().get("chunk", chunk))
+
+    def load(self):
+        """
+        Reads the index file.
+
+        Returns:
+            dict: The index, empty if the cube has no data yet.
+        """
+        try:
+            with open(self.index) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, index):
+        """
+        Writes the index file, replacing it in one step so a crash can't leave it half written.
+
+        Args:
+            index (dict): The index.
+        """
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+        with open(f"{self.index}.tmp", "w") as out:
+            json.dump(index, out, indent=1)
+        replace(f"{self.index}.tmp", self.index)
+
+    def block(self, index, number, mode="r"):
+        """
+        Maps a file of `chunk[0]` time steps.
+
+        Args:
+            index (dict): The index of the cube.
+            number (int): The number of the file.
+            mode (str, optional): The numpy.memmap mode. "r+" creates the file if it does not exist.
+
+        Returns:
+            numpy.memmap: The values, shaped (chunk rows, chunk columns, time, rows, columns).
+        """
+        (steps, rows, columns) = self.chunk
+        shape = (
+            -(-index["rows"] // rows),
+            -(-index["columns"] // columns),
+            steps,
+            rows,
+            columns,
+        )
+        name = join(self.folder, f"t{number:05d}.dat")
+        if mode == "r+" and not isfile(name):
+            mode = "w+"
+        return np.memmap(name, dtype=np.int16, mode=mode, shape=shape)
+
+    def append(self, date, tiff):
+        """
+        Appends a converted product to the cube.
+
+        Args:
+            date (str): The date of the product in YYYYMMDD format.
+            tiff (GTIFF): The converted GTIFF object, with `fullPath` set.
+        """
+        source = gdal.Open(tiff.fullPath)
+        band = source.GetRasterBand(1)
+        self.extend(date, tiff.metadata, lambda row, count: band.ReadAsArray(0, row, source.RasterXSize, count))
+        source = None
+
+    def extend(self, date, metadata, read):
+        """
+        Writes one date of raw values to the cube, a band of `chunk[1]` rows at a time.
+
+        Args:
+            date (str): The date of the values in YYYYMMDD format.
+            metadata (dict): The metadata read from the product's .txt file.
+            read (callable): Returns `count` rows of raw values starting at `row` when called as
+                `read(row, count)`.
+        """
+        (steps, rows, columns) = self.chunk
+        with self.lock:
+            index = self.load()
+            if not index:
+                (slope, intercept, units) = scale_from_metadata(metadata)
+                minX = float(metadata["Minimum x-axis coordinate"])
+                maxY = float(metadata["Maximum y-axis coordinate"])
+                index = {
+                    "rows": int(metadata["Number of rows"]),
+                    "columns": int(metadata["Number of columns"]),
+                    "chunk": list(self.chunk),
+                    "minX": minX,
+                    "maxY": maxY,
+                    "width": (float(metadata["Maximum x-axis coordinate"]) - minX) / int(metadata["Number of columns"]),
+                    "height": (maxY - float(metadata["Minimum y-axis coordinate"])) / int(metadata["Number of rows"]),
+                    "nodata": float(metadata["No data value"]),
+                    "slope": slope,
+                    "intercept": intercept,
+                    "units": units,
+                    "dates": {},
+                }
+            step = index["dates"].get(date, len(index["dates"]))
+            Path(self.folder).mkdir(parents=True, exist_ok=True)
+            values = self.block(index, step // steps, "r+")
+            for row in range(0, index["rows"], rows):
+                band = read(row, min(rows, index["rows"] - row))
+                for column in range(0, index["columns"], columns):
+                    tile = band[:, column : column + columns]
+                    values[row // rows, column // columns, step % steps, : tile.shape[0], : tile.shape[1]] = tile
+            values.flush()
+            del values
+            index["dates"][date] = step
+            self.save(index)
+
+    def steps(self, index, start=None, end=None):
+        """
+        Lists the dates of the cube between two dates, in order, with their time steps.
+
+        Args:
+            index (dict): The index of the cube.
+            start (str, optional): The first date in YYYYMMDD format. Defaults to the first date.
+            end (str, optional): The last date in YYYYMMDD format. Defaults to the last date.
+
+        Returns:
+            list: (date, time step) tuples.
+        """
+        return [
+            (date, step)
+            for date, step in sorted(index["dates"].items())
+            if (start is None or date >= start) and (end is None or date <= end)
+        ]
+
+    def window(self, row, column, rows=1, columns=1, start=None, end=None):
+        """
+        Reads the time series of a window of pixels.
+
+        Args:
+            row (int): The first row of the window.
+            column (int): The first column of the window.
+            rows (int, optional): The number of rows of the window. Defaults to 1.
+            columns (int, optional): The number of columns of the window. Defaults to 1.
+            start (str, optional): The first date in YYYYMMDD format. Defaults to the first date.
+            end (str, optional): The last date in YYYYMMDD format. Defaults to the last date.
+
+        Returns:
+            tuple: The dates and the values, shaped (dates, rows, columns), in the units of the
+            product's metadata with NaN for no data.
+
+        Raises:
+            ValueError: If the window is not inside the grid.
+        """
+        index = self.load()
+        if not index or row < 0 or column < 0 or row + rows > index["rows"] or column + columns > index["columns"]:
+            raise ValueError(f"Window {row} {column} {rows} {columns} is not inside the grid of {self.folder}.")
+        (steps, chunkRows, chunkColumns) = self.chunk
+        dates = self.steps(index, start, end)
+        raw = np.empty((len(dates), rows, columns), dtype=np.int16)
+        numbers = np.array([step // steps for date, step in dates], dtype=int)
+        for number in np.unique(numbers):
+            selected = np.nonzero(numbers == number)[0]
+            times = [dates[position][1] % steps for position in selected]
+            values = self.block(index, number)
+            for top in range(row - row % chunkRows, row + rows, chunkRows):
+                for left in range(column - column % chunkColumns, column + columns, chunkColumns):
+                    (r0, r1) = (max(row, top), min(row + rows, top + chunkRows))
+                    (c0, c1) = (max(column, left), min(column + columns, left + chunkColumns))
+                    tile = values[top // chunkRows, left // chunkColumns]
+                    raw[selected, r0 - row : r1 - row, c0 - column : c1 - column] = tile[
+                        times, r0 - top : r1 - top, c0 - left : c1 - left
+                    ]
+            del values
+        series = raw * index["slope"] + index["intercept"]
+        series[raw == index["nodata"]] = np.nan
+        return [date for date, step in dates], series
+
+    def pixel(self, longitude, latitude):
+        """
+        Finds the pixel of the grid containing a point.
+
+        Args:
+            longitude (float): The longitude in degrees.
+            latitude (float): The latitude in degrees.
+
+        Returns:
+            tuple: The row and column of the pixel.
+        """
+        index = self.load()
+        if not index:
+            raise ValueError(f"{self.folder} has no data.")
+        row = math.floor((index["maxY"] - latitude) / index["height"])
+        column = math.floor((longitude - index["minX"]) / index["width"])
+        return row, column
+
+    def point(self, longitude, latitude, start=None, end=None):
+        """
+        Reads the time series of the pixel containing a point.
+
+        Args:
+            longitude (float): The longitude in degrees.
+            latitude (float): The latitude in degrees.
+            start (str, optional): The first date in YYYYMMDD format. Defaults to the first date.
+            end (str, optional): The last date in YYYYMMDD format. Defaults to the last date.
+
+        Returns:
+            tuple: The dates and the values, in the units of the product's metadata with NaN for no data.
+        """
+        (row, column) = self.pixel(longitude, latitude)
+        (dates, series) = self.window(row, column, start=start, end=end)
+        return dates, series[:, 0, 0]
+
+    def stats(self, longitude, latitude, start=None, end=None):
+        """
+        Summarizes the time series of the pixel containing a point, e.g. over a season.
+
+        Args:
+            longitude (float): The longitude in degrees.
+            latitude (float): The latitude in degrees.
+            start (str, optional): The first date in YYYYMMDD format. Defaults to the first date.
+            end (str, optional): The last date in YYYYMMDD format. Defaults to the last date.
+
+        Returns:
+            dict: The number of days with data, the minimum, mean and maximum, the date of the
+            maximum and the latest value with its date, in the units of the product's metadata.
+            The values are None if no day has data.
+        """
+        (dates, series) = self.point(longitude, latitude, start, end)
+        valid = np.nonzero(~np.isnan(series))[0]
+        stats = {"days": int(len(valid)), "units": self.load()["units"]}
+        if not len(valid):
+            return {**stats, "min": None, "mean": None, "max": None, "peak": None, "latest": None, "latestDate": None}
+        peak = valid[np.argmax(series[valid])]
+        return {
+            **stats,
+            "min": float(series[valid].min()),
+            "mean": float(series[valid].mean()),
+            "max": float(series[peak]),
+            "peak": dates[peak],
+            "latest": float(series[valid[-1]]),
+            "latestDate": dates[valid[-1]],
+        }
+
+
+def convert_tiff(tiff, directory, filename, colorize=False, reconvert=True):
+    """
+    Converts a single product to a GeoTIFF file, to one per region in regions.txt and to one per
+    target in targets.txt.
+
+    This is a module level function so that it can be sent to a process pool by `file.convert()`.
+
+    Args:
+        tiff (GTIFF): The GTIFF object to convert.
+        directory (directory): A directory object containing the necessary paths.
+        filename (str): The desired filename for the output GeoTIFF file.
+        colorize (bool, optional): If True, applies color relief when a color table exists for the product. Defaults to False.
+        reconvert (bool, optional): If False, the product was converted by an earlier run (see
+            `GTIFF.restore`) and is only colorized. Defaults to True.
+
+    Returns:
+        GTIFF: The converted GTIFF object, with `fullPath` and `name` set, and the records of
+        the conversion's stages in `measurements`, to send them back from a worker process.
+    """
+    start = len(instruments.records)
+    with gdal_options(directory.gdalConfig):
+        try:
+            if reconvert:
+                tiff.name = filename
+                tiff.validate()
+                if tiff.archive is None:
+                    tiff.createHDR()
+                tiff.process(directory, filename)
+                tiff.createAUX()
+                for region, definition in directory.regions.items():
+                    tiff.clip(directory, filename, region, definition)
+                for target, definition in directory.targets.items():
+                    tiff.warp(directory, filename, target, definition)
+            if colorize and isfile(join(directory.colortables, f"{tiff.name}.txt")):
+                tiff.colorize(directory)
+        finally:
+            tiff.release()
+    tiff.measurements = [
+        record for record in instruments.records[start:] if record["labels"].get("product") == filename
+    ]
+    return tiff
+
+
+class directory:  # directory manager
+    def __init__(self, date, root=None, tmp=None, settings=None, gdal_config=None):
+        """
+        Initializes the directory object with paths and filenames based on the provided date.
+
+        Args:
+            date (dataDate): A dataDate object containing the current date information.
+            root (str, optional): The folder to keep the data and tmp folders in. Defaults to the
+                folder of this file, which also holds the configuration, styles and color tables.
+            tmp (str, optional): The folder for downloads and scratch files, e.g. on a tmpfs.
+                Defaults to the tmp folder in `root`.
+            settings (dict, optional): Settings that take the place of the environment variables
+                of the same name (e.g. {"SNOSERVE_OUTPUT_PROFILE": "cog"}) for everything done
+                with this directory. See `setting`.
+            gdal_config (dict, optional): GDAL configuration options (e.g. {"GDAL_CACHEMAX": "512"})
+                set for the threads converting this directory's products. See `gdal_options`.
+        """
+        self.workingDirectory = dirname(abspath(__file__))
+        self.date = f"{date.year}{date.month}{date.day}"
+        self.name = f"SNODAS-{self.date}"
+        self.settings = dict(settings or {})
+        self.gdalConfig = dict(gdal_config or {})
+        self.root = self.workingDirectory if root is None else root
+        self.data = join(self.root, "data")
+        self.tmp = join(self.root, "tmp") if tmp is None else tmp
+        self.download = join(self.tmp, self.name + ".tar")
+        self.extract = join(self.tmp, self.name)
+        self.finalData = join(self.data, self.name)
+        self.manifest = join(self.finalData, ".manifest.json")
+        self.tarCache = join(self.tmp, "cache.json")
+        self.dataCache = join(self.data, "cache.json")
+        self.cubes = join(self.data, "cube")
+        self.swe = join(self.finalData, f"swe{self.date}.tif")
+        self.snowDepth = join(self.finalData, f"snowdepth{self.date}.tif")
+        self.styles = join(self.workingDirectory, "styles")
+        self.colortables = join(self.workingDirectory, "colortables")
+        self.folders = [
+            self.data,
+            self.tmp,
+            self.finalData,
+            self.extract,
+            self.styles,
+        ]
+        self.filenames = join(self.workingDirectory, "filenames.txt")
+        self.finalNames = read_txt_vars(self.filenames)
+        self.derivedProducts = join(self.workingDirectory, "derived.txt")
+        self.profiles = join(self.workingDirectory, "profiles.txt")
+        self.outputProfiles = read_txt_vars(self.profiles) if isfile(self.profiles) else {}
+        self.regionsFile = join(self.workingDirectory, "regions.txt")
+        self.regions = parse_regions(self.regionsFile)
+        self.targetsFile = join(self.workingDirectory, "targets.txt")
+        self.targets = parse_targets(self.targetsFile, self.setting("SNOSERVE_WARP_RESAMPLING", "bilinear"))
+        self.environment = join(self.workingDirectory, ".env")
+
+    def setting(self, name, default=None):
+        """
+        Reads a setting from `settings`, or else from the environment variable of the same name.
+
+        Args:
+            name (str): The name of the setting (e.g., SNOSERVE_OUTPUT_PROFILE).
+            default (str, optional): The value to use if the setting is not set.
+
+        Returns:
+            str: The value of the setting.
+        """
+        return setting(name, default, self.settings)
+
+    def forDate(self, date):
+        """
+        Returns the directory object of another date, with the same folders and settings.
+
+        Args:
+            date (dataDate): The other date.
+
+        Returns:
+            directory: The directory object of `date`.
+        """
+        return directory(date, self.root, self.tmp, self.settings, self.gdalConfig)
+
+    def create(self):
+        """
+        Creates directories for storing data, temporary files, and styles.
+        """
+        for folder in self.folders:
+            Path(folder).mkdir(parents=True, exist_ok=True)
+
+    def outputDirs(self):
+        """
+        Reads the file names from the filenames.txt file and creates a dictionary with the locations to save processed data.
+
+        Returns:
+            dict: A dictionary where keys are file descriptions and values are output file paths.
+        """
+        self.finalNames = read_txt_vars(self.filenames)
+        self.outputPaths = {}
+        for key in self.finalNames:
+            self.outputPaths[key] = join(self.finalData, f"{self.finalNames[key]}.tif")
+        return self.outputPaths
+
+    def mosaicGranule(self, name, granule, local_path):
+        """
+        Hard links a GeoTIFF into the ImageMosaic folder of a product.
+
+        The folder `data/mosaic/<name>` holds the granules of the product's time-enabled
+        ImageMosaic store, named with their date, and the properties files that configure the
+        mosaic. Hard linking keeps the granule when the dated data folder is removed by the cache
+        without copying any data. If the data folder is on another file system, the file is copied.
+
+        Args:
+            name (str): The name of the product (e.g., swe).
+            granule (str): The file name of the granule, containing its date in YYYYMMDD format.
+            local_path (str): The local file path of the GeoTIFF.
+
+        Returns:
+            str: The path of the granule.
+        """
+        folder = join(self.data, "mosaic", name)
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        for properties, content in MOSAIC_PROPERTIES.items():
+            if not isfile(join(folder, properties)):
+                with open(join(folder, properties), "w") as out:
+                    out.write(content)
+        dest = join(folder, granule)
+        Path(dest).unlink(missing_ok=True)
+        try:
+            link(local_path, dest)
+        except OSError:
+            copyfile(local_path, dest)
+        return dest
+
+    def outputProfile(self, name):
+        """
+        Returns the output profile to write a product with.
+
+        Products listed in profiles.txt use the profile given there. Other products use the
+        SNOSERVE_OUTPUT_PROFILE setting, or "gtiff" if it is not set.
+
+        Args:
+            name (str): The output file name of the product (e.g., swe).
+
+        Returns:
+            str: The name of a profile in `OUTPUT_PROFILES`.
+
+        Raises:
+            ValueError: If the configured profile is not in `OUTPUT_PROFILES`.
+        """
+        profile = self.outputProfiles.get(name, self.setting("SNOSERVE_OUTPUT_PROFILE", "gtiff"))
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(
+                f"Output profile {profile} for {name} is not one of {list(OUTPUT_PROFILES)}."
+            )
+        return profile
+
+    def regionLayers(self, products):
+        """
+        Returns the layers published for products, including their clipped and warped copies.
+
+        Args:
+            products (list): The output file names of the products (e.g., ["snowdepth", "swe"]).
+
+        Returns:
+            dict: The product each layer is made from, by layer name (e.g., {"swe_tetons": "swe"}).
+        """
+        layers = {product: product for product in products}
+        for product in products:
+            for region in self.regions:
+                layers[f"{product}_{region}"] = product
+            for target in self.targets:
+                layers[f"{product}_{target}"] = product
+        return layers
+
+    def layerSRS(self, layer):
+        """
+        Returns the coordinate system a layer is declared in, if it is the warped copy of a product.
+
+        Args:
+            layer (str): The name of the layer (e.g., swe_3857).
+
+        Returns:
+            str: The coordinate system of the layer's target (e.g., EPSG:3857), or None for a
+            layer in the coordinate system of the SNODAS grid.
+        """
+        for target, definition in self.targets.items():
+            if layer.endswith(f"_{target}"):
+                return definition["srs"]
+        return None
+
+    def unzippedName(self, extension, zippedFile):  # refactor extract GZ in future
+        """
+        This method is a placeholder for future refactoring related to extracting GZ files.
+        """
+        pass
+
+
+class GeoServerError(Exception):
+    """
+    Raised when the GeoServer REST API answers a request with an error status.
+
+    Attributes:
+        status (int): The HTTP status code of the response.
+        body (str): The body of the response, which usually explains the error.
+    """
+
+    def __init__(self, method, url, status, body):
+        super().__init__(f"{method} {url} failed with status {status}: {body[:500]}")
+        self.status = status
+        self.body = body
+
+
+class QualityError(ValueError):
+    """
+    Raised when a product's grid fails the quality checks of `GTIFF.validate`.
+
+    Attributes:
+        statistics (dict): The statistics of the grid, if it could be read in full.
+    """
+
+    def __init__(self, message, statistics=None):
+        super().__init__(message)
+        self.statistics = statistics
+
+    def __reduce__(self):
+        # Keeps the statistics when the error is sent back from a worker process
+        return (QualityError, (str(self), self.statistics))
+
+
+class restClient:
+    """
+    A client for the GeoServer REST API on a pooled HTTP session.
+
+    The connections are kept open between requests and may be used by several threads at once,
+    so `server` can publish several products concurrently over the same pool. Every response is
+    checked, and error statuses raise `GeoServerError`.
+
+    Attributes:
+        host (str): The address of the REST API (e.g., http://localhost:8080/geoserver/rest).
+        session (requests.Session): The session holding the pooled connections and credentials.
+        timeout (float): The timeout in seconds for connecting and for each read.
+    """
+
+    def __init__(self, host, username, password, pool_size=8, timeout=300):
+        """
+        Initializes the client and its connection pool.
+
+        Args:
+            host (str): The address of the REST API.
+            username (str): The GeoServer user name.
+            password (str): The GeoServer password.
+            pool_size (int, optional): The number of connections kept open. Defaults to 8.
+            timeout (float, optional): The timeout in seconds for connecting and for each read. Defaults to 300.
+        """
+        self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, ok=(), **kwargs):
+        """
+        Send a request to the REST API and check its response.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path of the resource, relative to `self.host`.
+            ok (tuple, optional): Error statuses that should be returned instead of raised (e.g., 404).
+            **kwargs: Passed on to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The response.
+
+        Raises:
+            GeoServerError: If the response has an error status not in `ok`.
+        """
+        url = f"{self.host}/{path}"
+        response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        if response.status_code >= 400 and response.status_code not in ok:
+            raise GeoServerError(method, url, response.status_code, response.text)
+        return response
+
+    def exists(self, path):
+        """
+        Check whether a resource exists.
+
+        Args:
+            path (str): The path of the resource, relative to `self.host`.
+
+        Returns:
+            bool: True if the resource exists.
+        """
+        return self.request("GET", path, ok=(404,)).status_code != 404
+
+
+class server:
+    def __init__(self, directory):
+        """
+        Initialize a server instance with the given directory.
+
+        Args:
+            directory (object): A directory object containing the necessary information
+                for the server, such as the styles folder path.
+        """
+        self.directory = directory
+        self.HOST = directory.setting("GEOSERVER_ADDRESS")
+        self.USERNAME = directory.setting("GEOSERVER_USERNAME")
+        self.PASSWORD = directory.setting("GEOSERVER_PASS")
+        self._geoserver = None
+        # Products are published this many at a time over one pool of connections
+        self.workers = int(directory.setting("SNOSERVE_PUBLISH_WORKERS", 4))
+        self.client = restClient(self.HOST, self.USERNAME, self.PASSWORD, pool_size=self.workers)
+        self.errors = {}
+        # "coverage" replaces one coverage store per product each day, "mosaic" adds each day
+        # to a time-enabled ImageMosaic store per product
+        self.layout = directory.setting("SNOSERVE_PUBLISH", "coverage")
+        # "external" registers files GeoServer can read from a shared volume by path instead of
+        # uploading them, translating paths with SNOSERVE_PATH_MAP
+        self.external = directory.setting("SNOSERVE_TRANSFER", "upload") == "external"
+        self.pathMap = parse_path_map(directory.setting("SNOSERVE_PATH_MAP", ""))
+        # GeoWebCache's REST API, used to refresh cached tiles of updated layers
+        self.gwc = restClient(
+            directory.setting("GEOSERVER_GWC_ADDRESS", gwc_address(self.HOST)),
+            self.USERNAME,
+            self.PASSWORD,
+            pool_size=self.workers,
+        )
+
+    @property
+    def geoserver(self):
+        """
+        The gsconfig catalog of the GeoServer instance, created the first time it is used.
+
+        Only `delete_data` needs it, so publishing does not import or set up gsconfig.
+
+        Returns:
+            geoserver.catalog.Catalog: The catalog.
+        """
+        if self._geoserver is None:
+            self._geoserver = catalog.Catalog(self.HOST, self.USERNAME, self.PASSWORD)
+        return self._geoserver
+
+    def rest(self, method, path, ok=(), **kwargs):
+        """
+        Send a request to the GeoServer REST API with `self.client`.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path of the resource, relative to the REST API address.
+            ok (tuple, optional): Error statuses that should be returned instead of raised.
+            **kwargs: Passed on to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The response.
+
+        Raises:
+            GeoServerError: If the response has an error status not in `ok`.
+        """
+        return self.client.request(method, path, ok, **kwargs)
+
+    def parallel(self, function, jobs):
+        """
+        Run a function for several jobs at once, `self.workers` at a time.
+
+        A job that fails is reported and recorded in `self.errors` under its name, without
+        stopping the other jobs.
+
+        Args:
+            function (callable): The function to run.
+            jobs (dict): The arguments to call `function` with (as a tuple), by job name.
+
+        Returns:
+            dict: The return values of the jobs that succeeded, by job name.
+        """
+        results = {}
+        if not jobs:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as ex:
+            futures = {name: ex.submit(function, *args) for name, args in jobs.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as error:
+                    print(f"Failed to publish {name}: {error}")
+                    self.errors[name] = error
+        return results
+
+    @instrumented("upload_data", lambda self, data_name, *args, **kwargs: {"product": data_name})
+    def upload_data(self, data_name, workspace, local_path, external=None):
+        """
+        Upload geospatial data to the GeoServer instance.
+
+        With the "mosaic" publish layout (SNOSERVE_PUBLISH=mosaic) the data is added to a
+        time-enabled ImageMosaic store with `harvest_granule` instead. The warped copy of a product
+        (see `directory.layerSRS`) is then declared in its target's coordinate system with `declare_srs`.
+
+        Args:
+            data_name (str): The name of the data to be uploaded.
+            workspace (str): The workspace in GeoServer where the data will be uploaded.
+            local_path (str): The local file path of the data to be uploaded.
+            external (bool, optional): Whether to register the file by path with `register_data`
+                instead of uploading it. Defaults to `self.external` (SNOSERVE_TRANSFER=external).
+
+        Returns:
+            requests.Response: The response to the upload.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the upload.
+        """
+        if external is None:
+            external = self.external
+        if self.layout == "mosaic":
+            response = self.harvest_granule(data_name, workspace, local_path, external=external)
+        elif external:
+            response = self.register_data(data_name, workspace, local_path)
+        else:
+            with open(local_path, "rb") as data:
+                response = self.rest(
+                    "PUT",
+                    f"workspaces/{workspace}/coveragestores/{data_name}/file.geotiff",
+                    params={"configure": "first", "coverageName": data_name},
+                    data=data,
+                    headers={"Content-type": "image/tiff"},
+                )
+        srs = self.directory.layerSRS(data_name)
+        if srs is not None:
+            self.declare_srs(data_name, workspace, srs)
+        return response
+
+    def declare_srs(self, data_name, workspace, srs):
+        """
+        Declares the coordinate system of a coverage, so GeoServer serves it without reprojecting.
+
+        GeoServer does not always match the coordinate system read from a GeoTIFF file to an EPSG
+        code (Web Mercator in particular), and then reprojects the coverage for every request
+        even in its own coordinate system. Declaring the code with the FORCE_DECLARED policy
+        avoids that.
+
+        Args:
+            data_name (str): The name of the coverage and of its store.
+            workspace (str): The workspace of the coverage.
+            srs (str): The coordinate system (e.g., EPSG:3857).
+
+        Returns:
+            requests.Response: The response to the request.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the request.
+        """
+        coverage = (
+            f"<coverage><srs>{escape(srs)}</srs>"
+            "<projectionPolicy>FORCE_DECLARED</projectionPolicy></coverage>"
+        )
+        return self.rest(
+            "PUT",
+            f"workspaces/{workspace}/coveragestores/{data_name}/coverages/{data_name}",
+            data=coverage,
+            headers={"Content-type": "text/xml"},
+        )
+
+    def harvest_granule(self, data_name, workspace, local_path, date=None, external=None):
+        """
+        Add one day of data to a time-enabled ImageMosaic store.
+
+        There is one ImageMosaic store per product, named after the product. The first upload
+        creates the store with a TIME dimension read from the date in the granule file names.
+        Later uploads harvest the new granule into the existing store, so every earlier day stays
+        available through the WMS TIME parameter. A granule already harvested for the same date is
+        replaced.
+
+        In external mode the granule is not uploaded. It is hard linked into `data/mosaic/<product>`
+        (see `directory.mosaicGranule`) and GeoServer harvests it from there by path.
+
+        Args:
+            data_name (str): The name of the product (e.g., swe). Used as the store and layer name.
+            workspace (str): The workspace in GeoServer where the data will be uploaded.
+            local_path (str): The local file path of the GeoTIFF to be uploaded.
+            date (str, optional): The date of the data in YYYYMMDD format. Defaults to the date of `self.directory`.
+            external (bool, optional): Whether to register the granule by path instead of uploading
+                it. Defaults to `self.external`.
+
+        Returns:
+            requests.Response: The response to the upload.
+
+        Raises:
+            GeoServerError: If GeoServer rejects a request.
+        """
+        if date is None:
+            date = self.directory.date
+        if external is None:
+            external = self.external
+        granule = f"{data_name}_{date}.tif"
+        store = f"workspaces/{workspace}/coveragestores/{data_name}"
+        exists = self.client.exists(f"{store}.json")
+        if external:
+            # A new store indexes the whole mosaic folder, an existing one harvests the granule
+            target = self.remote_path(self.directory.mosaicGranule(data_name, granule, local_path))
+            if not exists:
+                target = dirname(target)
+            kind = "external.imagemosaic"
+            data = f"file:{target}"
+            headers = {"Content-type": "text/plain"}
+        else:
+            kind = "file.imagemosaic"
+            data = mosaic_archive(local_path, granule, configure=not exists)
+            headers = {"Content-type": "application/zip"}
+        if exists:
+            self.rest(
+                "DELETE",
+                f"{store}/coverages/{data_name}/index/granules.xml",
+                ok=(404,),
+                params={"filter": f"location LIKE '%{granule}'"},
+            )
+            return self.rest(
+                "POST",
+                f"{store}/{kind}",
+                params={"recalculate": "nativebbox,latlonbbox"},
+                data=data,
+                headers=headers,
+            )
+        response = self.rest(
+            "PUT",
+            f"{store}/{kind}",
+            params={"configure": "first", "coverageName": data_name},
+            data=data,
+            headers=headers,
+        )
+        time_dimension = (
+            "<coverage><enabled>true</enabled><metadata><entry key=\"time\"><dimensionInfo>"
+            "<enabled>true</enabled><presentation>LIST</presentation><units>ISO8601</units>"
+            "<defaultValue><strategy>MAXIMUM</strategy></defaultValue>"
+            "</dimensionInfo></entry></metadata></coverage>"
+        )
+        self.rest(
+            "PUT",
+            f"{store}/coverages/{data_name}",
+            data=time_dimension,
+            headers={"Content-type": "text/xml"},
+        )
+        return response
+
+    def register_data(self, data_name, workspace, local_path):
+        """
+        Publish a GeoTIFF that GeoServer can read from a shared volume, without uploading it.
+
+        The coverage store is pointed at the file by path, so no data is sent over HTTP and
+        GeoServer does not keep a copy of its own. The path is translated to GeoServer's view of
+        the shared volume with `remote_path`.
+
+        Args:
+            data_name (str): The name of the data to be published.
+            workspace (str): The workspace in GeoServer where the data will be published.
+            local_path (str): The local file path of the GeoTIFF.
+
+        Returns:
+            requests.Response: The response to the request.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the request.
+        """
+        return self.rest(
+            "PUT",
+            f"workspaces/{workspace}/coveragestores/{data_name}/external.geotiff",
+            params={"configure": "first", "coverageName": data_name},
+            data=f"file:{self.remote_path(local_path)}",
+            headers={"Content-type": "text/plain"},
+        )
+
+    def remote_path(self, local_path):
+        """
+        Translate a local path to the path GeoServer sees for the same file.
+
+        Uses the first prefix in `self.pathMap` that `local_path` starts with. Paths that match no
+        prefix are returned unchanged, which is right when both share the same file system layout.
+
+        Args:
+            local_path (str): The local path of the file.
+
+        Returns:
+            str: The path of the file as seen by GeoServer.
+        """
+        return map_path(local_path, self.pathMap)
+
+    @instrumented("style_data", lambda self, layer_name, *args, **kwargs: {"product": layer_name})
+    def style_data(self, layer_name, style_name, workspace="SNODAS"):
+        """
+        Styles a GeoServer layer with the specified style.
+
+        This method first checks if the specified style exists in the GeoServer instance.
+        If the style does not exist, it uploads the style using the `upload_style` method.
+        Then it sets the style as the default style of the layer with `default_style`.
+
+        Args:
+            layer_name (str): The name of the layer to be styled.
+            style_name (str): The name of the style to be applied to the layer.
+            workspace (str, optional): The workspace of the layer. Defaults to "SNODAS".
+
+        Raises:
+            GeoServerError: If GeoServer rejects a request.
+        """
+        self.ensure_style(style_name)
+        return self.default_style(layer_name, style_name, workspace)
+
+    def ensure_style(self, style_name):
+        """
+        Uploads a style from the styles folder if it does not exist in the GeoServer instance.
+
+        Args:
+            style_name (str): The name of the style.
+
+        Raises:
+            GeoServerError: If GeoServer rejects a request.
+        """
+        if not self.client.exists(f"styles/{style_name}.json"):
+            print("Style does not exist, uploading new style")
+            self.upload_style(style_name)
+
+    @instrumented("default_style", lambda self, layer_name, *args, **kwargs: {"product": layer_name})
+    def default_style(self, layer_name, style_name, workspace="SNODAS"):
+        """
+        Sets the default style of a GeoServer layer.
+
+        Args:
+            layer_name (str): The name of the layer to be styled.
+            style_name (str): The name of the style to be applied to the layer.
+            workspace (str, optional): The workspace of the layer. Defaults to "SNODAS".
+
+        Returns:
+            requests.Response: The response to the request.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the request.
+        """
+        style = f"<layer><defaultStyle><name>{escape(style_name)}</name></defaultStyle></layer>"
+        return self.rest(
+            "PUT",
+            f"layers/{workspace}:{layer_name}",
+            data=style,
+            headers={"Content-type": "text/xml"},
+        )
+
+    def upload_folder(self, workspace, folder_path):
+        """
+        Upload all GeoTIFF files from a specified folder to the GeoServer instance.
+
+        Args:
+            workspace (str): The workspace in GeoServer where the data will be uploaded.
+            folder_path (str): The local path of the folder containing the GeoTIFF files.
+
+        Returns:
+            dict: The responses of the uploads that succeeded, by file name (without extension).
+        """
+        selection = [strip_extension(data) for data in listdir(folder_path) if data.endswith(".tif")]
+        return self.selective_upload(workspace, folder_path, selection)
+
+    def delete_data(self, data_name, workspace):
+        """
+        Delete geospatial data from the GeoServer instance.
+
+        Args:
+            data_name (str): The name of the data to be deleted.
+            workspace (str): The workspace in GeoServer where the data is located.
+
+        Returns:
+            A boolean indicating whether the deletion was successful.
+        """
+        store = self.geoserver.get_store(name=data_name, workspace=workspace)
+        return self.geoserver.delete(store, purge=True, recurse=True)
+
+    def upload_style(self, style):
+        """
+        Uploads a specified style to the GeoServer instance.
+
+        This method checks if the specified style file exists in the styles folder
+        of the current directory object. If the style file is found, it reads the
+        file and creates a new style in the GeoServer instance with the content
+        of the file.
+
+        Args:
+            style (str): The name of the style to be uploaded.
+
+        Raises:
+            Exception: If the specified style file is not found in the styles folder.
+            GeoServerError: If GeoServer rejects the style.
+        """
+        style_files = listdir(self.directory.styles)
+        available_styles = [
+            strip_extension(path.basename(file)) for file in style_files
+        ]
+        if style in available_styles:
+            style_file = join(self.directory.styles, f"{style}.sld")
+            with open(style_file, "rb") as file:
+                self.rest(
+                    "POST",
+                    "styles",
+                    params={"name": style},
+                    data=file.read(),
+                    headers={"Content-type": "application/vnd.ogc.sld+xml"},
+                )
+        else:
+            raise Exception(f"Style {style} not found in styles folder.")
+
+    def style_types(self, types_list, workspace="SNODAS", dry_run=False, styles=None):
+        """
+        Style all layers in GeoServer that have a name matching the provided list of types.
+
+        Each layer is styled with the style of the same name from the styles folder. Only the
+        targeted workspace, layers and styles are fetched, and only the REST calls needed to
+        reach that state are made (see `catalogSync`). Failures are recorded in `self.errors`.
+
+        Args:
+            types_list (list): A list of data types (layer names) to be styled.
+            workspace (str, optional): The workspace of the layers. Defaults to "SNODAS".
+            dry_run (bool, optional): If True, only prints the plan. Defaults to False.
+            styles (dict, optional): The style of layers not named after their style, by layer
+                name (e.g., {"swe_tetons": "swe"}).
+
+        Returns:
+            list: The descriptions of the planned changes.
+        """
+        return catalogSync(self, workspace, types_list, styles).apply(dry_run)
+
+    def create_workspace(self, workspace):
+        """
+        Create a workspace in the GeoServer instance, with a namespace of the same name.
+
+        Args:
+            workspace (str): The name of the workspace.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the request.
+        """
+        return self.rest(
+            "POST",
+            "workspaces",
+            data=f"<workspace><name>{escape(workspace)}</name></workspace>",
+            headers={"Content-type": "text/xml"},
+        )
+
+    def update_style(self, style):
+        """
+        Replaces the content of an existing style with the file from the styles folder.
+
+        Args:
+            style (str): The name of the style.
+
+        Raises:
+            GeoServerError: If GeoServer rejects the request.
+        """
+        with open(join(self.directory.styles, f"{style}.sld"), "rb") as file:
+            return self.rest(
+                "PUT",
+                f"styles/{style}",
+                params={"raw": "true"},
+                data=file.read(),
+                headers={"Content-type": "application/vnd.ogc.sld+xml"},
+            )
+
+    def selective_upload(self, workspace, folder_path, selection, external=None, manifest=None, files=None):
+        """
+        Upload selected GeoTIFF files from a specified folder to the GeoServer instance.
+
+        The files are uploaded `self.workers` at a time. A file that fails is reported and
+        recorded in `self.errors` without stopping the others.
+
+        Args:
+            workspace (str): The workspace in GeoServer where the data will be uploaded.
+            folder_path (str): The local path of the folder containing the GeoTIFF files.
+            selection (list): A list of file names (without extensions) to be uploaded.
+            external (bool, optional): Whether to register the files by path instead of uploading
+                them. See `upload_data`.
+            manifest (manifest, optional): The manifest of the files' date. If given, files whose
+                content was already uploaded to the same place are skipped, and uploads are
+                recorded in it as "publish/<name>".
+            files (dict, optional): The paths of the files, by name. If given, the folder is not
+                listed and only these files are uploaded.
+
+        Returns:
+            dict: The responses of the uploads that succeeded, by file name (without extension).
+        """
+        if files is None:
+            files = {
+                strip_extension(file): join(folder_path, file) for file in listdir(folder_path) if file.endswith(".tif")
+            }
+        jobs = {}
+        inputs = {}
+        for name, data_path in files.items():
+            if name in selection:
+                if manifest is not None:
+                    inputs[name] = {
+                        "data": manifest.signature(data_path),
+                        "host": self.HOST,
+                        "workspace": workspace,
+                        "layout": self.layout,
+                        "external": self.external if external is None else external,
+                        "srs": self.directory.layerSRS(name),
+                    }
+                    if manifest.fresh(f"publish/{name}", inputs[name]):
+                        continue
+                jobs[name] = (name, workspace, data_path, external)
+        results = self.parallel(self.upload_data, jobs)
+        for name in results:
+            if manifest is not None:
+                manifest.record(f"publish/{name}", inputs[name])
+        return results
+    
+    def warm_cache(self, layers, workspace="SNODAS"):
+        """
+        Refresh the GeoWebCache tiles of updated layers so the first views are cache hits.
+
+        The cached tiles of each layer are truncated, then GeoWebCache is asked to seed the
+        configured zoom levels of each configured gridset (see `seed_tiles`). Only the given
+        layers are touched. The layers are handled `self.workers` at a time; GeoWebCache seeds
+        each of them with several threads in the background.
+
+        Args:
+            layers (list): The names of the layers that were updated.
+            workspace (str, optional): The workspace of the layers. Defaults to "SNODAS".
+
+        Returns:
+            dict: The gridsets seeded for each layer that succeeded.
+        """
+        return self.parallel(self.refresh_tiles, {layer: (layer, workspace) for layer in layers})
+
+    def refresh_tiles(self, layer, workspace="SNODAS"):
+        """
+        Truncate and reseed the GeoWebCache tiles of one layer.
+
+        Args:
+            layer (str): The name of the layer.
+            workspace (str, optional): The workspace of the layer. Defaults to "SNODAS".
+
+        Returns:
+            list: The gridsets seeded.
+
+        Raises:
+            GeoServerError: If GeoWebCache rejects a request.
+        """
+        self.gwc.request(
+            "POST",
+            "masstruncate",
+            data=f"<truncateLayer><layerName>{escape(workspace)}:{escape(layer)}</layerName></truncateLayer>",
+            headers={"Content-type": "text/xml"},
+        )
+        return self.seed_tiles(layer, workspace)
+
+    def seed_tiles(self, layer, workspace="SNODAS"):
+        """
+        Ask GeoWebCache to seed the tiles of a layer.
+
+        The zoom levels, gridsets, area and seeding threads are set with SNOSERVE_SEED_ZOOM
+        (e.g., "0-8"), SNOSERVE_SEED_GRIDSETS (e.g., "EPSG:4326,EPSG:900913"), SNOSERVE_SEED_BBOX
+        (longitude and latitude as "west,south,east,north", defaulting to the gridset's extent)
+        and SNOSERVE_SEED_THREADS.
+
+        Args:
+            layer (str): The name of the layer.
+            workspace (str, optional): The workspace of the layer. Defaults to "SNODAS".
+
+        Returns:
+            list: The gridsets seeded.
+
+        Raises:
+            GeoServerError: If GeoWebCache rejects a request.
+        """
+        (zoomStart, zoomStop) = self.directory.setting("SNOSERVE_SEED_ZOOM", "0-8").split("-")
+        gridsets = self.directory.setting("SNOSERVE_SEED_GRIDSETS", "EPSG:4326,EPSG:900913").split(",")
+        bbox = self.directory.setting("SNOSERVE_SEED_BBOX")
+        for gridset in gridsets:
+            request = {
+                "name": f"{workspace}:{layer}",
+                "gridSetId": gridset,
+                "zoomStart": int(zoomStart),
+                "zoomStop": int(zoomStop),
+                "format": "image/png",
+                "type": "seed",
+                "threadCount": int(self.directory.setting("SNOSERVE_SEED_THREADS", 4)),
+            }
+            if bbox:
+                bounds = [float(coordinate) for coordinate in bbox.split(",")]
+                if gridset in ("EPSG:900913", "EPSG:3857"):
+                    bounds = lonlat_to_mercator(*bounds[:2]) + lonlat_to_mercator(*bounds[2:])
+                request["bounds"] = {"coords": {"double": [str(coordinate) for coordinate in bounds]}}
+            self.gwc.request("POST", f"seed/{workspace}:{layer}.json", json={"seedRequest": request})
+        return gridsets
+
+    def check_workspace(self, workspace):
+        """
+        Check if a workspace exists in the GeoServer instance.
+        If the workspace does not exist, create it.
+
+        Args:
+            workspace (str): The name of the workspace to check/create.
+
+        Returns:
+            None
+        """
+        if not self.client.exists(f"workspaces/{workspace}.json"):
+            self.create_workspace(workspace)
+        else:
+            print(f"Workspace '{workspace}' already exists.")
+
+
+class catalogSync:
+    """
+    Plans and applies the GeoServer REST calls that bring the SNODAS catalog to its desired state.
+
+    The desired state is: the workspace exists, every style needed by the products exists with
+    the content of its file in the styles folder, and every product's layer has its style as the
+    default style. Only those resources are fetched, each at most once per catalogSync object,
+    and only the calls needed to close the gap are planned. Layers that do not exist yet are
+    skipped, as they are created by uploading data.
+
+    Attributes:
+        server (server): The server to fetch from and apply changes with.
+        workspace (str): The workspace of the products.
+        styles (dict): The style of each product layer, by layer name.
+        fetched (dict): The fetched resources by REST path, None for resources that don't exist.
+    """
+
+    def __init__(self, server, workspace, products, styles=None):
+        """
+        Initializes the planner with the desired state.
+
+        Args:
+            server (server): The server to fetch from and apply changes with.
+            workspace (str): The workspace of the products.
+            products (list): The names of the product layers.
+            styles (dict, optional): The style of each product layer. Defaults to the style with
+                the same name as the layer.
+        """
+        self.server = server
+        self.workspace = workspace
+        self.styles = {product: product for product in products}
+        self.styles.update(styles or {})
+        self.fetched = {}
+
+    def fetch(self, path, text=False):
+        """
+        Gets a resource from the REST API, or from this run's cache if it was fetched before.
+
+        Args:
+            path (str): The path of the resource.
+            text (bool, optional): If True, returns the body as text instead of parsed JSON.
+
+        Returns:
+            The resource, or None if it does not exist.
+        """
+        if path not in self.fetched:
+            response = self.server.rest("GET", path, ok=(404,))
+            if response.status_code == 404:
+                self.fetched[path] = None
+            else:
+                self.fetched[path] = response.text if text else response.json()
+        return self.fetched[path]
+
+    def plan(self):
+        """
+        Compares the catalog with the desired state.
+
+        Returns:
+            list: The changes to make as (phase, description, function, args) tuples. Changes in
+            the same phase are independent of each other; each phase depends on the ones before.
+        """
+        actions = []
+        if self.fetch(f"workspaces/{self.workspace}.json") is None:
+            actions.append(
+                (0, f"create workspace {self.workspace}", self.server.create_workspace, (self.workspace,))
+            )
+        for style in sorted(set(self.styles.values())):
+            with open(join(self.server.directory.styles, f"{style}.sld")) as file:
+                local = file.read()
+            if self.fetch(f"styles/{style}.json") is None:
+                actions.append((1, f"create style {style}", self.server.upload_style, (style,)))
+            elif self.fetch(f"styles/{style}.sld", text=True).strip() != local.strip():
+                actions.append((1, f"update style {style}", self.server.update_style, (style,)))
+        for layer_name, style in self.styles.items():
+            layer = self.fetch(f"layers/{self.workspace}:{layer_name}.json")
+            if layer is None:
+                print(f"Layer {self.workspace}:{layer_name} does not exist yet; skipping")
+                continue
+            current = layer["layer"].get("defaultStyle", {}).get("name", "")
+            if current.split(":")[-1] != style:
+                actions.append(
+                    (
+                        2,
+                        f"set default style of {layer_name} to {style}",
+                        self.server.default_style,
+                        (layer_name, style, self.workspace),
+                    )
+                )
+        return actions
+
+    def apply(self, dry_run=False):
+        """
+        Prints the plan and, unless this is a dry run, makes the changes.
+
+        The changes of each phase are made at once with `server.parallel`. Failures are
+        recorded in `server.errors`.
+
+        Args:
+            dry_run (bool, optional): If True, only prints the plan. Defaults to False.
+
+        Returns:
+            list: The descriptions of the planned changes.
+        """
+        actions = self.plan()
+        if not actions:
+            print("GeoServer catalog is up to date")
+        for phase, description, function, args in actions:
+            print(f"{'would ' if dry_run else ''}{description}")
+        if not dry_run:
+            for phase in sorted({action[0] for action in actions}):
+                jobs = {
+                    description: (function, *args)
+                    for (number, description, function, args) in actions
+                    if number == phase
+                }
+                self.server.parallel(lambda function, *args: function(*args), jobs)
+        return [action[1] for action in actions]
+
+
+class daemon:
+    """
+    Publishes each day's SNODAS data as soon as NOAA releases it, from one long-running process.
+
+    Shortly before the expected release (SNOSERVE_POLL_LEAD minutes before SNOSERVE_RELEASE), the
+    daemon starts checking whether the day's TAR file exists with HEAD requests. Checks that find
+    nothing are spaced out with jittered exponential backoff, from SNOSERVE_POLL_INTERVAL up to
+    SNOSERVE_POLL_MAX seconds. As soon as the file appears, the day is processed and published by
+    `process_date`. Days of the last `lookback` days that are not complete, e.g. because NOAA was
+    late or publishing failed, are retried the same way. Once every day is complete, the daemon
+    sleeps until the next release.
+
+    A day that fails validation (see `GTIFF.validate`) is recorded as rejected in its manifest,
+    with the hash and the Last-Modified (or ETag) header of its TAR file. It is not missing any
+    more, and is only processed again once NOAA publishes a different TAR file for it.
+
+    The downloader and the GeoServer sessions are created once and reused for every day.
+
+    Attributes:
+        workspace (str): The GeoServer workspace to publish to.
+        selection (iterable): The products to publish.
+        lookback (int): The number of days, including today, that are retried until complete.
+        root (str): The folder of the data and tmp folders, or None for the default. See `directory`.
+        tmp (str): The folder for downloads and scratch files, or None for the default. See `directory`.
+        settings (dict): Settings used instead of the environment variables of the same name.
+        gdalConfig (dict): GDAL configuration options for every day. See `directory`.
+        client (downloader): The downloader shared by every day.
+        verty (server): The server shared by every day, once the first day is published.
+        attempts (int): The number of checks in a row that found nothing new.
+    """
+
+    def __init__(
+        self,
+        workspace="SNODAS",
+        selection=("snowdepth", "swe"),
+        lookback=None,
+        root=None,
+        tmp=None,
+        settings=None,
+        gdal_config=None,
+    ):
+        """
+        Initializes the daemon.
+
+        Args:
+            workspace (str, optional): The GeoServer workspace to publish to. Defaults to "SNODAS".
+            selection (iterable, optional): The products to publish. Defaults to snowdepth and swe.
+            lookback (int, optional): The number of days, including today, that are retried until
+                complete. Defaults to SNOSERVE_LOOKBACK, or 7.
+            root (str, optional): The folder of the data and tmp folders. See `directory`.
+            tmp (str, optional): The folder for downloads and scratch files. See `directory`.
+            settings (dict, optional): Settings used instead of the environment variables of
+                the same name. See `directory`.
+            gdal_config (dict, optional): GDAL configuration options. See `directory`.
+        """
+        self.workspace = workspace
+        self.selection = selection
+        self.root = root
+        self.tmp = tmp
+        self.settings = dict(settings or {})
+        self.gdalConfig = dict(gdal_config or {})
+        self.lookback = int(lookback or env_number("SNOSERVE_LOOKBACK", 7, self.settings))
+        self.lead = env_number("SNOSERVE_POLL_LEAD", 10, self.settings) * 60
+        self.interval = env_number("SNOSERVE_POLL_INTERVAL", 60, self.settings)
+        self.max_interval = env_number("SNOSERVE_POLL_MAX", 900, self.settings)
+        self.client = downloader()
+        self.verty = None
+        self.attempts = 0
+
+    def folders(self, date):
+        """
+        Returns the directory object of a day, with the daemon's folders and settings.
+
+        Args:
+            date (dataDate): The day.
+
+        Returns:
+            directory: The directory object. Nothing is created on disk.
+        """
+        return directory(date, self.root, self.tmp, self.settings, self.gdalConfig)
+
+    def window(self, now=None):
+        """
+        Lists the days that should be published by now and are not complete, oldest first.
+
+        Today is included from SNOSERVE_POLL_LEAD minutes before its expected release.
+
+        Args:
+            now (datetime.datetime, optional): The current time. Defaults to now.
+
+        Returns:
+            list: The dataDate objects of the days.
+        """
+        now = now or datetime.now(pytz.timezone("US/Eastern"))
+        release = release_time(now, self.settings) - timedelta(seconds=self.lead)
+        latest = now if now >= release else now - timedelta(days=1)
+        dates = [dataDate(latest - timedelta(days=days)) for days in reversed(range(self.lookback))]
+        return [date for date in dates if not manifest(self.folders(date).manifest).done()]
+
+    def missing(self, now=None):
+        """
+        Lists the days that should be published but are not complete or rejected, oldest first.
+
+        Args:
+            now (datetime.datetime, optional): The current time. Defaults to now.
+
+        Returns:
+            list: The dataDate objects of the days. See `window`.
+        """
+        return [date for date in self.window(now) if "rejected" not in manifest(self.folders(date).manifest).load()]
+
+    def cycle(self, now=None):
+        """
+        Checks every missing or rejected day once and publishes the ones NOAA has released.
+
+        A rejected day is only processed again if the Last-Modified (or ETag) header of its TAR
+        file changed, or, if the server sends neither, if a conditional download of it brings a
+        TAR file with a different hash.
+
+        Args:
+            now (datetime.datetime, optional): The current time. Defaults to now.
+
+        Returns:
+            list: The date strings of the days published.
+        """
+        published = []
+        for date in self.window(now):
+            version = self.client.version(data_address(date, self.settings))
+            if version is None:
+                continue
+            rejected = manifest(self.folders(date).manifest).load().get("rejected")
+            if rejected is not None and version and rejected["inputs"]["version"] == version:
+                continue
+            current_data = file(date, self.folders(date), self.client)
+            try:
+                if rejected is not None and not version:
+                    current_data.download()
+                    if current_data.manifest.hash(current_data.dir.download) == rejected["inputs"]["source"]:
+                        continue
+                self.verty = process_date(current_data, self.verty, self.workspace, self.selection)
+                current_data.manifest.invalidate("rejected")
+                published.append(date.date_string)
+            except QualityError as error:
+                print(f"Publishing {date.date_string} failed: {error}")
+                inputs = {"source": current_data.manifest.hash(current_data.dir.download), "version": version}
+                current_data.manifest.record("rejected", inputs, status="failed", details={"error": str(error)})
+            except Exception as error:
+                print(f"Publishing {date.date_string} failed: {error}")
+            finally:
+                metrics = setting("SNOSERVE_METRICS_FILE", None, self.settings)
+                if metrics:
+                    instruments.export(metrics)
+                instruments.reset()
+        self.attempts = 0 if published else self.attempts + 1
+        return published
+
+    def wait(self, now=None):
+        """
+        Returns how long to sleep before the next cycle.
+
+        Args:
+            now (datetime.datetime, optional): The current time. Defaults to now.
+
+        Returns:
+            float: The number of seconds to sleep.
+        """
+        now = now or datetime.now(pytz.timezone("US/Eastern"))
+        if self.missing(now):
+            return min(self.max_interval, self.interval * 2 ** min(self.attempts, 16)) * uniform(0.5, 1)
+        start = release_time(now, self.settings) - timedelta(seconds=self.lead)
+        if now >= start:
+            start = release_time(now + timedelta(days=1), self.settings) - timedelta(seconds=self.lead)
+        return (start - now).total_seconds()
+
+    def run(self):
+        """
+        Publishes each day as it is released, forever.
+        """
+        while True:
+            self.cycle()
+            delay = self.wait()
+            print(f"Next check in {delay:.0f}s")
+            sleep(delay)
+
+
+class pipeline:
+    """
+    One run of the stages for one date, with its own folders, settings and connections.
+
+    Everything a run depends on is held by the pipeline instead of the process: its folders and
+    settings by its directory object (see `directory.setting`), its HTTP sessions by its
+    downloader and server, and its GDAL configuration options are set for the threads that
+    convert its products only (see `gdal_options`). Nothing changes the working directory or
+    `os.environ`, so several pipelines, for different dates, settings or output folders, can run
+    at once in the threads of one long-lived process. The stages hand their results to the next
+    stage in memory: `publish` uploads the files `convert` made.
+
+    Attributes:
+        date (dataDate): The date of the run.
+        dir (directory): The folders and settings of the run.
+        data (file): The file object that downloads and converts the date.
+        verty (server): The server to publish with, created by the first `publish`.
+        workspace (str): The GeoServer workspace to publish to.
+        selection (iterable): The products to publish.
+        tiffs (list): The converted GTIFF objects, once `convert` has run.
+    """
+
+    def __init__(
+        self,
+        date=None,
+        root=None,
+        tmp=None,
+        settings=None,
+        gdal_config=None,
+        client=None,
+        verty=None,
+        workspace="SNODAS",
+        selection=("snowdepth", "swe"),
+    ):
+        """
+        Initializes the pipeline.
+
+        Args:
+            date (dataDate or str, optional): The date, as a dataDate or in YYYYMMDD format.
+                Defaults to the latest date.
+            root (str, optional): The folder of the data folder. See `directory`.
+            tmp (str, optional): The folder for downloads and scratch files. See `directory`.
+            settings (dict, optional): Settings used instead of the environment variables of
+                the same name. See `directory`.
+            gdal_config (dict, optional): GDAL configuration options for the run. See `directory`.
+            client (downloader, optional): The downloader to use. Defaults to a new downloader.
+            verty (server, optional): The server to publish with. Defaults to a new server. A
+                server should not be shared by pipelines that run at the same time.
+            workspace (str, optional): The GeoServer workspace to publish to. Defaults to "SNODAS".
+            selection (iterable, optional): The products to publish. Defaults to snowdepth and swe.
+        """
+        self.date = date if isinstance(date, dataDate) else dataDate(date)
+        self.dir = directory(self.date, root, tmp, settings, gdal_config)
+        self.data = file(self.date, self.dir, client)
+        self.verty = verty
+        self.workspace = workspace
+        self.selection = selection
+        self.tiffs = None
+
+    def fetch(self):
+        """
+        Downloads the date's TAR file.
+
+        Returns:
+            bool: True if new data was downloaded. See `file.download`.
+        """
+        return self.data.download()
+
+    def convert(self):
+        """
+        Converts the downloaded date and derives its products. See `convert_date`.
+
+        Returns:
+            list: The converted GTIFF objects.
+
+        Raises:
+            Exception: If a product failed to convert.
+        """
+        self.tiffs = convert_date(self.data)
+        if self.data.errors:
+            raise Exception(f"Failed to convert {list(self.data.errors)}")
+        return self.tiffs
+
+    def publish(self):
+        """
+        Uploads and styles the converted products, and marks the date complete. See `publish_date`.
+
+        Returns:
+            dict: The responses of the uploads made, by layer name.
+
+        Raises:
+            Exception: If a product failed to publish. The date is then not marked complete.
+        """
+        if self.verty is None:
+            self.verty = server(self.dir)
+        self.verty.errors = {}
+        published = publish_date(self.data, self.verty, self.workspace, self.selection, self.tiffs)
+        if self.dir.setting("SNOSERVE_SEED", "0") == "1":
+            self.verty.warm_cache(list(published), self.workspace)
+        if self.verty.errors:
+            raise Exception(f"Failed to publish {list(self.verty.errors)}")
+        self.data.manifest.record("complete")
+        return published
+
+    def run(self):
+        """
+        Downloads, converts and publishes the date, and marks it complete. See `process_date`.
+
+        Returns:
+            server: The server the date was published with.
+        """
+        self.verty = process_date(self.data, self.verty, self.workspace, self.selection)
+        return self.verty
+
+    def status(self):
+        """
+        Reports which stages of the date have finished. See `date_status`.
+
+        Returns:
+            dict: The status of the date.
+        """
+        return date_status(self.date, self.dir.root)
+
+
+def process_date(current_data, verty=None, workspace="SNODAS", selection=("snowdepth", "swe")):
+    """
+    Downloads, converts and publishes one date, and marks it complete.
+
+    Args:
+        current_data (file): The file object of the date.
+        verty (server, optional): A server to publish with, reused from an earlier date. Defaults
+            to a new server.
+        workspace (str, optional): The GeoServer workspace to publish to. Defaults to "SNODAS".
+        selection (iterable, optional): The products to publish. Defaults to snowdepth and swe.
+
+    Returns:
+        server: The server the date was published with, to reuse for the next date.
+
+    Raises:
+        QualityError: If a product failed validation (see `GTIFF.validate`). Nothing of the date
+            is published then.
+        Exception: If a product failed to convert or publish. The date is then not marked complete.
+    """
+    dir = current_data.dir
+    current_data.download()
+    tiffs = convert_date(current_data)
+    if verty is None:
+        verty = server(dir)
+    verty.directory = dir
+    verty.errors = {}
+    published = publish_date(current_data, verty, workspace, selection, tiffs)
+    if dir.setting("SNOSERVE_SEED", "0") == "1":
+        verty.warm_cache(list(published), workspace)
+    if current_data.errors or verty.errors:
+        raise Exception(f"Failed to process {list(current_data.errors) + list(verty.errors)}")
+    current_data.manifest.record("complete")
+    return verty
+
+
+def convert_date(current_data):
+    """
+    Converts one downloaded date, derives its products and removes the files it no longer needs.
+
+    Args:
+        current_data (file): The file object of the date.
+
+    Returns:
+        list: The converted GTIFF objects.
+    """
+    tiffs = current_data.ingest()
+    current_data.derive(tiffs)
+    current_data.cleantemp()
+    current_data.clean_old_tar()
+    current_data.clean_old_data()
+    return tiffs
+
+
+def date_status(date, root=None):
+    """
+    Reports which stages of a date have finished, from its manifest.
+
+    Only reads the manifest file, so it is quick enough for health checks.
+
+    Args:
+        date (dataDate): The date.
+        root (str, optional): The folder holding the data folder. See `directory`.
+
+    Returns:
+        dict: The date string, whether the date is complete, and the time each finished stage
+        finished at, by stage name.
+    """
+    stages = manifest(directory(date, root).manifest).load()
+    return {
+        "date": date.date_string,
+        "complete": "complete" in stages,
+        "stages": {stage: record.get("finished") for stage, record in stages.items()},
+    }
+
+
+def publish_date(current_data, verty, workspace="SNODAS", selection=("snowdepth", "swe"), tiffs=None):
+    """
+    Uploads and styles the selected products of one date, skipping what is already published.
+
+    A layer is uploaded unless the same content was uploaded to the same place by an earlier run,
+    and the layers are styled unless neither the layers nor the styles changed since the last run
+    (see `manifest`). Nothing is published if a product of the date failed validation, or a
+    published product was never validated (see `GTIFF.validate`), unless SNOSERVE_QA is 0.
+    Products written with the vrt output profile can't be uploaded, so their layers are skipped
+    with a warning; their clipped and warped copies are still published.
+
+    Args:
+        current_data (file): The file object of the date.
+        verty (server): The server to publish with.
+        workspace (str, optional): The GeoServer workspace to publish to. Defaults to "SNODAS".
+        selection (iterable, optional): The products to publish. Defaults to snowdepth and swe.
+        tiffs (list, optional): The converted GTIFF objects of the date. Their GeoTIFF files, and
+            those of their regions and targets, are published without listing the data folder.
+            Layers that are not among them (e.g. derived products) are still looked up there.
+
+    Returns:
+        dict: The responses of the uploads made, by layer name.
+
+    Raises:
+        QualityError: If the date did not pass validation.
+    """
+    dir = current_data.dir
+    layers = dir.regionLayers(selection)
+    derived = parse_derived(dir.derivedProducts)
+    if dir.setting("SNOSERVE_QA", "1") != "0":
+        (failed, missing) = current_data.manifest.validation(
+            product for product in set(layers.values()) if product not in derived
+        )
+        if failed or missing:
+            raise QualityError(
+                f"Not publishing {current_data.date.date_string}: {failed} failed validation, {missing} were not validated."
+            )
+    for layer, product in list(layers.items()):
+        if layer == product and product not in derived and OUTPUT_PROFILES[dir.outputProfile(product)]["format"] == "VRT":
+            print(f"Skipping {layer}: products with the vrt output profile are not uploaded to GeoServer")
+            del layers[layer]
+    files = None
+    if tiffs is not None:
+        files = {}
+        for tiff in tiffs:
+            if tiff.rawPath is None:
+                files[tiff.name] = tiff.fullPath
+            files.update({f"{tiff.name}_{region}": clipped for region, clipped in tiff.regions.items()})
+            files.update({f"{tiff.name}_{target}": warped for target, warped in tiff.targets.items()})
+        for layer in layers:
+            if layer not in files and isfile(join(dir.finalData, f"{layer}.tif")):
+                files[layer] = join(dir.finalData, f"{layer}.tif")
+    published = verty.selective_upload(
+        workspace, dir.finalData, list(layers), manifest=current_data.manifest, files=files
+    )
+    styling = {
+        "host": verty.HOST,
+        "workspace": workspace,
+        "layers": layers,
+        "styles": {style: file_hash(join(dir.styles, f"{style}.sld")) for style in sorted(set(layers.values()))},
+    }
+    if published or not current_data.manifest.fresh("style", styling):
+        errors = len(verty.errors)
+        verty.style_types(list(layers), workspace, styles=layers)
+        if len(verty.errors) == errors:
+            current_data.manifest.record("style", styling)
+    return published
+
+
+def read_txt_vars(txt):
+    """
+    Read key-value pairs from a text file and store them in a dictionary.
+
+    Args:
+        txt (str): Path to the text file.
+
+    Returns:
+        dict: A dictionary containing the key-value pairs read from the file.
+    """
+    with open(txt) as varfile:
+        return parse_txt_vars(varfile)
+
+
+def parse_txt_vars(lines):
+    """
+    Parse key-value pairs from the lines of a text file and store them in a dictionary.
+
+    Args:
+        lines (iterable): The lines of the text file, each formatted as 'key: value'.
+
+    Returns:
+        dict: A dictionary containing the key-value pairs read from the lines.
+    """
+    variables = {}
+    for var in lines:
+        (key, val) = var.rstrip().split(": ")
+        variables[key] = val
+    return variables
+
+
+def parse_derived(txt):
+    """
+    Read the definitions of derived products from a text file such as derived.txt.
+
+    Each line is formatted as `<name>: <operation> <product> [days] [inches]`. See `derivedProducts`.
+
+    Args:
+        txt (str): Path to the text file. A missing file defines no products.
+
+    Returns:
+        dict: The definitions by output name, each a dict with the operation, product, number of
+        days and whether to convert to inches.
+
+    Raises:
+        ValueError: If a line has an unknown operation.
+    """
+    if not isfile(txt):
+        return {}
+    definitions = {}
+    for name, value in read_txt_vars(txt).items():
+        words = value.split()
+        if words[0] not in ("scaled", "inches", "change", "total"):
+            raise ValueError(f"Unknown operation {words[0]} for derived product {name}.")
+        definitions[name] = {
+            "operation": words[0],
+            "product": words[1],
+            "days": int(words[2]) if len(words) > 2 and words[2].isdigit() else 1,
+            "inches": words[-1] == "inches",
+        }
+    return definitions
+
+
+def parse_regions(txt):
+    """
+    Read the regions products are clipped to from a text file such as regions.txt.
+
+    Each line is formatted as `<name>: <west> <south> <east> <north>`, in degrees, or as
+    `<name>: <file>` with the path of a GeoJSON file holding the region's polygons, relative to
+    the text file. A polygon region is clipped to the box around it, then masked to its shape.
+
+    Args:
+        txt (str): Path to the text file. A missing file defines no regions.
+
+    Returns:
+        dict: The regions by name, each a dict with the `bounds` as [west, south, east, north]
+        and the `cutline` file, or None for a box.
+    """
+    if not isfile(txt):
+        return {}
+    regions = {}
+    for name, value in read_txt_vars(txt).items():
+        words = value.split()
+        if len(words) == 4:
+            regions[name] = {"bounds": [float(word) for word in words], "cutline": None}
+            continue
+        cutline = join(dirname(abspath(txt)), value.strip())
+        with open(cutline) as geojson:
+            points = list(geojson_points(json.load(geojson)))
+        longitudes = [point[0] for point in points]
+        latitudes = [point[1] for point in points]
+        regions[name] = {
+            "bounds": [min(longitudes), min(latitudes), max(longitudes), max(latitudes)],
+            "cutline": cutline,
+        }
+    return regions
+
+
+def parse_targets(txt, resampling=None):
+    """
+    Read the coordinate systems products are warped to from a text file such as targets.txt.
+
+    Each line is formatted as `<name>: <srs> [<resampling>]`, e.g. `3857: EPSG:3857 bilinear`.
+    The resampling method defaults to `resampling`.
+
+    Args:
+        txt (str): Path to the text file. A missing file defines no targets.
+        resampling (str, optional): The resampling method of targets that do not name one.
+            Defaults to the SNOSERVE_WARP_RESAMPLING environment variable, or "bilinear".
+
+    Returns:
+        dict: The targets by name, each a dict with the `srs` and the `resampling` method.
+    """
+    if not isfile(txt):
+        return {}
+    targets = {}
+    for name, value in read_txt_vars(txt).items():
+        words = value.split()
+        if len(words) not in (1, 2):
+            raise ValueError(f"Target {name} should be `<srs> [<resampling>]`, not {value!r}.")
+        method = words[1] if len(words) == 2 else resampling or getenv("SNOSERVE_WARP_RESAMPLING", "bilinear")
+        targets[name] = {"srs": words[0], "resampling": method}
+    return targets
+
+
+def geojson_points(geojson):
+    """
+    Yields every coordinate pair in a GeoJSON object.
+
+    Args:
+        geojson: A GeoJSON object, or any part of one.
+    """
+    if isinstance(geojson, dict):
+        for key, value in geojson.items():
+            if key in ("coordinates", "geometry", "geometries", "features"):
+                yield from geojson_points(value)
+    elif isinstance(geojson, list):
+        if len(geojson) >= 2 and all(isinstance(value, (int, float)) for value in geojson):
+            yield geojson[:2]
+        else:
+            for value in geojson:
+                yield from geojson_points(value)
+
+
+def scale_from_metadata(metadata):
+    """
+    Read how to convert the raw values of a SNODAS grid to physical units from its metadata.
+
+    Uses 'Data slope' and 'Data intercept' when present, otherwise the divisor in 'Data units'
+    (e.g., 'Meters / 1000.000000').
+
+    Args:
+        metadata (dict): The metadata read from the .txt file.
+
+    Returns:
+        tuple: The slope, the intercept and the base units (e.g., 'Meters').
+    """
+    (units, _, divisor) = metadata.get("Data units", "").partition(" / ")
+    slope = float(metadata.get("Data slope", 1 / float(divisor) if divisor else 1))
+    intercept = float(metadata.get("Data intercept", 0))
+    return (slope, intercept, units.strip())
+
+
+def mosaic_archive(local_path, granule, configure=False):
+    """
+    Build the ZIP file uploaded to GeoServer to create or add to an ImageMosaic store.
+
+    Args:
+        local_path (str): The local file path of the GeoTIFF.
+        granule (str): The file name of the GeoTIFF in the mosaic. Must contain the date in YYYYMMDD format.
+        configure (bool, optional): If True, adds the properties files that configure a new mosaic
+            with a TIME dimension taken from the date in the granule file names. Defaults to False.
+
+    Returns:
+        bytes: The content of the ZIP file.
+    """
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_STORED) as archive:
+        if configure:
+            for properties, content in MOSAIC_PROPERTIES.items():
+                archive.writestr(properties, content)
+        archive.write(local_path, granule)
+    return buffer.getvalue()
+
+
+def file_hash(file):
+    """
+    Computes the SHA-256 hash of a file, reading it in 1 MB blocks.
+
+    Args:
+        file (str): The path of the file.
+
+    Returns:
+        str: The hexadecimal hash.
+    """
+    digest = hashlib.sha256()
+    with open(file, "rb") as content:
+        for block in iter(lambda: content.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic(dest):
+    """
+    Writes a file under a temporary name and moves it into place once it is complete.
+
+    A crash or error while writing leaves no file at `dest`, or the previous one, never a half
+    written one.
+
+    Args:
+        dest (str): The path of the file.
+
+    Yields:
+        str: The temporary path to write to, `dest` with a .tmp suffix.
+    """
+    part = f"{dest}.tmp"
+    try:
+        yield part
+    except BaseException:
+        Path(part).unlink(missing_ok=True)
+        raise
+    replace(part, dest)
+
+
+def data_address(date, settings=None):
+    """
+    Returns the URL of the TAR file of a day, without creating anything for it.
+
+    Args:
+        date (dataDate): The day.
+        settings (dict, optional): Settings that take the place of the environment. See `setting`.
+
+    Returns:
+        str: The URL, under SNOSERVE_SOURCE.
+    """
+    source = setting("SNOSERVE_SOURCE", "https://noaadata.apps.nsidc.org/NOAA/G02158/unmasked", settings)
+    return f"{source}/{date.year}/{date.month}_{date.monthAbbrv}/SNODAS_unmasked_{date.year}{date.month}{date.day}.tar"
+
+
+def release_time(now, settings=None):
+    """
+    Returns when NOAA is expected to release the data of a day.
+
+    The time is set with SNOSERVE_RELEASE as HH:MM Eastern Time. Defaults to 09:15.
+
+    Args:
+        now (datetime.datetime): A time on the day, in Eastern Time.
+        settings (dict, optional): Settings that take the place of the environment. See `setting`.
+
+    Returns:
+        datetime.datetime: The expected release time of that day.
+    """
+    (hour, minute) = setting("SNOSERVE_RELEASE", "09:15", settings).split(":")
+    release = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    if hasattr(now.tzinfo, "localize"):
+        # A pytz time keeps the UTC offset of `now`, which is wrong on the other side of a DST change
+        return now.tzinfo.localize(release.replace(tzinfo=None))
+    return release
+
+
+def io_counters():
+    """
+    Reads the bytes the process has read and written so far, including sockets.
+
+    Returns:
+        tuple: The bytes read and written, or zeros where /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io") as counters:
+            values = dict(line.split(": ") for line in counters.read().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the process so far, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def prometheus_escape(value):
+    """
+    Escapes a label value for the Prometheus text format.
+
+    Args:
+        value: The label value.
+
+    Returns:
+        str: The escaped value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def gwc_address(host):
+    """
+    Derive the address of GeoWebCache's REST API from the GeoServer REST API address.
+
+    Args:
+        host (str): The GeoServer REST API address (e.g., http://localhost:8080/geoserver/rest).
+
+    Returns:
+        str: The GeoWebCache REST API address (e.g., http://localhost:8080/geoserver/gwc/rest).
+    """
+    if host is None:
+        return None
+    host = host.rstrip("/")
+    if host.endswith("/rest"):
+        host = host[: -len("/rest")]
+    return f"{host}/gwc/rest"
+
+
+def lonlat_to_mercator(longitude, latitude):
+    """
+    Project a longitude and latitude to Web Mercator (EPSG:3857) coordinates.
+
+    Args:
+        longitude (float): The longitude in degrees.
+        latitude (float): The latitude in degrees.
+
+    Returns:
+        list: The x and y coordinates in meters.
+    """
+    radius = 6378137.0
+    x = radius * math.radians(longitude)
+    y = radius * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+    return [x, y]
+
+
+def parse_path_map(mapping):
+    """
+    Parse a path mapping in the format 'local=remote;local=remote'.
+
+    Args:
+        mapping (str): The path mapping, e.g. from the SNOSERVE_PATH_MAP environment variable.
+
+    Returns:
+        list: (local prefix, remote prefix) pairs, in the order given.
+    """
+    pairs = []
+    for pair in mapping.split(";"):
+        if pair.strip():
+            (local, remote) = pair.split("=", 1)
+            pairs.append((local.strip(), remote.strip()))
+    return pairs
+
+
+def map_path(local_path, pairs):
+    """
+    Translate a path with the first matching (local prefix, remote prefix) pair.
+
+    Args:
+        local_path (str): The path to translate.
+        pairs (list): (local prefix, remote prefix) pairs from `parse_path_map`.
+
+    Returns:
+        str: The translated path, or `local_path` if no prefix matches.
+    """
+    for local, remote in pairs:
+        local = local.rstrip("/")
+        if local_path == local or local_path.startswith(f"{local}/"):
+            return remote.rstrip("/") + local_path[len(local) :]
+    return local_path
+
+
+def valid_tar(file):
+    """
+    Check that a file is a TAR file and that none of its members are cut off.
+
+    Args:
+        file (str): The path of the file.
+
+    Returns:
+        bool: True if the file is a complete TAR file with at least one member.
+    """
+    try:
+        with tarfile.open(file) as archive:
+            members = archive.getmembers()
+    except (OSError, tarfile.TarError):
+        return False
+    size = getsize(file)
+    return bool(members) and all(
+        member.offset_data + member.size <= size for member in members
+    )
+
+
+def env_number(name, default=None, settings=None):
+    """
+    Read a number from an environment variable.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (float, optional): The value to use if the variable is not set or empty.
+        settings (dict, optional): Settings that take the place of the environment. See `setting`.
+
+    Returns:
+        float: The value of the variable, or `default`.
+    """
+    value = setting(name, None, settings)
+    if not value:
+        return default
+    return float(value)
+
+
+def setting(name, default=None, settings=None):
+    """
+    Read a setting, from `settings` if it is there and from the environment otherwise.
+
+    Settings let several runs in one process (see `pipeline`) be configured differently without
+    changing `os.environ`, which every thread shares.
+
+    Args:
+        name (str): The name of the setting, the same as its environment variable.
+        default (str, optional): The value to use if the setting is not set.
+        settings (dict, optional): The settings of a run.
+
+    Returns:
+        str: The value of the setting.
+    """
+    if settings and name in settings:
+        return settings[name]
+    return getenv(name, default)
+
+
+@contextmanager
+def gdal_options(options):
+    """
+    Sets GDAL configuration options for the current thread only, and restores them afterwards.
+
+    Args:
+        options (dict): The configuration options (e.g. {"GDAL_CACHEMAX": "512"}). GDAL is not
+            touched when there are none.
+    """
+    if not options:
+        yield
+        return
+    previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, str(value))
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+def strip_extension(file):
+    """
+    Remove the first file extension from a file path or name.
+
+    Args:
+        file (str): The file path or name.
+
+    Returns:
+        str: The file name without the first extension.
+    """
+    return (path.basename(file)).rsplit(".", 1)[0]
+
+
+def datetime_from_str(string):
+    """
+    Convert a string in the format 'YYYYMMDD' to a datetime object in the US/Eastern timezone.
+
+    Args:
+        string (str): A string representing a date in the format 'YYYYMMDD'.
+
+    Returns:
+        datetime.datetime: A datetime object representing the input date in the US/Eastern timezone.
+    """
+    tz = pytz.timezone("US/Eastern")
+    date = datetime.strptime(string, "%Y%m%d").replace(tzinfo=tz)
+    return date
+
+
+def date_range(start, end=None):
+    """
+    List the dates from start to end, inclusive.
+
+    Args:
+        start (str): The first date in YYYYMMDD format.
+        end (str, optional): The last date in YYYYMMDD format. Defaults to the latest date with data available.
+
+    Returns:
+        list: A dataDate object for each day in the range.
+    """
+    first = datetime_from_str(start)
+    last = datetime_from_str(end) if end is not None else dataDate().latest_data
+    days = (last.date() - first.date()).days
+    return [dataDate(first + timedelta(days=day)) for day in range(days + 1)]
+
+
+def backfill(
+    start,
+    end=None,
+    downloads=2,
+    converts=1,
+    workers=None,
+    publish=False,
+    workspace="SNODAS",
+    selection=("snowdepth", "swe"),
+    root=None,
+    tmp=None,
+    settings=None,
+    gdal_config=None,
+):
+    """
+    Download and process every date in a range, for example to rebuild data after an outage.
+
+    Each date goes through download and conversion in its own thread. All dates share one
+    downloader, so their downloads reuse the same connections. The number of dates
+    downloading at once and the number of dates converting at once are limited separately, so
+    downloads for later dates overlap with the conversion of earlier ones. If `publish` is True,
+    the converted dates are then uploaded and styled in date order, so the latest date is the one
+    left in GeoServer. With the "mosaic" publish layout every date is kept as a time step instead.
+
+    A date is marked complete in its manifest (see `manifest`) once it has been published, or
+    converted when `publish` is False. Dates already marked so are skipped, so an interrupted
+    backfill resumes where it stopped when it is run again, and a date converted without
+    publishing is still published by a later backfill with `publish`. Once a date is marked, the
+    TAR and data caches are trimmed to their budgets (see `file.clean_old_tar` and
+    `file.clean_old_data`), keeping the converted dates that are still to be published.
+
+    Args:
+        start (str): The first date in YYYYMMDD format.
+        end (str, optional): The last date in YYYYMMDD format. Defaults to the latest date with data available.
+        downloads (int, optional): The number of dates to download at once. Defaults to 2.
+        converts (int, optional): The number of dates to convert at once. Defaults to 1.
+        workers (int, optional): The number of products converted at once within a date. See `file.convert()`.
+        publish (bool, optional): If True, uploads and styles the selected products. Defaults to False.
+        workspace (str, optional): The GeoServer workspace to publish to. Defaults to "SNODAS".
+        selection (iterable, optional): The products to publish. Defaults to snowdepth and swe.
+        root (str, optional): The folder to keep the data and tmp folders in. See `directory`.
+        tmp (str, optional): The folder for downloads and scratch files. See `directory`.
+        settings (dict, optional): Settings that take the place of environment variables. See `directory`.
+        gdal_config (dict, optional): GDAL configuration options. See `directory`.
+
+    Returns:
+        dict: The outcome for each date string: "complete", "converted", "skipped", or the
+        exception that stopped it.
+    """
+    # A date converted without publishing still needs publishing by a later backfill with publish
+    stage = "complete" if publish else "converted"
+    client = downloader(pool_size=downloads)
+    download_slots = BoundedSemaphore(downloads)
+    convert_slots = BoundedSemaphore(converts)
+    outcomes = {}
+    pending = []
+
+    def folders(date):
+        return directory(date, root, tmp, settings, gdal_config)
+
+    for date in date_range(start, end):
+        if manifest(folders(date).manifest).done(stage):
+            outcomes[date.date_string] = "skipped"
+        else:
+            pending.append(date)
+
+    def prepare(date):
+        current_data = file(date, folders(date), client)
+        with download_slots:
+            current_data.download()
+        with convert_slots:
+            tiffs = current_data.ingest(workers=workers)
+            current_data.derive(tiffs)
+        current_data.cleantemp()
+        if current_data.errors:
+            raise Exception(f"Failed to convert {list(current_data.errors)}")
+        return current_data
+
+    converted = []
+    with ThreadPoolExecutor(max_workers=max(1, downloads + converts)) as ex:
+        futures = [(date, ex.submit(prepare, date)) for date in pending]
+        for date, future in futures:
+            try:
+                converted.append(future.result())
+            except Exception as error:
+                print(f"Backfill of {date.date_string} failed: {error}")
+                outcomes[date.date_string] = error
+
+    verty = None
+    for index, current_data in enumerate(converted):
+        try:
+            if publish:
+                if verty is None:
+                    verty = server(current_data.dir)
+                verty.directory = current_data.dir
+                verty.errors = {}
+                publish_date(current_data, verty, workspace, selection)
+                if verty.errors:
+                    raise Exception(f"Failed to publish {list(verty.errors)}")
+            current_data.manifest.record(stage)
+            outcomes[current_data.date.date_string] = stage
+        except Exception as error:
+            print(f"Publishing {current_data.date.date_string} failed: {error}")
+            outcomes[current_data.date.date_string] = error
+            continue
+        unpublished = [later.date.date_string for later in converted[index + 1 :]]
+        current_data.clean_old_tar(keep=unpublished)
+        current_data.clean_old_data(keep=unpublished)
+    return outcomes
+
+
+def main(argv=None):
+    """
+    Runs a command from the command line.
+
+    GDAL, the GeoServer client and the other heavy modules are only imported by the commands that
+    use them (see `lazyModule`), so `status` returns in milliseconds.
+
+    Args:
+        argv (list, optional): The arguments. Defaults to the command line.
+
+    Returns:
+        int: The exit status: 1 if `status` finds the date incomplete, otherwise 0.
+    """
+    parser = ArgumentParser(description="Retrieve, process and publish SNODAS data.")
+    commands = parser.add_subparsers(dest="command")
+    rooted = ArgumentParser(add_help=False)
+    rooted.add_argument("--root", help="Folder of the data folder. Defaults to the folder of snoserve.py.")
+    rooted.add_argument("--tmp", help="Folder for downloads and scratch files, e.g. on a tmpfs. Defaults to tmp in the root.")
+    dated = ArgumentParser(add_help=False, parents=[rooted])
+    dated.add_argument("--date", help="Date to work on, YYYYMMDD. Defaults to the latest date.")
+    commands.add_parser("run", parents=[dated], help="Download, convert and publish a date (the default).")
+    commands.add_parser("fetch", parents=[dated], help="Download a date.")
+    commands.add_parser("convert", parents=[dated], help="Convert a downloaded date.")
+    commands.add_parser("publish", parents=[dated], help="Upload and style a converted date.")
+    status = commands.add_parser("status", parents=[dated], help="Print which stages of a date have finished.")
+    status.add_argument("--json", action="store_true", help="Print the status as JSON.")
+    fill = commands.add_parser("backfill", parents=[rooted], help="Process every date in a range.")
+    fill.add_argument("start", help="First date, YYYYMMDD.")
+    fill.add_argument("end", nargs="?", help="Last date, YYYYMMDD. Defaults to the latest date.")
+    fill.add_argument("--downloads", type=int, default=2, help="Dates to download at once.")
+    fill.add_argument("--converts", type=int, default=1, help="Dates to convert at once.")
+    fill.add_argument("--workers", type=int, help="Products to convert at once within a date.")
+    fill.add_argument("--publish", action="store_true", help="Upload and style each date.")
+    sync = commands.add_parser("sync", parents=[dated], help="Bring the GeoServer workspace, styles and default styles up to date.")
+    sync.add_argument("--dry-run", action="store_true", help="Print the planned changes without making them.")
+    history = commands.add_parser("history", parents=[rooted], help="Print the history of a product at a point.")
+    history.add_argument("product", help="Product with a cube, e.g. swe.")
+    history.add_argument("longitude", type=float)
+    history.add_argument("latitude", type=float)
+    history.add_argument("--start", help="First date, YYYYMMDD.")
+    history.add_argument("--end", help="Last date, YYYYMMDD.")
+    watch = commands.add_parser("daemon", parents=[rooted], help="Keep running and publish each day as soon as NOAA releases it.")
+    watch.add_argument("--lookback", type=int, help="Days, including today, to retry until complete.")
+    args = parser.parse_args(argv)
+    date = dataDate(getattr(args, "date", None))
+    try:
+        if args.command == "status":
+            report = date_status(date, args.root)
+            if args.json:
+                print(json.dumps(report))
+            else:
+                print(f"{report['date']}: {'complete' if report['complete'] else 'incomplete'}")
+                for stage, finished in report["stages"].items():
+                    print(f"  {stage}: {datetime.fromtimestamp(finished).isoformat(timespec='seconds')}")
+            return 0 if report["complete"] else 1
+        if args.command == "history":
+            series = cube(join(directory(date, args.root, args.tmp).cubes, args.product))
+            (dates, values) = series.point(args.longitude, args.latitude, args.start, args.end)
+            for date_string, value in zip(dates, values):
+                print(f"{date_string}: {value}")
+            print(json.dumps(series.stats(args.longitude, args.latitude, args.start, args.end)))
+            return 0
+        if args.command == "sync":
+            dir = directory(date, args.root, args.tmp)
+            layers = dir.regionLayers(["snowdepth", "swe"])
+            server(dir).style_types(list(layers), dry_run=args.dry_run, styles=layers)
+            return 0
+        if args.command == "backfill":
+            outcomes = backfill(
+                args.start,
+                args.end,
+                downloads=args.downloads,
+                converts=args.converts,
+                workers=args.workers,
+                publish=args.publish,
+                root=args.root,
+                tmp=args.tmp,
+            )
+            for date_string, outcome in outcomes.items():
+                print(f"{date_string}: {outcome}")
+            return 0
+
+        if args.command == "daemon":
+            daemon(lookback=args.lookback, root=args.root, tmp=args.tmp).run()
+            return 0
+
+        run = pipeline(date, getattr(args, "root", None), getattr(args, "tmp", None))
+        if args.command == "fetch":
+            run.fetch()
+        elif args.command == "convert":
+            run.convert()
+        elif args.command == "publish":
+            run.publish()
+        else:
+            run.run()
+        return 0
+    finally:
+        if getenv("SNOSERVE_METRICS_FILE"):
+            instruments.export()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,16 +1,103 @@
+import gzip
+import hashlib
+import io
+import json
+import subprocess
+import sys
+import tarfile
 import unittest
-from os.path import exists
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, listdir, urandom
+from os.path import exists, join
+from pathlib import Path
+from shutil import rmtree
+from tempfile import TemporaryDirectory, mkdtemp
+from threading import Thread
+from time import time
+from urllib.parse import urlparse
+from zipfile import ZipFile
 
-from snoserve import dataDate, directory, file, server
+import numpy as np
+from pytz import timezone
+
+from benchmark import benchmark, synthetic_tar
+from snoserve import (
+    GTIFF,
+    GeoServerError,
+    QualityError,
+    atomic,
+    backfill,
+    cache,
+    cube,
+    daemon,
+    dataDate,
+    date_range,
+    derivedProducts,
+    directory,
+    downloader,
+    file,
+    gwc_address,
+    instrumentation,
+    instruments,
+    manifest,
+    main,
+    map_path,
+    mosaic_archive,
+    palette,
+    parse_derived,
+    parse_path_map,
+    parse_regions,
+    parse_targets,
+    parse_txt_vars,
+    pipeline,
+    scale_from_metadata,
+    server,
+    valid_tar,
+)
+
+try:
+    from osgeo import gdal, osr
+
+    gdal.VersionInfo()
+except (ImportError, AttributeError):
+    gdal = None
+
+
+def write_grid(path, grid, nodata=-9999, bounds=(-120.0, 40.0, -117.0, 42.0)):
+    """Write a grid to a GeoTIFF in WGS84 covering `bounds` (west, south, east, north)."""
+    (rows, columns) = grid.shape
+    types = {np.dtype("int16"): gdal.GDT_Int16, np.dtype("float32"): gdal.GDT_Float32}
+    dataset = gdal.GetDriverByName("GTiff").Create(path, columns, rows, 1, types[grid.dtype.newbyteorder("=")])
+    (west, south, east, north) = bounds
+    dataset.SetGeoTransform([west, (east - west) / columns, 0.0, north, 0.0, -(north - south) / rows])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).SetNoDataValue(nodata)
+    dataset.GetRasterBand(1).WriteArray(grid.astype(grid.dtype.newbyteorder("=")))
+    dataset = None
 
 
 class TestSNOserve(unittest.TestCase):
     def setUp(self):
+        self.environ = dict(environ)
+        environ.setdefault("GEOSERVER_ADDRESS", "http://localhost:8600/geoserver/rest")
+        environ.setdefault("GEOSERVER_USERNAME", "admin")
+        environ.setdefault("GEOSERVER_PASS", "geoserver")
+        self.root = TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
         self.date = dataDate()
-        self.file = file(self.date)
-        self.directory = directory(self.date)
+        self.directory = directory(self.date, self.root.name)
+        self.file = file(self.date, self.directory)
         # self.gTiff = GTIFF("test_file", self.directory)
-        self.server = server()
+        self.server = server(self.directory)
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
 
     def test_dataDate(self):
         self.assertIsNotNone(self.date.latest_data)
@@ -44,5 +131,1295 @@ class TestSNOserve(unittest.TestCase):
         self.assertIsNotNone(self.server.geoserver)
 
 
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_tar(self):
+        tmp = mkdtemp()
+        try:
+            tar = join(tmp, "SNODAS_unmasked_20240115.tar")
+            synthetic_tar(tar, "20240115", scale=0.01)
+            names = directory(dataDate()).finalNames
+            with tarfile.open(tar) as archive:
+                members = archive.getnames()
+                self.assertEqual(len(members), 2 * len(names))
+                for member in members:
+                    if member.endswith(".txt.gz"):
+                        content = gzip.decompress(archive.extractfile(member).read()).decode()
+                        metadata = parse_txt_vars(content.splitlines())
+                        self.assertIn(metadata["Description"], names)
+                        (columns, rows) = (int(metadata["Number of columns"]), int(metadata["Number of rows"]))
+                        self.assertEqual((columns, rows), (69, 34))
+                        dat = archive.extractfile(member.replace(".txt.gz", ".dat.gz")).read()
+                        grid = np.frombuffer(gzip.decompress(dat), dtype=">i2").reshape(rows, columns)
+                        self.assertEqual(grid[0, 0], -9999)
+                        self.assertGreater(grid.max(), 0)
+        finally:
+            rmtree(tmp)
+
+    def test_publish_leaves_environment(self):
+        with TemporaryDirectory() as root:
+            run = benchmark(root)
+            dir = directory(run.date, root)
+            dir.create()
+            for name in ["snowdepth", "swe"]:
+                Path(dir.finalData, f"{name}.tif").write_bytes(name.encode())
+            saved = dict(environ)
+            self.assertEqual(set(run.publish(dir)), {"snowdepth", "swe"})
+            self.assertEqual(dict(environ), saved)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.environ = dict(environ)
+        environ["SNOSERVE_METRICS_LOG"] = join(self.tmp, "metrics.jsonl")
+        self.instruments = instrumentation()
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        rmtree(self.tmp)
+
+    def test_stage(self):
+        with self.instruments.stage("extractGZ") as record:
+            Path(self.tmp, "out").write_bytes(b"x" * 100000)
+        with self.assertRaises(ValueError):
+            with self.instruments.stage("process", product="swe"):
+                raise ValueError("bad grid")
+        (ok, failed) = self.instruments.records
+        self.assertIs(ok, record)
+        self.assertEqual(ok["outcome"], "ok")
+        self.assertGreaterEqual(ok["written_bytes"], 100000)
+        self.assertGreater(ok["peak_rss_bytes"], 0)
+        self.assertEqual(failed["outcome"], "error")
+        self.assertEqual(failed["error"], "ValueError: bad grid")
+        with open(join(self.tmp, "metrics.jsonl")) as log:
+            lines = [json.loads(line) for line in log]
+        self.assertEqual([line["stage"] for line in lines], ["extractGZ", "process"])
+
+    def test_export(self):
+        self.instruments.add(
+            [
+                {"stage": "process", "labels": {"product": "swe"}, "outcome": "ok", "wall_seconds": 2.0,
+                 "cpu_seconds": 1.0, "read_bytes": 10, "written_bytes": 20, "peak_rss_bytes": 1000},
+                {"stage": "process", "labels": {"product": "swe"}, "outcome": "error", "wall_seconds": 1.0,
+                 "cpu_seconds": 1.0, "read_bytes": 10, "written_bytes": 20, "peak_rss_bytes": 3000},
+            ]
+        )
+        textfile = join(self.tmp, "snoserve.prom")
+        self.instruments.export(textfile)
+        with open(textfile) as prom:
+            text = prom.read()
+        self.assertIn('snoserve_stage_duration_seconds{product="swe",stage="process"} 3.0', text)
+        self.assertIn('snoserve_stage_peak_rss_bytes{product="swe",stage="process"} 3000.0', text)
+        self.assertIn('snoserve_stage_success{product="swe",stage="process"} 0.0', text)
+        self.assertIn("# TYPE snoserve_stage_runs gauge", text)
+
+    def test_cprofile(self):
+        environ["SNOSERVE_CPROFILE"] = join(self.tmp, "profiles")
+        with self.instruments.stage("download"):
+            sum(range(1000))
+        self.assertEqual(len(list(Path(self.tmp, "profiles").glob("download-*.prof"))), 1)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.directory = directory(dataDate())
+        self.metadata = parse_txt_vars(
+            [
+                "Description: Modeled snow water equivalent, total of snow layers\n",
+                "Number of columns: 6935\n",
+                "Number of rows: 3351\n",
+            ]
+        )
+
+    def test_parse_txt_vars(self):
+        self.assertEqual(self.metadata["Number of columns"], "6935")
+        self.assertEqual(self.metadata["Number of rows"], "3351")
+
+    def test_archive_source(self):
+        tiff = GTIFF("swe", self.directory, metadata=self.metadata, archive="/tmp/x.tar")
+        self.assertEqual(tiff.dat, f"/vsimem/{self.directory.name}/swe.dat")
+        vrt = tiff.stringVRT()
+        self.assertIn(f'<SourceFilename relativeToVRT="0">/vsimem/{self.directory.name}/swe.dat', vrt)
+        self.assertIn("<LineOffset>13870</LineOffset>", vrt)
+        self.assertIn("<ByteOrder>MSB</ByteOrder>", vrt)
+
+    def test_vrt_profile(self):
+        tmp = mkdtemp()
+        self.addCleanup(rmtree, tmp)
+        grid = np.arange(6, dtype=">i2").reshape(2, 3)
+        archive = join(tmp, "x.tar")
+        with tarfile.open(archive, "w") as tar:
+            member = tarfile.TarInfo("swe.dat.gz")
+            data = gzip.compress(grid.tobytes())
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+        metadata = {
+            "Number of columns": "3",
+            "Number of rows": "2",
+            "Minimum x-axis coordinate": "-120.0",
+            "Maximum x-axis coordinate": "-117.0",
+            "Minimum y-axis coordinate": "40.0",
+            "Maximum y-axis coordinate": "42.0",
+            "No data value": "-9999",
+        }
+        data = directory(dataDate(), tmp)
+        Path(data.finalData).mkdir(parents=True)
+        tiff = GTIFF("swe", data, metadata=metadata, archive=archive)
+        tiff.process(data, "swe", profile="vrt")
+        self.assertEqual(tiff.fullPath, join(data.finalData, "swe.vrt"))
+        self.assertEqual(Path(tiff.rawPath).read_bytes(), grid.tobytes())
+        vrt = Path(tiff.fullPath).read_text()
+        self.assertIn('<SourceFilename relativeToVRT="1">swe.dat</SourceFilename>', vrt)
+        self.assertIn("<GeoTransform>-120.0, 1.0, 0.0, 42.0, 0.0, -1.0</GeoTransform>", vrt)
+        self.assertIn("<NoDataValue>-9999.0</NoDataValue>", vrt)
+        self.assertIn("EPSG:4326", vrt)
+        self.assertEqual(tiff.source(), tiff.fullPath)
+        restored = GTIFF("swe", data, metadata=metadata)
+        restored.restore(data, "swe", "vrt", {})
+        self.assertEqual((restored.fullPath, restored.rawPath), (tiff.fullPath, tiff.rawPath))
+
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.environ = dict(environ)
+        self.grid = np.full((40, 30), -9999, dtype=">i2")
+        self.grid[5:35, 3:27] = np.arange(720).reshape(30, 24)
+        self.metadata = {"Number of columns": "30", "Number of rows": "40", "No data value": "-9999"}
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        rmtree(self.tmp)
+
+    def streamed(self, data):
+        archive = join(self.tmp, "x.tar")
+        Path(archive).write_bytes(make_tar({"swe.dat.gz": gzip.compress(data)}))
+        tiff = GTIFF("swe", directory(dataDate(), self.tmp), metadata=self.metadata, archive=archive)
+        tiff.name = "swe"
+        return tiff
+
+    def extracted(self, data):
+        Path(self.tmp, "swe.dat").write_bytes(data)
+        tiff = GTIFF("swe", directory(dataDate()), metadata=self.metadata)
+        tiff.dat = join(self.tmp, "swe.dat")
+        tiff.name = "swe"
+        return tiff
+
+    def test_statistics(self):
+        values = self.grid[self.grid != -9999].astype(float)
+        for tiff in (self.streamed(self.grid.tobytes()), self.extracted(self.grid.tobytes())):
+            stats = tiff.statistics(buckets=10)
+            self.assertEqual((stats["minimum"], stats["maximum"]), (0.0, 719.0))
+            self.assertAlmostEqual(stats["mean"], values.mean())
+            self.assertAlmostEqual(stats["stddev"], values.std())
+            self.assertAlmostEqual(stats["nodata"], 1 - 720 / 1200)
+            self.assertEqual(stats["histogram"]["counts"], [72] * 10)
+            self.assertEqual((stats["histogram"]["min"], stats["histogram"]["max"]), (-0.5, 719.5))
+
+    def test_truncated(self):
+        for tiff in (self.streamed(self.grid.tobytes()[:-60]), self.extracted(self.grid.tobytes()[:-60])):
+            with self.assertRaises(QualityError):
+                tiff.validate()
+
+    def test_inflates_once(self):
+        tiff = self.streamed(self.grid.tobytes())
+        tiff.validate()
+        self.assertEqual(tiff.buffer, self.grid.tobytes())
+        self.assertFalse(exists(join(self.tmp, "tmp")))
+        tiff.release()
+        self.assertIsNone(tiff.buffer)
+        Path(self.tmp, "x.tar").write_bytes(make_tar({"swe.dat.gz": gzip.compress(self.grid.tobytes())[:-60]}))
+        tiff = GTIFF("swe", directory(dataDate(), self.tmp), metadata=self.metadata, archive=join(self.tmp, "x.tar"))
+        with self.assertRaisesRegex(QualityError, "truncated"):
+            tiff.validate()
+
+    def test_thresholds(self):
+        empty = np.full((40, 30), -9999, dtype=">i2").tobytes()
+        with self.assertRaisesRegex(QualityError, "no data"):
+            self.streamed(empty).validate()
+        environ["SNOSERVE_QA_MAX_NODATA"] = "0.3"
+        with self.assertRaisesRegex(QualityError, "40.0%"):
+            self.streamed(self.grid.tobytes()).validate()
+        environ["SNOSERVE_QA"] = "0"
+        self.assertEqual(self.streamed(empty).validate()["nodata"], 1.0)
+
+    def test_failure_is_recorded(self):
+        dir = directory(dataDate("20240101"), self.tmp)
+        data = file(dataDate("20240101"), dir)
+        empty = np.full((40, 30), -9999, dtype=">i2").tobytes()
+        Path(dir.download).write_bytes(make_tar({"swe.dat.gz": gzip.compress(empty)}))
+        metadata = {**self.metadata, "Description": "Modeled snow water equivalent, total of snow layers"}
+        tiff = GTIFF("swe", dir, metadata=metadata, archive=dir.download)
+        self.assertEqual(data.convert([tiff], workers=1), [])
+        self.assertIsInstance(data.errors["swe"], QualityError)
+        self.assertEqual(data.manifest.validation(["swe"]), (["swe"], []))
+        record = data.manifest.load()["validate/swe"]
+        self.assertEqual((record["status"], record["details"]["statistics"]["nodata"]), ("failed", 1.0))
+
+    def test_aux(self):
+        tiff = self.streamed(self.grid.tobytes())
+        tiff.statistics()
+        tiff.fullPath = join(self.tmp, "swe.tif")
+        aux = Path(tiff.createAUX()).read_text()
+        self.assertIn('<MDI key="STATISTICS_MAXIMUM">719.0</MDI>', aux)
+        self.assertIn('<MDI key="STATISTICS_VALID_PERCENT">60.0</MDI>', aux)
+        self.assertIn("<BucketCount>256</BucketCount>", aux)
+        self.assertIn('<PAMRasterBand band="1">', aux)
+
+
+@unittest.skipUnless(gdal, "GDAL is not installed")
+class TestGDAL(unittest.TestCase):
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.dir = directory(dataDate("20240101"), self.root.name)
+        Path(self.dir.finalData).mkdir(parents=True)
+        self.grid = np.full((40, 30), -9999, dtype=">i2")
+        self.grid[5:35, 3:27] = np.arange(720).reshape(30, 24)
+        self.metadata = {
+            "Number of columns": "30",
+            "Number of rows": "40",
+            "Minimum x-axis coordinate": "-120.0",
+            "Maximum x-axis coordinate": "-117.0",
+            "Minimum y-axis coordinate": "40.0",
+            "Maximum y-axis coordinate": "44.0",
+            "No data value": "-9999",
+        }
+        archive = join(self.root.name, "x.tar")
+        Path(archive).write_bytes(make_tar({"swe.dat.gz": gzip.compress(self.grid.tobytes())}))
+        self.tiff = GTIFF("swe", self.dir, metadata=self.metadata, archive=archive)
+        self.tiff.name = "swe"
+        self.addCleanup(self.tiff.release)
+
+    def read(self, path, band=1):
+        dataset = gdal.Open(path)
+        return dataset.GetRasterBand(band).ReadAsArray()
+
+    def test_process(self):
+        stats = self.tiff.validate()
+        self.tiff.process(self.dir, "swe", profile="cog")
+        aux = self.tiff.createAUX()
+        self.assertEqual(aux, join(self.dir.finalData, "swe.tif.aux.xml"))
+        dataset = gdal.Open(self.tiff.fullPath)
+        self.assertEqual(dataset.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE"), "COG")
+        np.testing.assert_allclose(dataset.GetGeoTransform(), [-120.0, 0.1, 0.0, 44.0, 0.0, -0.1])
+        band = dataset.GetRasterBand(1)
+        np.testing.assert_array_equal(band.ReadAsArray(), self.grid)
+        self.assertEqual(band.GetNoDataValue(), -9999)
+        # GDAL takes the statistics from the .aux.xml file instead of computing them
+        np.testing.assert_allclose(
+            band.GetStatistics(False, False), [stats["minimum"], stats["maximum"], stats["mean"], stats["stddev"]]
+        )
+        dataset = None
+        self.assertFalse(exists(self.dir.tmp))
+
+    def test_process_extracted(self):
+        Path(self.dir.extract).mkdir(parents=True)
+        tiff = GTIFF("swe", self.dir, metadata=self.metadata)
+        Path(tiff.dat).write_bytes(self.grid.tobytes())
+        tiff.createHDR()
+        self.assertEqual(tiff.validate()["maximum"], 719.0)
+        tiff.process(self.dir, "swe", profile="gtiff")
+        np.testing.assert_array_equal(self.read(tiff.fullPath), self.grid)
+
+    def test_clip(self):
+        path = self.tiff.clip(self.dir, "swe", "box", {"bounds": [-119.75, 41.0, -118.5, 42.55]}, profile="gtiff")
+        self.assertEqual(path, join(self.dir.finalData, "swe_box.tif"))
+        dataset = gdal.Open(path)
+        np.testing.assert_allclose(dataset.GetGeoTransform(), [-119.8, 0.1, 0.0, 42.6, 0.0, -0.1])
+        np.testing.assert_array_equal(dataset.GetRasterBand(1).ReadAsArray(), self.grid[14:30, 2:15])
+        self.assertEqual(self.tiff.regions, {"box": path})
+
+    def test_warp(self):
+        self.tiff.process(self.dir, "swe", profile="gtiff")
+        path = self.tiff.warp(self.dir, "swe", "3857", {"srs": "EPSG:3857", "resampling": "near"}, profile="gtiff")
+        self.assertEqual(path, join(self.dir.finalData, "swe_3857.tif"))
+        dataset = gdal.Open(path)
+        srs = osr.SpatialReference(wkt=dataset.GetProjection())
+        self.assertEqual(srs.GetAuthorityCode(None), "3857")
+        band = dataset.GetRasterBand(1)
+        self.assertEqual(band.GetNoDataValue(), -9999)
+        values = band.ReadAsArray()
+        self.assertTrue(np.isin(values, self.grid).all())
+        self.assertEqual(self.tiff.targets, {"3857": path})
+
+    def test_colorize(self):
+        self.tiff.process(self.dir, "swe", profile="gtiff")
+        colors = palette(join(self.dir.colortables, "swe.txt"), -9999)
+        grid = self.grid.astype(np.int16)
+        path = self.tiff.colorize(self.dir, mode="palette")
+        self.assertEqual(path, join(self.dir.finalData, "swe_color.tif"))
+        dataset = gdal.Open(path)
+        self.assertEqual(dataset.RasterCount, 1)
+        self.assertEqual(dataset.GetRasterBand(1).GetRasterColorTable().GetCount(), len(colors.colors))
+        np.testing.assert_array_equal(dataset.GetRasterBand(1).ReadAsArray(), colors.indices(grid))
+        dataset = None
+        path = self.tiff.colorize(self.dir, output_file=join(self.dir.finalData, "swe_rgba.tif"), mode="rgba")
+        pixels = np.stack([self.read(path, band) for band in range(1, 5)], axis=-1)
+        np.testing.assert_array_equal(pixels, colors.rgba(grid))
+
+
+class TestConvert(unittest.TestCase):
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.date = dataDate()
+        self.file = file(self.date, directory(self.date, self.root.name))
+
+    def missing(self, description):
+        metadata = {"Description": description}
+        return GTIFF("missing", self.file.dir, metadata=metadata, archive="/nonexistent.tar")
+
+    def test_errors_do_not_stop_batch(self):
+        tiffs = [
+            self.missing("Modeled snow water equivalent, total of snow layers"),
+            self.missing("Modeled snow layer thickness, total of snow layers"),
+        ]
+        results = self.file.convert(tiffs, workers=2, executor="thread")
+        self.assertEqual(results, [])
+        self.assertEqual(set(self.file.errors), {"swe", "snowdepth"})
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.manifest = manifest(join(self.tmp, ".manifest.json"))
+        self.output = join(self.tmp, "swe.tif")
+        Path(self.output).write_bytes(b"swe")
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_fresh(self):
+        self.assertFalse(self.manifest.fresh("convert/swe", {"profile": "cog"}))
+        self.manifest.record("convert/swe", {"profile": "cog"}, [self.output])
+        self.assertTrue(self.manifest.fresh("convert/swe", {"profile": "cog"}))
+        self.assertFalse(self.manifest.fresh("convert/swe", {"profile": "gtiff"}))
+        self.assertEqual(self.manifest.hash(self.output), hashlib.sha256(b"swe").hexdigest())
+        Path(self.output).write_bytes(b"swe")
+        self.assertTrue(self.manifest.fresh("convert/swe", {"profile": "cog"}))
+        Path(self.output).write_bytes(b"SWE")
+        self.assertFalse(self.manifest.fresh("convert/swe", {"profile": "cog"}))
+        self.assertEqual(self.manifest.signature(self.output), hashlib.sha256(b"SWE").hexdigest())
+        Path(self.output).unlink()
+        self.assertEqual(self.manifest.hash(self.output), hashlib.sha256(b"swe").hexdigest())
+        self.assertFalse(self.manifest.fresh("convert/swe", {"profile": "cog"}))
+
+    def test_extract_only_stale_products(self):
+        dir = directory(dataDate("20240101"), self.tmp, settings={"SNOSERVE_INGEST": "extract", "SNOSERVE_CUBE": ""})
+        data = file(dataDate("20240101"), dir)
+        txt = "Description: Modeled snow water equivalent, total of snow layers\nNo data value: -9999\n"
+        members = {"us_ssmv11034.txt.gz": gzip.compress(txt.encode()), "us_ssmv11034.dat.gz": gzip.compress(b"")}
+        Path(dir.download).write_bytes(make_tar(members))
+        (tiff,) = data.readTiffs(stream=False)
+        converted = join(dir.finalData, "swe.tif")
+        Path(converted).write_bytes(b"swe")
+        data.manifest.record("convert/swe", data.convertInputs(tiff, "swe"), [converted])
+        data.manifest.record("validate/swe", data.validateInputs(tiff))
+        (result,) = data.ingest(workers=1)
+        self.assertEqual(result.fullPath, converted)
+        self.assertFalse(exists(tiff.dat))
+        Path(converted).write_bytes(b"new")
+        data.ingest(workers=1)
+        self.assertTrue(exists(tiff.dat))
+
+    def test_done_and_invalidate(self):
+        self.manifest.record("publish/swe")
+        self.manifest.record("complete")
+        self.assertTrue(self.manifest.done())
+        self.assertEqual(self.manifest.invalidate("complete"), ["complete"])
+        self.assertFalse(self.manifest.done())
+        self.assertTrue(self.manifest.fresh("publish/swe"))
+
+    def test_atomic(self):
+        with self.assertRaises(RuntimeError):
+            with atomic(self.output) as part:
+                Path(part).write_bytes(b"half")
+                raise RuntimeError("crash")
+        self.assertEqual(Path(self.output).read_bytes(), b"swe")
+        self.assertFalse(exists(f"{self.output}.tmp"))
+        with atomic(self.output) as part:
+            Path(part).write_bytes(b"new")
+        self.assertEqual(Path(self.output).read_bytes(), b"new")
+
+    def test_convert_skips_fresh_products(self):
+        dir = directory(dataDate("20240101"), self.tmp)
+        data = file(dataDate("20240101"), dir)
+        metadata = {"Description": "Modeled snow water equivalent, total of snow layers", "No data value": "-9999"}
+        tiff = GTIFF("us_ssmv11034", dir, metadata=metadata, archive=join(self.tmp, "missing.tar"))
+        converted = join(dir.finalData, "swe.tif")
+        Path(converted).write_bytes(b"swe")
+        data.manifest.record("convert/swe", data.convertInputs(tiff, "swe"), [converted])
+        data.manifest.record("validate/swe", data.validateInputs(tiff))
+        environ["SNOSERVE_CUBE"] = ""
+        try:
+            (result,) = data.convert([tiff], workers=1)
+        finally:
+            del environ["SNOSERVE_CUBE"]
+        self.assertEqual(data.errors, {})
+        self.assertEqual((result.fullPath, result.name), (converted, "swe"))
+        # A product that can't be set up for conversion does not stop the others
+        unknown = GTIFF("us_ssmv99999", dir, metadata={"Description": "Unknown"}, archive=join(self.tmp, "missing.tar"))
+        environ["SNOSERVE_CUBE"] = ""
+        try:
+            self.assertEqual(data.convert([unknown, tiff], workers=1), [result])
+        finally:
+            del environ["SNOSERVE_CUBE"]
+        self.assertEqual(list(data.errors), ["us_ssmv99999.dat.gz"])
+        # A changed output profile makes the conversion stale
+        dir.outputProfiles = {"swe": "tiled"}
+        self.assertEqual(data.convert([tiff], workers=1), [])
+        self.assertIn("swe", data.errors)
+
+
+class TestOutputProfiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = directory(dataDate())
+
+    def test_configured_profile(self):
+        self.directory.outputProfiles = {"swe": "cog"}
+        self.assertEqual(self.directory.outputProfile("swe"), "cog")
+        self.assertEqual(self.directory.outputProfile("temp"), "gtiff")
+
+    def test_unknown_profile(self):
+        self.directory.outputProfiles = {"swe": "jpeg"}
+        with self.assertRaises(ValueError):
+            self.directory.outputProfile("swe")
+
+
+class TestBackfill(unittest.TestCase):
+    def test_dataDate_from_string(self):
+        date = dataDate("20240229")
+        self.assertEqual(date.date_string, "20240229")
+        self.assertEqual(date.monthAbbrv, "Feb")
+
+    def test_date_range(self):
+        dates = [date.date_string for date in date_range("20231230", "20240102")]
+        self.assertEqual(dates, ["20231230", "20231231", "20240101", "20240102"])
+
+    def test_skips_complete_dates(self):
+        with TemporaryDirectory() as root:
+            dir = directory(dataDate("19990101"), root)
+            dir.create()
+            manifest(dir.manifest).record("complete")
+            self.assertEqual(backfill("19990101", "19990101", root=root), {"19990101": "skipped"})
+
+    def test_converted_dates_still_publish(self):
+        with TemporaryDirectory() as root:
+            dir = directory(dataDate("19990103"), root)
+            dir.create()
+            manifest(dir.manifest).record("converted")
+            self.assertEqual(backfill("19990103", "19990103", root=root), {"19990103": "skipped"})
+            self.assertFalse(manifest(dir.manifest).done())
+            manifest(dir.manifest).record("complete")
+            self.assertTrue(manifest(dir.manifest).done("converted"))
+
+
+class TestCommands(unittest.TestCase):
+    def test_import_is_lazy(self):
+        script = (
+            "import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import snoserve\n"
+            "print(time.perf_counter() - start)\n"
+            "print(' '.join(m for m in ('osgeo', 'geoserver', 'numpy', 'requests', 'pytz') if m in sys.modules))\n"
+        )
+        # The first import also compiles the module, so the second one is timed
+        for _ in range(2):
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        (seconds, heavy) = output.split("\n")[:2]
+        self.assertEqual(heavy, "")
+        self.assertLess(float(seconds), 0.25)
+
+    def test_status(self):
+        with TemporaryDirectory() as root:
+            dir = directory(dataDate("19990102"), root)
+            self.assertEqual(main(["status", "--date", "19990102", "--root", root]), 1)
+            manifest(dir.manifest).record("download")
+            manifest(dir.manifest).record("complete")
+            self.assertEqual(main(["status", "--date", "19990102", "--json", "--root", root]), 0)
+
+    def test_history_reads_root(self):
+        with TemporaryDirectory() as root:
+            metadata = {
+                "Number of rows": "2",
+                "Number of columns": "2",
+                "Minimum x-axis coordinate": "-112",
+                "Maximum x-axis coordinate": "-111.8",
+                "Minimum y-axis coordinate": "40",
+                "Maximum y-axis coordinate": "40.2",
+                "No data value": "-9999",
+                "Data units": "Meters / 1000.000000",
+            }
+            grid = np.array([[100, 200], [300, 400]], dtype=np.int16)
+            cube(join(directory(dataDate(), root).cubes, "swe")).extend("20240101", metadata, lambda row, count: grid[row : row + count])
+            output = io.StringIO()
+            with redirect_stdout(output):
+                self.assertEqual(main(["history", "swe", "-111.85", "40.05", "--root", root]), 0)
+            self.assertEqual(output.getvalue().splitlines()[0], "20240101: 0.4")
+
+
+def make_tar(members):
+    """Build an in-memory TAR file from a dict of member names and contents."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class TarHandler(BaseHTTPRequestHandler):
+    """Stands in for the NOAA server: supports Range, ETag and a truncated first response."""
+
+    body = b""
+    etag = '"v1"'
+    truncate = False
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+        else:
+            self.send_response(200)
+        data = self.body[start:]
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        if type(self).truncate:
+            type(self).truncate = False
+            self.wfile.write(data[: len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200 if self.body else 404)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloader(unittest.TestCase):
+    def setUp(self):
+        TarHandler.body = make_tar({"a.dat.gz": urandom(300000), "a.txt.gz": urandom(1000)})
+        TarHandler.truncate = False
+        TarHandler.requests = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), TarHandler)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/SNODAS.tar"
+        self.tmp = mkdtemp()
+        self.dest = join(self.tmp, "SNODAS.tar")
+        self.client = downloader(retries=2, backoff=0)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        rmtree(self.tmp)
+
+    def test_download(self):
+        self.assertTrue(self.client.fetch(self.url, self.dest))
+        self.assertEqual(Path(self.dest).read_bytes(), TarHandler.body)
+        self.assertFalse(exists(f"{self.dest}.part"))
+
+    def test_resumes_truncated_download(self):
+        TarHandler.truncate = True
+        self.assertTrue(self.client.fetch(self.url, self.dest))
+        self.assertEqual(Path(self.dest).read_bytes(), TarHandler.body)
+        self.assertEqual(len(TarHandler.requests), 2)
+        self.assertIn("Range", TarHandler.requests[1])
+
+    def test_existing_download_is_reused(self):
+        self.client.fetch(self.url, self.dest)
+        self.assertFalse(self.client.fetch(self.url, self.dest))
+        self.assertEqual(len(TarHandler.requests), 1)
+
+    def test_revalidate(self):
+        self.client.fetch(self.url, self.dest)
+        self.client.revalidate = True
+        self.assertFalse(self.client.fetch(self.url, self.dest))
+        self.assertEqual(TarHandler.requests[1].get("If-None-Match"), TarHandler.etag)
+
+    def test_truncated_tar_is_invalid(self):
+        Path(self.dest).write_bytes(TarHandler.body[:100000])
+        self.assertFalse(valid_tar(self.dest))
+        self.client.fetch(self.url, self.dest)
+        self.assertEqual(Path(self.dest).read_bytes(), TarHandler.body)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.environ = dict(environ)
+        environ["SNOSERVE_RELEASE"] = "09:15"
+        environ["SNOSERVE_POLL_LEAD"] = "10"
+        self.daemon = daemon(lookback=3, root=self.tmp)
+        self.eastern = timezone("US/Eastern")
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        rmtree(self.tmp)
+
+    def complete(self, *dates):
+        for date in dates:
+            manifest(directory(dataDate(date), self.tmp).manifest).record("complete")
+
+    def test_missing(self):
+        before = self.eastern.localize(datetime(2024, 1, 10, 8, 0))
+        during = self.eastern.localize(datetime(2024, 1, 10, 9, 10))
+        self.complete("20240108")
+        self.assertEqual([date.date_string for date in self.daemon.missing(before)], ["20240107", "20240109"])
+        self.assertEqual([date.date_string for date in self.daemon.missing(during)], ["20240109", "20240110"])
+
+    def test_wait(self):
+        self.complete("20240108", "20240109", "20240110")
+        after = self.eastern.localize(datetime(2024, 1, 10, 10, 0))
+        # Everything is published: sleep until 9:05 the next day
+        self.assertEqual(self.daemon.wait(after), 23 * 3600 + 5 * 60)
+        during = self.eastern.localize(datetime(2024, 1, 11, 9, 10))
+        self.daemon.attempts = 3
+        self.assertTrue(240 <= self.daemon.wait(during) <= 480)
+        self.daemon.attempts = 20
+        self.assertLessEqual(self.daemon.wait(during), 900)
+
+    def test_wait_across_dst(self):
+        self.complete("20240307", "20240308", "20240309")
+        # Clocks go forward on March 10: 9:05 EDT is 22 hours of real time after 10:00 EST
+        after = self.eastern.localize(datetime(2024, 3, 9, 10, 0))
+        self.assertEqual(self.daemon.wait(after), 22 * 3600 + 5 * 60)
+
+    def test_available(self):
+        TarHandler.body = b"tar"
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), TarHandler)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{httpd.server_port}/SNODAS.tar"
+            self.assertTrue(self.daemon.client.available(url))
+            TarHandler.body = b""
+            self.assertFalse(self.daemon.client.available(url))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertFalse(self.daemon.client.available(url))
+
+    def test_unreleased_days_create_nothing(self):
+        watch = daemon(lookback=2, root=self.tmp, settings={"SNOSERVE_SOURCE": "http://127.0.0.1:9"})
+        self.assertEqual(watch.cycle(self.eastern.localize(datetime(2024, 1, 10, 10, 0))), [])
+        self.assertEqual(listdir(self.tmp), [])
+
+    def test_rejected_days_wait_for_a_new_tar(self):
+        TarHandler.body = make_tar({"a.dat.gz": urandom(1000), "a.txt.gz": urandom(100)})
+        TarHandler.etag = '"v1"'
+        self.addCleanup(setattr, TarHandler, "etag", '"v1"')
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), TarHandler)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        source = {"SNOSERVE_SOURCE": f"http://127.0.0.1:{httpd.server_port}", "SNOSERVE_LOOKBACK": "1"}
+        watch = daemon(root=self.tmp, settings=source)
+        self.assertEqual(watch.lookback, 1)
+        now = self.eastern.localize(datetime(2024, 1, 10, 10, 0))
+        dir = watch.folders(dataDate("20240110"))
+        manifest(dir.manifest).record("rejected", {"source": None, "version": '"v1"'}, status="failed")
+        self.assertEqual(watch.missing(now), [])
+        self.assertEqual(watch.cycle(now), [])
+        self.assertFalse(exists(dir.download))
+        # A new TAR file that fails validation is rejected in turn
+        txt = "Description: Modeled snow water equivalent, total of snow layers\nNumber of columns: 3\nNumber of rows: 2\nNo data value: -9999\n"
+        empty = np.full((2, 3), -9999, dtype=">i2").tobytes()
+        TarHandler.body = make_tar({"swe.txt.gz": gzip.compress(txt.encode()), "swe.dat.gz": gzip.compress(empty)})
+        TarHandler.etag = '"v2"'
+        self.assertEqual(watch.cycle(now), [])
+        self.assertTrue(exists(dir.download))
+        rejected = manifest(dir.manifest).load()["rejected"]
+        self.assertEqual(rejected["inputs"]["version"], '"v2"')
+        self.assertIn("failed validation", rejected["details"]["error"])
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        TarHandler.body = make_tar({"a.dat.gz": urandom(1000), "a.txt.gz": urandom(100)})
+        TarHandler.truncate = False
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), TarHandler)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.tmp = mkdtemp()
+        self.environ = dict(environ)
+        environ.pop("SNOSERVE_OUTPUT_PROFILE", None)
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        rmtree(self.tmp)
+
+    def test_concurrent_runs(self):
+        source = {"SNOSERVE_SOURCE": f"http://127.0.0.1:{self.httpd.server_port}"}
+        runs = [
+            pipeline("20240101", join(self.tmp, "a"), join(self.tmp, "scratch"), settings=source),
+            pipeline("20240102", join(self.tmp, "b"), settings={**source, "SNOSERVE_OUTPUT_PROFILE": "cog"}),
+        ]
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            self.assertEqual(list(ex.map(lambda run: run.fetch(), runs)), [True, True])
+        self.assertEqual(Path(self.tmp, "scratch", "SNODAS-20240101.tar").read_bytes(), TarHandler.body)
+        self.assertEqual(Path(self.tmp, "b", "tmp", "SNODAS-20240102.tar").read_bytes(), TarHandler.body)
+        self.assertEqual([run.dir.outputProfile("temp") for run in runs], ["gtiff", "cog"])
+        self.assertEqual(dict(environ), {key: value for key, value in self.environ.items() if key != "SNOSERVE_OUTPUT_PROFILE"})
+        self.assertEqual(runs[0].status()["stages"].keys(), {"download"})
+
+    def test_settings(self):
+        run = pipeline("20240101", self.tmp, settings={"SNOSERVE_FORCE": "1", "GEOSERVER_ADDRESS": "http://example/rest"})
+        run.data.manifest.record("download")
+        self.assertFalse(run.data.manifest.fresh("download"))
+        self.assertTrue(manifest(run.dir.manifest).fresh("download"))
+        self.assertEqual(server(run.dir).HOST, "http://example/rest")
+        self.assertEqual(run.dir.forDate(dataDate("20240102")).settings, run.dir.settings)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.index = join(self.tmp, "cache.json")
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def fill(self, store, dates):
+        for count, date in enumerate(dates):
+            folder = Path(self.tmp, date)
+            folder.mkdir()
+            (folder / "swe.tif").write_bytes(b"x" * 100)
+            store.add(f"{date}/swe", str(folder / "swe.tif"), date)
+            entries = store.load()
+            entries[f"{date}/swe"]["accessed"] = 1000 + count
+            store.save(entries)
+
+    def test_lru(self):
+        store = cache(self.index, max_bytes=200)
+        self.fill(store, ["20240103", "20240101", "20240102"])
+        self.assertEqual(list(store.evict()), ["20240103/swe"])
+        self.assertFalse(exists(join(self.tmp, "20240103")))
+        self.assertIsNone(store.get("20240103/swe"))
+        self.assertIsNotNone(store.get("20240101/swe"))
+
+    def test_clean_old_data_keeps_dates(self):
+        settings = {"SNOSERVE_DATA_CACHE_BYTES": "100"}
+        data = file(dataDate("20240103"), directory(dataDate("20240103"), self.tmp, settings=settings))
+        for date in ["20240101", "20240102", "20240103"]:
+            folder = directory(dataDate(date), self.tmp).finalData
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            Path(folder, "swe.tif").write_bytes(b"x" * 100)
+            data.rasters.add(f"{date}/swe", join(folder, "swe.tif"), date)
+        self.assertEqual(list(data.clean_old_data(keep=["20240102"])), ["20240101/swe"])
+
+    def test_clean_old_data_by_default(self):
+        data = file(dataDate("20240103"), directory(dataDate("20240103"), self.tmp))
+        for date in ["20240101", "20240102"]:
+            folder = directory(dataDate(date), self.tmp).finalData
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            Path(folder, "swe.tif").write_bytes(b"x" * 100)
+            data.rasters.add(f"{date}/swe", join(folder, "swe.tif"), date)
+        entries = data.rasters.load()
+        entries["20240101/swe"]["accessed"] = time() - 31 * 86400
+        data.rasters.save(entries)
+        self.assertEqual(list(data.clean_old_data()), ["20240101/swe"])
+        self.assertFalse(exists(directory(dataDate("20240101"), self.tmp).finalData))
+
+    def test_oldest(self):
+        store = cache(self.index, max_bytes=200, policy="oldest")
+        self.fill(store, ["20240103", "20240101", "20240102"])
+        self.assertEqual(list(store.evict()), ["20240101/swe"])
+
+    def test_age_and_keep(self):
+        store = cache(self.index, max_days=1)
+        self.fill(store, ["20240101", "20240102"])
+        self.assertEqual(list(store.evict(keep=["20240102"])), ["20240101/swe"])
+        self.assertEqual(list(store.load()), ["20240102/swe"])
+
+
+class TestMosaic(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.tif = join(self.tmp, "swe.tif")
+        Path(self.tif).write_bytes(b"tiff")
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_new_mosaic(self):
+        archive = ZipFile(io.BytesIO(mosaic_archive(self.tif, "swe_20240101.tif", configure=True)))
+        self.assertEqual(
+            sorted(archive.namelist()),
+            ["indexer.properties", "swe_20240101.tif", "timeregex.properties"],
+        )
+        self.assertEqual(archive.read("swe_20240101.tif"), b"tiff")
+
+    def test_granule(self):
+        archive = ZipFile(io.BytesIO(mosaic_archive(self.tif, "swe_20240101.tif")))
+        self.assertEqual(archive.namelist(), ["swe_20240101.tif"])
+
+
+class TestPathMap(unittest.TestCase):
+    def test_parse(self):
+        pairs = parse_path_map("/srv/snoserve/data=/opt/geoserver/snodas; /mnt/a = /b")
+        self.assertEqual(pairs, [("/srv/snoserve/data", "/opt/geoserver/snodas"), ("/mnt/a", "/b")])
+        self.assertEqual(parse_path_map(""), [])
+
+    def test_map(self):
+        pairs = parse_path_map("/srv/data/=/opt/snodas")
+        self.assertEqual(map_path("/srv/data/SNODAS-20240101/swe.tif", pairs), "/opt/snodas/SNODAS-20240101/swe.tif")
+        self.assertEqual(map_path("/srv/database/swe.tif", pairs), "/srv/database/swe.tif")
+
+    def test_mosaic_granule(self):
+        tmp = mkdtemp()
+        try:
+            dir = directory(dataDate("20240101"))
+            dir.data = tmp
+            tif = join(tmp, "swe.tif")
+            Path(tif).write_bytes(b"tiff")
+            granule = dir.mosaicGranule("swe", "swe_20240101.tif", tif)
+            self.assertEqual(granule, join(tmp, "mosaic", "swe", "swe_20240101.tif"))
+            self.assertEqual(Path(granule).read_bytes(), b"tiff")
+            self.assertTrue(exists(join(tmp, "mosaic", "swe", "timeregex.properties")))
+        finally:
+            rmtree(tmp)
+
+
+class TestCube(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.metadata = {
+            "Number of rows": "10",
+            "Number of columns": "7",
+            "Minimum x-axis coordinate": "-112",
+            "Maximum x-axis coordinate": "-111.3",
+            "Minimum y-axis coordinate": "40",
+            "Maximum y-axis coordinate": "41",
+            "No data value": "-9999",
+            "Data units": "Meters / 1000.000000",
+        }
+        self.grids = {}
+        self.cube = cube(join(self.tmp, "swe"), chunk=(4, 4, 3))
+        # Appended out of order, across two files of 4 time steps
+        for day in [3, 1, 2, 5, 4, 6]:
+            grid = (np.arange(70, dtype=np.int16).reshape(10, 7) + 100 * day).astype(np.int16)
+            grid[0, 0] = -9999
+            self.grids[f"202401{day:02d}"] = grid
+            self.cube.extend(f"202401{day:02d}", self.metadata, lambda row, count, grid=grid: grid[row : row + count])
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_point(self):
+        (dates, values) = cube(join(self.tmp, "swe")).point(-111.55, 40.25, start="20240102", end="20240105")
+        self.assertEqual(dates, ["20240102", "20240103", "20240104", "20240105"])
+        # Row 7, column 4
+        np.testing.assert_allclose(values, [(53 + 100 * day) / 1000 for day in [2, 3, 4, 5]])
+
+    def test_window(self):
+        (dates, values) = self.cube.window(2, 1, rows=5, columns=5)
+        self.assertEqual(len(dates), 6)
+        for position, date in enumerate(dates):
+            np.testing.assert_allclose(values[position], self.grids[date][2:7, 1:6] / 1000)
+        (dates, values) = self.cube.window(0, 0)
+        self.assertTrue(np.isnan(values).all())
+        with self.assertRaises(ValueError):
+            self.cube.window(9, 0, rows=2)
+
+    def test_overwrite_and_stats(self):
+        grid = np.full((10, 7), 1000, dtype=np.int16)
+        self.cube.extend("20240103", self.metadata, lambda row, count: grid[row : row + count])
+        self.assertEqual(len(self.cube.load()["dates"]), 6)
+        stats = self.cube.stats(-111.55, 40.25)
+        self.assertEqual(stats["days"], 6)
+        self.assertEqual(stats["peak"], "20240103")
+        self.assertAlmostEqual(stats["max"], 1.0)
+        self.assertAlmostEqual(stats["latest"], 0.653)
+        self.assertEqual(stats["latestDate"], "20240106")
+
+
+class TestRegions(unittest.TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.directory = directory(dataDate())
+        metadata = {
+            "Number of columns": "6935",
+            "Number of rows": "3351",
+            "Minimum x-axis coordinate": "-124.733749999999",
+            "Maximum x-axis coordinate": "-66.9420833333342",
+            "Minimum y-axis coordinate": "24.9495833333335",
+            "Maximum y-axis coordinate": "52.8745833333323",
+        }
+        self.tiff = GTIFF("swe", self.directory, metadata=metadata, archive="/tmp/x.tar")
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_parse(self):
+        polygon = {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[[-111, 43], [-110.5, 44.2], [-110, 43], [-111, 43]]]}}
+        Path(self.tmp, "tetons.geojson").write_text(json.dumps({"type": "FeatureCollection", "features": [polygon]}))
+        Path(self.tmp, "regions.txt").write_text("wasatch: -112 40 -111 41.5\ntetons: tetons.geojson\n")
+        regions = parse_regions(join(self.tmp, "regions.txt"))
+        self.assertEqual(regions["wasatch"], {"bounds": [-112.0, 40.0, -111.0, 41.5], "cutline": None})
+        self.assertEqual(regions["tetons"]["bounds"], [-111, 43, -110, 44.2])
+        self.assertEqual(regions["tetons"]["cutline"], join(self.tmp, "tetons.geojson"))
+        self.assertEqual(parse_regions(join(self.tmp, "missing.txt")), {})
+
+    def test_window(self):
+        (window, extent) = self.tiff.window([-112, 40, -111, 41.5])
+        self.assertEqual(window, [1528, 1364, 121, 181])
+        # Widened to whole pixels, so the extent covers the box by less than one pixel per side
+        for edge, bound in zip(extent, [-112, 41.5, -111, 40]):
+            self.assertLess(abs(edge - bound), 1 / 120)
+        self.assertTrue(extent[0] <= -112 and extent[1] >= 41.5 and extent[2] >= -111 and extent[3] <= 40)
+        (window, extent) = self.tiff.window([-130, 50, -120, 60])
+        self.assertEqual(window[:2], [0, 0])
+        with self.assertRaises(ValueError):
+            self.tiff.window([0, 0, 1, 1])
+
+    def test_layers(self):
+        self.directory.regions = {"wasatch": {"bounds": [-112, 40, -111, 41.5], "cutline": None}}
+        self.assertEqual(
+            self.directory.regionLayers(["swe"]), {"swe": "swe", "swe_wasatch": "swe"}
+        )
+
+    def test_targets(self):
+        Path(self.tmp, "targets.txt").write_text("3857: EPSG:3857 average\n5070: EPSG:5070\n")
+        targets = parse_targets(join(self.tmp, "targets.txt"))
+        self.assertEqual(targets["3857"], {"srs": "EPSG:3857", "resampling": "average"})
+        self.assertEqual(targets["5070"], {"srs": "EPSG:5070", "resampling": "bilinear"})
+        self.assertEqual(parse_targets(join(self.tmp, "missing.txt")), {})
+        self.directory.targets = targets
+        self.assertEqual(self.directory.regionLayers(["swe"])["swe_3857"], "swe")
+        self.assertEqual(self.directory.layerSRS("swe_3857"), "EPSG:3857")
+        self.assertIsNone(self.directory.layerSRS("swe"))
+
+
+class GeoServerHandler(BaseHTTPRequestHandler):
+    """Stands in for the GeoServer REST API, recording every request."""
+
+    requests = []
+    existing = {}
+    fail = set()
+
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        type(self).requests.append((self.command, path, body, dict(self.headers)))
+        if path in self.fail:
+            status = 500
+        elif self.command == "GET":
+            status = 200 if path in self.existing else 404
+        else:
+            status = 201
+        body = self.existing.get(path, b"") if self.command == "GET" else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        GeoServerHandler.requests = []
+        GeoServerHandler.existing = {}
+        GeoServerHandler.fail = set()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), GeoServerHandler)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.environ = dict(environ)
+        environ["GEOSERVER_ADDRESS"] = f"http://127.0.0.1:{self.httpd.server_port}/geoserver/rest"
+        environ["GEOSERVER_USERNAME"] = "admin"
+        environ["GEOSERVER_PASS"] = "geoserver"
+        self.server = server(directory(dataDate()))
+        self.tmp = mkdtemp()
+        for name in ["snowdepth", "swe", "temp"]:
+            Path(self.tmp, f"{name}.tif").write_bytes(name.encode())
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        rmtree(self.tmp)
+
+    def sent(self, method):
+        return {path: body for (command, path, body, headers) in GeoServerHandler.requests if command == method}
+
+    def test_selective_upload(self):
+        self.server.selective_upload("SNODAS", self.tmp, ["snowdepth", "swe"])
+        self.assertEqual(
+            self.sent("PUT"),
+            {
+                "/geoserver/rest/workspaces/SNODAS/coveragestores/snowdepth/file.geotiff": b"snowdepth",
+                "/geoserver/rest/workspaces/SNODAS/coveragestores/swe/file.geotiff": b"swe",
+            },
+        )
+        self.assertTrue(all("Authorization" in request[3] for request in GeoServerHandler.requests))
+
+    def test_upload_skips_published(self):
+        record = manifest(join(self.tmp, ".manifest.json"))
+        self.assertEqual(set(self.server.selective_upload("SNODAS", self.tmp, ["snowdepth", "swe"], manifest=record)), {"snowdepth", "swe"})
+        GeoServerHandler.requests = []
+        Path(self.tmp, "swe.tif").write_bytes(b"new swe")
+        self.assertEqual(set(self.server.selective_upload("SNODAS", self.tmp, ["snowdepth", "swe"], manifest=record)), {"swe"})
+        self.assertEqual(list(self.sent("PUT")), ["/geoserver/rest/workspaces/SNODAS/coveragestores/swe/file.geotiff"])
+
+    def test_publish_marks_complete(self):
+        run = pipeline("19990104", self.tmp)
+        for name in ["snowdepth", "swe"]:
+            Path(run.dir.finalData, f"{name}.tif").write_bytes(name.encode())
+            run.data.manifest.record(f"validate/{name}")
+        self.assertFalse(run.status()["complete"])
+        run.publish()
+        self.assertTrue(run.status()["complete"])
+
+    def test_publish_blocks_failed_validation(self):
+        run = pipeline("19990105", self.tmp)
+        for name in ["snowdepth", "swe"]:
+            Path(run.dir.finalData, f"{name}.tif").write_bytes(name.encode())
+        run.data.manifest.record("validate/snowdepth")
+        with self.assertRaisesRegex(QualityError, r"\['swe'\] were not validated"):
+            run.publish()
+        run.data.manifest.record("validate/swe", status="failed", details={"passed": False})
+        with self.assertRaisesRegex(QualityError, r"\['swe'\] failed validation"):
+            run.publish()
+        self.assertEqual(self.sent("PUT"), {})
+        environ["SNOSERVE_QA"] = "0"
+        run.publish()
+        self.assertTrue(run.status()["complete"])
+
+    def test_publish_skips_vrt_products(self):
+        run = pipeline("19990106", self.tmp)
+        run.dir.outputProfiles = {"snowdepth": "gtiff", "swe": "vrt"}
+        for name in ["snowdepth", "swe"]:
+            Path(run.dir.finalData, f"{name}.tif").write_bytes(name.encode())
+            run.data.manifest.record(f"validate/{name}")
+        run.publish()
+        self.assertEqual([path for path in self.sent("PUT") if "swe" in path], [])
+        self.assertTrue(run.status()["complete"])
+
+    def test_upload_given_files(self):
+        files = {"swe": join(self.tmp, "swe.tif"), "temp": join(self.tmp, "temp.tif")}
+        results = self.server.selective_upload("SNODAS", join(self.tmp, "missing"), ["swe", "snowdepth"], files=files)
+        self.assertEqual(list(results), ["swe"])
+
+    def test_upload_declares_target_srs(self):
+        self.server.directory.targets = {"3857": {"srs": "EPSG:3857", "resampling": "bilinear"}}
+        Path(self.tmp, "swe_3857.tif").write_bytes(b"swe")
+        self.server.selective_upload("SNODAS", self.tmp, ["swe", "swe_3857"])
+        coverages = {path: body for path, body in self.sent("PUT").items() if "/coverages/" in path}
+        self.assertEqual(
+            list(coverages), ["/geoserver/rest/workspaces/SNODAS/coveragestores/swe_3857/coverages/swe_3857"]
+        )
+        self.assertIn(b"<srs>EPSG:3857</srs>", list(coverages.values())[0])
+
+    def test_style_data(self):
+        self.server.style_data("swe", "swe")
+        with open(join(self.server.directory.styles, "swe.sld"), "rb") as sld:
+            self.assertEqual(self.sent("POST"), {"/geoserver/rest/styles": sld.read()})
+        self.assertEqual(
+            self.sent("PUT"),
+            {"/geoserver/rest/layers/SNODAS:swe": b"<layer><defaultStyle><name>swe</name></defaultStyle></layer>"},
+        )
+
+    def test_style_stages(self):
+        start = len(instruments.records)
+        self.server.style_data("swe", "swe")
+        stages = [record["stage"] for record in instruments.records[start:]]
+        self.assertEqual(stages, ["default_style", "style_data"])
+
+    def test_existing_style_is_not_uploaded(self):
+        GeoServerHandler.existing["/geoserver/rest/styles/swe.json"] = b"{}"
+        self.server.style_data("swe", "swe")
+        self.assertEqual(self.sent("POST"), {})
+
+    def test_errors_do_not_stop_batch(self):
+        GeoServerHandler.fail.add("/geoserver/rest/workspaces/SNODAS/coveragestores/swe/file.geotiff")
+        results = self.server.selective_upload("SNODAS", self.tmp, ["snowdepth", "swe"])
+        self.assertEqual(list(results), ["snowdepth"])
+        self.assertIsInstance(self.server.errors["swe"], GeoServerError)
+        self.assertEqual(self.server.errors["swe"].status, 500)
+
+    def sld(self, name):
+        with open(join(self.server.directory.styles, f"{name}.sld"), "rb") as sld:
+            return sld.read()
+
+    def test_sync_empty_catalog(self):
+        plan = self.server.style_types(["snowdepth", "swe"])
+        self.assertEqual(
+            plan,
+            ["create workspace SNODAS", "create style snowdepth", "create style swe"],
+        )
+        self.assertIn("/geoserver/rest/workspaces", self.sent("POST"))
+        self.assertNotIn("PUT", {request[0] for request in GeoServerHandler.requests})
+
+    def test_sync_only_changes_what_differs(self):
+        rest = "/geoserver/rest"
+        GeoServerHandler.existing.update(
+            {
+                f"{rest}/workspaces/SNODAS.json": b"{}",
+                f"{rest}/styles/swe.json": b"{}",
+                f"{rest}/styles/swe.sld": self.sld("swe"),
+                f"{rest}/styles/snowdepth.json": b"{}",
+                f"{rest}/styles/snowdepth.sld": b"<old/>",
+                f"{rest}/layers/SNODAS:swe.json": b'{"layer": {"defaultStyle": {"name": "swe"}}}',
+                f"{rest}/layers/SNODAS:snowdepth.json": b'{"layer": {"defaultStyle": {"name": "raster"}}}',
+            }
+        )
+        plan = self.server.style_types(["snowdepth", "swe"])
+        self.assertEqual(plan, ["update style snowdepth", "set default style of snowdepth to snowdepth"])
+        self.assertEqual(
+            set(self.sent("PUT")),
+            {f"{rest}/styles/snowdepth", f"{rest}/layers/SNODAS:snowdepth"},
+        )
+
+    def test_upload_measured(self):
+        tif = join(self.tmp, "swe.tif")
+        Path(tif).write_bytes(b"tiff")
+        start = len(instruments.records)
+        self.server.upload_data("swe", "SNODAS", tif)
+        record = instruments.records[start]
+        self.assertEqual((record["stage"], record["labels"], record["outcome"]), ("upload_data", {"product": "swe"}, "ok"))
+
+    def test_gwc_address(self):
+        self.assertEqual(gwc_address("http://host:8600/geoserver/rest/"), "http://host:8600/geoserver/gwc/rest")
+
+    def test_warm_cache(self):
+        environ["SNOSERVE_SEED_ZOOM"] = "2-6"
+        environ["SNOSERVE_SEED_GRIDSETS"] = "EPSG:4326,EPSG:900913"
+        environ["SNOSERVE_SEED_BBOX"] = "-112,43,-110,45"
+        results = self.server.warm_cache(["swe"])
+        self.assertEqual(results, {"swe": ["EPSG:4326", "EPSG:900913"]})
+        requests = [(request[1], request[2]) for request in GeoServerHandler.requests]
+        self.assertEqual(requests[0][0], "/geoserver/gwc/rest/masstruncate")
+        self.assertIn(b"<layerName>SNODAS:swe</layerName>", requests[0][1])
+        seeds = [json.loads(body)["seedRequest"] for path, body in requests[1:]]
+        self.assertEqual([seed["gridSetId"] for seed in seeds], ["EPSG:4326", "EPSG:900913"])
+        self.assertEqual((seeds[0]["zoomStart"], seeds[0]["zoomStop"]), (2, 6))
+        self.assertEqual(seeds[0]["bounds"]["coords"]["double"], ["-112.0", "43.0", "-110.0", "45.0"])
+        self.assertAlmostEqual(float(seeds[1]["bounds"]["coords"]["double"][0]), -12467782.96, places=1)
+        self.assertEqual(requests[1][0], "/geoserver/gwc/rest/seed/SNODAS:swe.json")
+
+    def test_sync_dry_run(self):
+        plan = self.server.style_types(["swe"], dry_run=True)
+        self.assertEqual(plan, ["create workspace SNODAS", "create style swe"])
+        self.assertEqual({request[0] for request in GeoServerHandler.requests}, {"GET"})
+
+
+class TestDerived(unittest.TestCase):
+    def setUp(self):
+        self.metadata = {
+            "Data units": "Meters / 1000.000000",
+            "Data slope": "0.001",
+            "Data intercept": "0",
+            "No data value": "-9999",
+        }
+        self.engine = derivedProducts(directory(dataDate()), definitions={})
+
+    def test_parse_derived(self):
+        tmp = mkdtemp()
+        try:
+            txt = join(tmp, "derived.txt")
+            Path(txt).write_text("a: inches swe\nb: change snowdepth 3 inches\nc: total precipsnow 7\n")
+            definitions = parse_derived(txt)
+        finally:
+            rmtree(tmp)
+        self.assertEqual(definitions["a"], {"operation": "inches", "product": "swe", "days": 1, "inches": False})
+        self.assertEqual(definitions["b"]["days"], 3)
+        self.assertTrue(definitions["b"]["inches"])
+        self.assertEqual(self.engine.offsets(definitions["b"]), [0, 3])
+        self.assertEqual(self.engine.offsets(definitions["c"]), [0, 1, 2, 3, 4, 5, 6])
+
+    def test_scale_from_units(self):
+        self.assertEqual(scale_from_metadata({"Data units": "Meters / 1000.000000"}), (0.001, 0.0, "Meters"))
+
+    def test_inches(self):
+        grid = np.array([[1000, -9999]], dtype=">i2")
+        result = self.engine.compute({"operation": "inches", "product": "snowdepth"}, [grid], self.metadata)
+        np.testing.assert_allclose(result, [[39.37007874, -9999.0]], rtol=1e-6)
+
+    def test_change_masks_nodata(self):
+        today = np.array([[500, 300, -9999]], dtype=">i2")
+        before = np.array([[200, -9999, 100]], dtype=">i2")
+        definition = {"operation": "change", "product": "snowdepth", "days": 1}
+        result = self.engine.compute(definition, [today, before], self.metadata)
+        np.testing.assert_allclose(result, [[0.3, -9999.0, -9999.0]], rtol=1e-6)
+
+    def test_total(self):
+        grids = [np.array([[10, 20]], dtype=">i2"), np.array([[5, -9999]], dtype=">i2")]
+        definition = {"operation": "total", "product": "precipsnow", "days": 2}
+        result = self.engine.compute(definition, grids, self.metadata)
+        np.testing.assert_allclose(result, [[0.015, -9999.0]], rtol=1e-6)
+
+    @unittest.skipUnless(gdal, "GDAL is not installed")
+    def test_run(self):
+        with TemporaryDirectory() as root:
+            dir = directory(dataDate("20240101"), root)
+            dir.outputProfiles = {"depth": "cog", "broken": "tiled"}
+            Path(dir.finalData).mkdir(parents=True)
+            tiff = GTIFF("snowdepth", dir, metadata=self.metadata)
+            tiff.name = "snowdepth"
+            tiff.fullPath = join(dir.finalData, "snowdepth.tif")
+            write_grid(tiff.fullPath, np.array([[1000, -9999], [2000, 0]], dtype=np.int16))
+            inches = {"operation": "inches", "product": "snowdepth", "days": 1, "inches": False}
+            (path,) = derivedProducts(dir, {"depth": inches}).run([tiff])
+            dataset = gdal.Open(path)
+            self.assertEqual(dataset.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE"), "COG")
+            np.testing.assert_allclose(
+                dataset.GetRasterBand(1).ReadAsArray(), [[39.37008, -9999.0], [78.74016, 0.0]], rtol=1e-5
+            )
+            dataset = None
+            # A product that fails leaves no partial file behind
+            tiff.metadata = {**self.metadata, "Data units": "Kelvin / 1.000000"}
+            with self.assertRaises(ValueError):
+                derivedProducts(dir, {"broken": inches}).run([tiff])
+            self.assertEqual(sorted(listdir(dir.finalData)), ["depth.tif", "snowdepth.tif"])
+
+
+class TestPalette(unittest.TestCase):
+    def setUp(self):
+        self.palette = palette(join(directory(dataDate()).colortables, "swe.txt"), -9999)
+
+    def test_read_colortable(self):
+        self.assertEqual(self.palette.entries[0], (0.0, (255, 255, 255, 0)))
+        self.assertEqual(self.palette.entries[-1], (800.0, (0, 0, 0, 255)))
+        self.assertEqual(self.palette.nodataColor, (0, 0, 0, 0))
+
+    def test_rgba(self):
+        block = np.array([[-9999, -5, 6], [12, 800, 30000]], dtype=np.int16)
+        np.testing.assert_array_equal(
+            self.palette.rgba(block),
+            [
+                [[0, 0, 0, 0], [255, 255, 255, 0], [255, 255, 255, 128]],
+                [[255, 255, 255, 255], [0, 0, 0, 255], [0, 0, 0, 255]],
+            ],
+        )
+
+    def test_indices(self):
+        indices = self.palette.indices(np.array([-9999, 0, 800, 1000], dtype=np.int16))
+        np.testing.assert_array_equal(indices, [0, 1, 255, 255])
+        np.testing.assert_array_equal(self.palette.colors[indices[2]], [0, 0, 0, 255])
+
+
 if __name__ == "__main__":
     unittest.main()